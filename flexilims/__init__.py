@@ -1,2 +1,11 @@
 from flexilims.main import Flexilims, get_token
 from flexilims.offline import OfflineFlexilims, download_database
+
+
+def __getattr__(name):
+    # aiohttp is slow to import, load the asyncio client only when it is used
+    if name == "AsyncFlexilims":
+        from flexilims.async_main import AsyncFlexilims
+
+        return AsyncFlexilims
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
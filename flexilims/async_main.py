@@ -0,0 +1,388 @@
+"""Asynchronous interface to flexilims
+
+This mirrors `flexilims.main.Flexilims` with coroutines instead of blocking calls, so
+that many requests can be in flight at the same time. It requires `aiohttp`, which is
+an optional dependency (`pip install flexilims[async]`).
+"""
+
+import asyncio
+import base64
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from flexilims.json_backend import get_json_backend
+from flexilims.main import (
+    BASE_URL,
+    _get_params,
+    _post_request,
+    _update_many_request,
+    _update_one_request,
+    check_status,
+)
+from flexilims.utils import AuthenticationError, FlexilimsError
+
+
+class AsyncFlexilims(object):
+    """Asynchronous interface to flexilims
+
+    The aiohttp session is created on the first request (or by `create_session`) and
+    must be closed with `close`. The object can also be used as an async context
+    manager:
+
+        async with AsyncFlexilims(username, password, project_id) as flm_sess:
+            sessions = await flm_sess.get(datatype="session")
+
+    Args:
+        username: username to connect to flexilims
+        password: password to connect to flexilims
+        project_id: hexadecimal id of the project to use
+        base_url: base url of the flexilims server
+        token: if you already have a token, you can pass it here
+        max_connections: maximum number of simultaneous connections to the server
+        json_backend: (optional) library used to decode replies and encode request
+            bodies, see `flexilims.main.Flexilims`
+    """
+
+    def __init__(
+        self,
+        username,
+        password,
+        project_id=None,
+        base_url=BASE_URL,
+        token=None,
+        max_connections=100,
+        json_backend=None,
+    ):
+        if aiohttp is None:
+            raise ImportError(
+                "AsyncFlexilims requires aiohttp. Install it with "
+                "`pip install flexilims[async]`"
+            )
+        assert isinstance(base_url, str), "base_url must be a string"
+        assert base_url.endswith("api/"), "base_url must end with 'api/'"
+
+        self.username = username
+        self.password = password
+        self.base_url = base_url
+        self.session = None
+        self.project_id = project_id
+        self.max_connections = max_connections
+        self.log = []
+        self._token = token
+        self._token_lock = None
+        self._json_backend = (
+            None if json_backend is None else get_json_backend(json_backend)
+        )
+
+    async def __aenter__(self):
+        await self.create_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def create_session(self, token=None):
+        """Create an aiohttp session with authentication information"""
+        if self.session is not None:
+            print("Session already exists.")
+            return
+        if token is None:
+            token = self._token
+        if token is None:
+            token = await get_token(self.username, self.password, self.base_url)
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        session = aiohttp.ClientSession(connector=connector)
+        session.headers.update(token)
+        self._token_lock = asyncio.Lock()
+        self.session = session
+        self.log.append("Session created for user %s" % self.username)
+
+    async def close(self):
+        """Close the underlying aiohttp session"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def update_token(self, timeout=600):
+        """Update the token in the session
+
+        Failed attempts are retried with an exponential backoff, until `timeout`
+        seconds have elapsed.
+        """
+        token = None
+        start = time.monotonic()
+        delay = 0.5
+        while token is None:
+            try:
+                token = await get_token(self.username, self.password, self.base_url)
+            except IOError:
+                remaining = timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise IOError("Failed to get a token. Timeout reached.")
+                delay = min(delay, remaining)
+                print("Failed to get a token. Retrying in %.1f seconds." % delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+        self.session.headers.update(token)
+
+    async def get(
+        self,
+        datatype=None,
+        project_id=None,
+        query_key=None,
+        query_value=None,
+        created_by=None,
+        id=None,
+        name=None,
+        origin_id=None,
+        date_created=None,
+        date_created_operator=None,
+        cross_project_entity=False,
+    ):
+        """Get all the entries of type datatype in the current project
+
+        See `flexilims.main.Flexilims.get` for a description of the arguments.
+
+        Returns:
+            a list of dictionary with one element per valid flexilimns entry.
+        """
+        if project_id is None:
+            project_id = self.project_id
+        params = _get_params(
+            datatype=datatype,
+            project_id=project_id,
+            query_key=query_key,
+            query_value=query_value,
+            created_by=created_by,
+            id=id,
+            name=name,
+            origin_id=origin_id,
+            date_created=date_created,
+            date_created_operator=date_created_operator,
+            cross_project_entity=cross_project_entity,
+        )
+        return await self.safe_execute("json", "GET", "get", params=params)
+
+    async def get_children(self, id):
+        """Get the children of one entry based on its hexadecimal id
+
+        Args:
+            id: hexadecimal id of the parent object
+        """
+        return await self.safe_execute(
+            "json", "GET", "get-children", params=dict(id=id)
+        )
+
+    async def get_project_info(self):
+        """Get the list of existing project and their properties
+
+        Returns:
+            proj_list (list of dict): a list with one dictionary per project
+        """
+        return await self.safe_execute("json", "GET", "projects")
+
+    async def update_one(
+        self,
+        id,
+        datatype,
+        origin_id=None,
+        name=None,
+        attributes=None,
+        strict_validation=True,
+        allow_nulls=True,
+        project_id=None,
+    ):
+        """Update one existing entity
+
+        See `flexilims.main.Flexilims.update_one` for a description of the arguments.
+
+        Returns: reply from flexilims
+        """
+        params, json_data = _update_one_request(
+            id=id,
+            datatype=datatype,
+            origin_id=origin_id,
+            name=name,
+            attributes=attributes,
+            strict_validation=strict_validation,
+            allow_nulls=allow_nulls,
+        )
+        return await self.safe_execute(
+            "json", "PUT", "update-one", params=params, **self._json_body(json_data)
+        )
+
+    async def update_many(
+        self,
+        datatype,
+        update_key,
+        update_value,
+        query_key=None,
+        query_value=None,
+        project_id=None,
+        strict_validation=False,
+    ):
+        """Update many existing entity
+
+        See `flexilims.main.Flexilims.update_many` for a description of the
+        arguments.
+
+        Returns: reply from flexilims
+        """
+        if project_id is None:
+            project_id = self.project_id
+        address, params = _update_many_request(
+            datatype=datatype,
+            update_key=update_key,
+            update_value=update_value,
+            query_key=query_key,
+            query_value=query_value,
+            project_id=project_id,
+            strict_validation=strict_validation,
+        )
+        return await self.safe_execute("content", "PUT", address, params=params)
+
+    async def post(
+        self,
+        datatype,
+        name,
+        attributes,
+        project_id=None,
+        origin_id=None,
+        other_relations=None,
+        strict_validation=True,
+    ):
+        """Create a new entry in the database
+
+        See `flexilims.main.Flexilims.post` for a description of the arguments.
+
+        Returns: reply from flexilims
+        """
+        if project_id is None:
+            project_id = self.project_id
+        address, json_data = _post_request(
+            datatype=datatype,
+            name=name,
+            attributes=attributes,
+            project_id=project_id,
+            origin_id=origin_id,
+            other_relations=other_relations,
+            strict_validation=strict_validation,
+        )
+        return await self.safe_execute(
+            "json", "POST", address, **self._json_body(json_data)
+        )
+
+    async def delete(self, id):
+        """Delete an entity
+
+        Args:
+            id: hexadecimal id of the entity to delete
+        """
+        return await self.safe_execute(
+            "content", "DELETE", "delete", params=dict(id=id)
+        )
+
+    async def safe_execute(self, mode, method, address, params=None, **kwargs):
+        """Send a request and update the token if needed
+
+        Args:
+            mode: 'json' or 'content' to return the json or the content of the response
+            method: HTTP method of the request ("GET", "POST", "PUT" or "DELETE")
+            address: endpoint, relative to `self.base_url`
+            params: (optional) query parameters of the request
+            **kwargs: keyword arguments to pass to `aiohttp.ClientSession.request`
+
+        Returns:
+            json or content of the response
+        """
+        if mode not in ("json", "content"):
+            raise ValueError("mode must be 'json' or 'content'")
+        if self.session is None:
+            await self.create_session()
+        if params is not None:
+            # aiohttp only accepts str, int or float. Format like `requests` would
+            params = {k: str(v) for k, v in params.items() if v is not None}
+        url = self.base_url + address
+        token = self.session.headers.get("Authorization")
+        try:
+            content = await self._request(method, url, params=params, **kwargs)
+        except AuthenticationError:
+            async with self._token_lock:
+                # another coroutine might have refreshed the token in the meantime
+                if self.session.headers.get("Authorization") == token:
+                    await self.update_token()
+            content = await self._request(method, url, params=params, **kwargs)
+        if mode == "json":
+            return self.json_backend.loads(content)
+        return content.decode("utf8")
+
+    async def _request(self, method, url, **kwargs):
+        """Send one request and return the body of the reply"""
+        async with self.session.request(method, url, **kwargs) as rep:
+            content = await rep.read()
+            self.handle_error(rep, content)
+        return content
+
+    def handle_error(self, rep, content):
+        """handles responses that have a status code != 200"""
+        return check_status(rep.status, content, self.base_url, rep=rep)
+
+    def _json_body(self, json_data):
+        """Keyword arguments to send `json_data` as the body of a request"""
+        return dict(
+            data=self.json_backend.dumps(json_data),
+            headers={"Content-Type": "application/json"},
+        )
+
+    @property
+    def json_backend(self):
+        """`flexilims.json_backend.JSONBackend` used by this session"""
+        if self._json_backend is None:
+            return get_json_backend()
+        return self._json_backend
+
+    @property
+    def project_id(self):
+        return self._project_id
+
+    @project_id.setter
+    def project_id(self, value):
+        if value is not None:
+            value = str(value)
+            try:
+                int(value, 16)
+            except ValueError:
+                raise FlexilimsError(
+                    "project_id must be a hexadecimal project id. Got %s" % value
+                )
+            if len(value) != 24:
+                raise FlexilimsError(
+                    "project_id must be a 24 characters long project id. Got %s" % value
+                )
+        self._project_id = value
+
+
+async def get_token(username, password, base_url=BASE_URL):
+    """Login to the database and create headers with the proper token"""
+    # use a dedicated session, so that the bearer token of an existing session is not
+    # sent with the credentials
+    credentials = base64.b64encode(("%s:%s" % (username, password)).encode("utf8"))
+    auth = {"Authorization": "Basic %s" % credentials.decode("ascii")}
+    async with aiohttp.ClientSession() as session:
+        try:
+            async with session.post(base_url + "authenticate", headers=auth) as rep:
+                text = await rep.text()
+                status = rep.status
+        except aiohttp.ClientConnectionError:
+            raise IOError("Cannot connect to flexilims. Are you on the Crick network?")
+    if status < 400:
+        token = text
+    else:
+        raise IOError("Failed to authenticate. Got an error %d" % status)
+
+    headers = {"Authorization": "Bearer %s" % token}
+    return headers
@@ -0,0 +1,412 @@
+"""Benchmarks of the offline and online code paths
+
+Run with:
+
+    python -m flexilims.bench --sizes 1000 100000 --output results.json
+
+Each benchmark is timed on synthetic databases of each size. The online benchmarks
+use a local `flexilims.server.FlexilimsServer`. Results are written as JSON and can be
+compared to a previous run with `--compare previous.json`.
+
+A benchmark is skipped for larger databases once its extrapolated duration (assuming
+linear scaling) exceeds `--max-time` seconds.
+"""
+
+import argparse
+import importlib.util
+import itertools
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from copy import deepcopy
+from datetime import datetime
+from pathlib import Path
+
+from flexilims.json_backend import get_json_backend
+from flexilims.main import Flexilims
+from flexilims.offline import OfflineFlexilims, download_database
+from flexilims.server import FlexilimsServer
+from flexilims.synthetic import HIERARCHY as TYPES
+from flexilims.synthetic import PROJECT_ID, write_database
+from flexilims.utils import format_results
+
+# name: (function, setup, online, per_size, requires)
+BENCHMARKS = {}
+
+
+def benchmark(name, setup=None, online=False, per_size=True, requires=()):
+    """Register a benchmark
+
+    Args:
+        name: name of the benchmark
+        setup: (optional) function called with the context before each run. Its
+            output is passed to the benchmark and its duration is not measured
+        online: whether the benchmark uses the local server
+        per_size: whether the benchmark depends on the database size. If False, it
+            is only run with the smallest database
+        requires: names of the optional modules needed by the benchmark. It is
+            skipped if one of them is not installed
+    """
+
+    def register(function):
+        BENCHMARKS[name] = (function, setup, online, per_size, tuple(requires))
+        return function
+
+    return register
+
+
+class BenchmarkContext(object):
+    """Database and sessions shared by the benchmarks of one size
+
+    Args:
+        n_entities: number of entities in the database
+        directory: directory where the database is written
+        seed: seed of the random database generator
+    """
+
+    def __init__(self, n_entities, directory, seed=0):
+        self.n_entities = n_entities
+        self.json_file = Path(directory) / ("database_%d.json" % n_entities)
+        write_database(self.json_file, n_entities, seed=seed)
+        self.offline = OfflineFlexilims(self.json_file)
+        entities = self.offline._flat_data()
+        by_type = {t: [e for e in entities if e["type"] == t] for t in TYPES}
+        rng = random.Random(seed)
+        self.sample = {t: rng.choice(v) for t, v in by_type.items() if v}
+        # a string attribute of a session, to filter on
+        attributes = self.sample["session"]["attributes"]
+        self.query = next(
+            (
+                (k, v)
+                for k, v in attributes.items()
+                if isinstance(v, str) and k != "path"
+            ),
+            ("path", attributes["path"]),
+        )
+        self.names = ("bench_%d" % i for i in itertools.count())
+        self._snapshot = None
+        self._server = None
+        self._online = None
+
+    @property
+    def snapshot(self):
+        """Output of `download_database`, created on first use"""
+        if self._snapshot is None:
+            self._snapshot = download_database(self.offline, types=TYPES, verbose=False)
+        return self._snapshot
+
+    @property
+    def online(self):
+        """Online client connected to a local server, started on first use"""
+        if self._online is None:
+            self._server = FlexilimsServer(self.json_file, project_id=PROJECT_ID)
+            self._server.start()
+            self._online = Flexilims(
+                "bench", "bench", project_id=PROJECT_ID, base_url=self._server.url
+            )
+        return self._online
+
+    def close(self):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+            self._online = None
+
+
+@benchmark("import_flexilims", per_size=False)
+def _import_flexilims(ctx):
+    # includes the start of the interpreter, about 20 ms
+    subprocess.run([sys.executable, "-c", "import flexilims"], check=True)
+
+
+@benchmark("offline_get_type")
+def _offline_get_type(ctx):
+    ctx.offline.get(datatype="dataset")
+
+
+@benchmark("offline_get_id")
+def _offline_get_id(ctx):
+    ctx.offline.get(id=ctx.sample["dataset"]["id"])
+
+
+@benchmark("offline_get_query")
+def _offline_get_query(ctx):
+    ctx.offline.get(
+        datatype="session", query_key=ctx.query[0], query_value=ctx.query[1]
+    )
+
+
+@benchmark("offline_get_date")
+def _offline_get_date(ctx):
+    ctx.offline.get(
+        datatype="dataset",
+        created_by="Synthetic User",
+        date_created=ctx.sample["dataset"]["dateCreated"],
+    )
+
+
+@benchmark("offline_get_children")
+def _offline_get_children(ctx):
+    ctx.offline.get_children(ctx.sample["session"]["id"])
+
+
+@benchmark("offline_find_entity")
+def _offline_find_entity(ctx):
+    ctx.offline._find_entity(ctx.sample["dataset"]["id"])
+
+
+@benchmark("offline_post")
+def _offline_post(ctx):
+    ctx.offline.post(
+        datatype="dataset",
+        name=next(ctx.names),
+        attributes=dict(path="bench/path", is_raw="yes"),
+        origin_id=ctx.sample["recording"]["id"],
+    )
+
+
+@benchmark("offline_update_one")
+def _offline_update_one(ctx):
+    ctx.offline.update_one(
+        id=ctx.sample["dataset"]["id"],
+        datatype="dataset",
+        attributes=dict(path="bench/updated"),
+    )
+
+
+@benchmark("download_database")
+def _download_database(ctx):
+    download_database(ctx.offline, types=TYPES, verbose=False)
+
+
+@benchmark("snapshot_load")
+def _snapshot_load(ctx):
+    # the fastest backend only helps if the file is valid JSON, without NaN
+    with open(ctx.json_file, "rb") as f:
+        get_json_backend("fastest").load(f)
+
+
+@benchmark("snapshot_dump", setup=lambda ctx: (ctx.snapshot,))
+def _snapshot_dump(ctx, snapshot):
+    get_json_backend("fastest").dumps(snapshot, allow_nan=True)
+
+
+@benchmark(
+    "format_results",
+    setup=lambda ctx: (deepcopy(ctx.offline._flat_data()),),
+    requires=("pandas",),
+)
+def _format_results(ctx, entities):
+    format_results(entities)
+
+
+@benchmark("online_get_type", online=True)
+def _online_get_type(ctx):
+    ctx.online.get(datatype="dataset")
+
+
+@benchmark("online_get_id", online=True)
+def _online_get_id(ctx):
+    ctx.online.get(datatype="dataset", id=ctx.sample["dataset"]["id"])
+
+
+@benchmark("online_get_children", online=True)
+def _online_get_children(ctx):
+    ctx.online.get_children(ctx.sample["session"]["id"])
+
+
+@benchmark("online_get_parallel", online=True)
+def _online_get_parallel(ctx):
+    ctx.online.get_parallel(datatype="dataset")
+
+
+@benchmark("online_post_many", online=True)
+def _online_post_many(ctx):
+    ctx.online.post_many(
+        [
+            dict(
+                datatype="dataset",
+                name=next(ctx.names),
+                attributes=dict(path="bench/path"),
+                origin_id=ctx.sample["recording"]["id"],
+            )
+            for _ in range(20)
+        ]
+    )
+
+
+def run_benchmarks(
+    sizes=(1000, 100000, 1000000),
+    names=None,
+    repeat=3,
+    max_time=30,
+    online=True,
+    seed=0,
+    verbose=True,
+):
+    """Run the benchmarks
+
+    Args:
+        sizes: number of entities of the databases
+        names: (optional) names of the benchmarks to run. All if None (default)
+        repeat: number of timed runs of each benchmark
+        max_time: skip a benchmark when its extrapolated duration is longer than
+            this, in seconds
+        online: whether to run the benchmarks of the online client
+        seed: seed of the random database generator
+        verbose: print progress to stderr
+
+    Returns:
+        dict: description of the environment and list of results
+    """
+    if names is None:
+        names = list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError("Unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+    if not online:
+        names = [n for n in names if not BENCHMARKS[n][2]]
+
+    results = []
+    last_duration = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for n_entities in sorted(sizes):
+            if verbose:
+                print("Creating database of %d entities" % n_entities, file=sys.stderr)
+            ctx = BenchmarkContext(n_entities, directory, seed=seed)
+            try:
+                for name in names:
+                    if not BENCHMARKS[name][3] and n_entities != min(sizes):
+                        continue
+                    result = dict(benchmark=name, n_entities=n_entities)
+                    if not _available(name):
+                        result["skipped"] = True
+                        results.append(result)
+                        continue
+                    if name in last_duration:
+                        previous_n, previous_time = last_duration[name]
+                        if previous_time * n_entities / previous_n > max_time:
+                            result["skipped"] = True
+                            results.append(result)
+                            continue
+                    times = _time_benchmark(name, ctx, repeat)
+                    last_duration[name] = (n_entities, min(times))
+                    result.update(
+                        skipped=False,
+                        times=times,
+                        min=min(times),
+                        median=statistics.median(times),
+                        mean=statistics.mean(times),
+                    )
+                    results.append(result)
+                    if verbose:
+                        print(
+                            "    %-24s %10.4f s" % (name, result["median"]),
+                            file=sys.stderr,
+                        )
+            finally:
+                ctx.close()
+    return dict(
+        version=_version(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        date=datetime.now().isoformat(),
+        repeat=repeat,
+        results=results,
+    )
+
+
+def _available(name):
+    """Whether the optional modules needed by a benchmark are installed"""
+    return all(importlib.util.find_spec(m) is not None for m in BENCHMARKS[name][4])
+
+
+def _time_benchmark(name, ctx, repeat):
+    function, setup, _, _, _ = BENCHMARKS[name]
+    times = []
+    for _ in range(repeat):
+        args = setup(ctx) if setup is not None else ()
+        start = time.perf_counter()
+        function(ctx, *args)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def compare(results, reference):
+    """Ratio of median durations between two runs
+
+    Args:
+        results: output of `run_benchmarks`
+        reference: output of a previous `run_benchmarks`
+
+    Returns:
+        list: (benchmark, n_entities, reference median, median, ratio) for the
+            benchmarks run in both
+    """
+    previous = {
+        (r["benchmark"], r["n_entities"]): r["median"]
+        for r in reference["results"]
+        if not r["skipped"]
+    }
+    output = []
+    for r in results["results"]:
+        key = (r["benchmark"], r["n_entities"])
+        if r["skipped"] or key not in previous:
+            continue
+        output.append(key + (previous[key], r["median"], r["median"] / previous[key]))
+    return output
+
+
+def _version():
+    try:
+        from importlib.metadata import version
+
+        return version("flexilims")
+    except Exception:
+        return "unknown"
+
+
+def main(argv=None):
+    """Run the benchmarks from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--benchmarks", nargs="+", default=None, choices=BENCHMARKS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-time", type=float, default=30)
+    parser.add_argument("--no-online", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON file. Default: stdout")
+    parser.add_argument("--compare", default=None, help="JSON file of a previous run")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        sizes=args.sizes,
+        names=args.benchmarks,
+        repeat=args.repeat,
+        max_time=args.max_time,
+        online=not args.no_online,
+        seed=args.seed,
+    )
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            reference = json.load(f)
+        for name, n_entities, before, after, ratio in compare(results, reference):
+            print(
+                "%-24s %9d %10.4f s -> %10.4f s (x%.2f)"
+                % (name, n_entities, before, after, ratio),
+                file=sys.stderr,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+"""Caches for replies of flexilims read requests."""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import deepcopy
+
+
+class ResponseCache(object):
+    """In-memory read-through cache of flexilims replies
+
+    Entries are evicted when they are older than `ttl` or, in least recently used
+    order, when the cache holds more than `max_entries` entries or more than
+    `max_bytes` bytes. Each entry is associated with a set of tags (ids, types or
+    parents of the entities in the reply) used to invalidate it after a write.
+
+    The cache is thread-safe and can be shared between several `Flexilims` objects.
+
+    Args:
+        ttl: time to live of entries in seconds. Never expire if None (default)
+        max_entries: maximum number of entries. Unlimited if None
+        max_bytes: maximum total size in bytes, estimated from the JSON size of the
+            replies. Unlimited if None (default)
+    """
+
+    def __init__(self, ttl=None, max_entries=1000, max_bytes=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key):
+        """Find a valid entry in the cache
+
+        Args:
+            key: hashable key of the request
+
+        Returns:
+            (bool, value): whether the key was found and a copy of the cached reply
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._remove(key)
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            value = entry["value"]
+        return True, deepcopy(value)
+
+    def store(self, key, value, tags=(), generation=None):
+        """Add a reply to the cache
+
+        Args:
+            key: hashable key of the request
+            value: reply to cache. A copy is stored
+            tags: iterable of tags used by `invalidate`
+            generation: (optional) value of `self.generation` when the request was
+                sent. If an invalidation happened since, the reply might be outdated
+                and is not stored
+        """
+        size = 0
+        if self.max_bytes is not None:
+            size = len(json.dumps(value, default=str))
+            if size > self.max_bytes:
+                return
+        entry = dict(
+            value=deepcopy(value), tags=set(tags), size=size, time=time.monotonic()
+        )
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._size += size
+            while self._entries and (
+                (self.max_entries is not None and len(self._entries) > self.max_entries)
+                or (self.max_bytes is not None and self._size > self.max_bytes)
+            ):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, tags):
+        """Remove all entries with at least one of `tags`
+
+        Args:
+            tags: iterable of tags
+
+        Returns:
+            int: number of entries removed
+        """
+        tags = set(tags)
+        with self._lock:
+            self.generation += 1
+            to_remove = [k for k, e in self._entries.items() if e["tags"] & tags]
+            for key in to_remove:
+                self._remove(key)
+            self.invalidations += len(to_remove)
+        return len(to_remove)
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """Usage counters of the cache
+
+        Returns:
+            dict: number of entries, size, hits, misses, evictions and invalidations
+        """
+        with self._lock:
+            return dict(
+                entries=len(self._entries),
+                bytes=self._size,
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                invalidations=self.invalidations,
+            )
+
+    def _expired(self, entry):
+        return self.ttl is not None and time.monotonic() - entry["time"] > self.ttl
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry["size"]
+
+
+def request_key(endpoint, params=None):
+    """Normalise a request into a hashable cache key
+
+    Parameters are formatted as they are sent to the server, so that requests with
+    equivalent parameters share the same key.
+
+    Args:
+        endpoint: name of the endpoint (e.g. "get")
+        params: dictionary of query parameters
+
+    Returns:
+        tuple: cache key
+    """
+    if params is None:
+        params = {}
+    return (endpoint,) + tuple(
+        sorted((k, str(v)) for k, v in params.items() if v is not None)
+    )
+
+
+def reply_tags(reply):
+    """Tags of the entities of a `get` or `get-children` reply
+
+    Args:
+        reply: list of entities
+
+    Returns:
+        set: ("id", id) and ("type", type) for each entity
+    """
+    tags = set()
+    for entity in reply:
+        tags.add(("id", entity.get("id")))
+        tags.add(("type", entity.get("type")))
+    return tags
+
+
+class SQLiteCache(object):
+    """Persistent cache of flexilims replies in a SQLite database
+
+    The database can be shared between processes (e.g. cluster jobs) to avoid
+    downloading the same data many times. Entities are stored once, keyed by id, and
+    each cached request keeps the list of ids of its reply. When several replies
+    contain the same entity, the version with the most recent `dateUpdated` is kept.
+
+    Staleness is controlled by `max_age`: older entries are not returned by `lookup`.
+    `Flexilims` refreshes an expired `get` reply by fetching only the entities created
+    after the most recent `dateCreated` of the cached reply. Changes to existing
+    entities made by other clients are only seen after an explicit `invalidate` (or
+    `clear`). Write requests made through a `Flexilims` object using this cache
+    invalidate the affected entries automatically.
+
+    Args:
+        path: path to the SQLite database file. Created if it does not exist
+        max_age: maximum age of entries in seconds. Never expire if None (default)
+        timeout: how long to wait, in seconds, for another process to release a lock
+            on the database
+    """
+
+    def __init__(self, path, max_age=None, timeout=30):
+        self.path = str(path)
+        self.max_age = max_age
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.generation = 0
+        self._lock = threading.Lock()
+        with self._connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS entities "
+                "(id TEXT PRIMARY KEY, date_updated INTEGER, data TEXT)"
+            )
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS queries "
+                "(key TEXT PRIMARY KEY, ids TEXT, value TEXT, cached_at REAL)"
+            )
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS tags "
+                "(tag TEXT, key TEXT, PRIMARY KEY (tag, key))"
+            )
+
+    def __len__(self):
+        with self._connect() as con:
+            return con.execute("SELECT COUNT(*) FROM queries").fetchone()[0]
+
+    def _connect(self):
+        return _closing_connection(self.path, timeout=self.timeout)
+
+    def lookup(self, key):
+        """Find a valid entry in the cache
+
+        Args:
+            key: hashable key of the request
+
+        Returns:
+            (bool, value): whether the key was found and the cached reply
+        """
+        found, value, cached_at = self._read(key)
+        if found and self.max_age is not None:
+            found = time.time() - cached_at <= self.max_age
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found, value if found else None
+
+    def lookup_stale(self, key):
+        """Find an entry in the cache, even if it is older than `max_age`
+
+        Args:
+            key: hashable key of the request
+
+        Returns:
+            (bool, value): whether the key was found and the cached reply
+        """
+        found, value, _ = self._read(key)
+        return found, value
+
+    def _read(self, key):
+        with self._connect() as con:
+            row = con.execute(
+                "SELECT ids, value, cached_at FROM queries WHERE key = ?",
+                (_dump_key(key),),
+            ).fetchone()
+            if row is None:
+                return False, None, None
+            ids, value, cached_at = row
+            if ids is None:
+                return True, json.loads(value), cached_at
+            ids = json.loads(ids)
+            entities = {}
+            # sqlite limits the number of variables per query
+            for start in range(0, len(ids), 500):
+                chunk = ids[start : start + 500]
+                rows = con.execute(
+                    "SELECT id, data FROM entities WHERE id IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    chunk,
+                )
+                entities.update(rows)
+        if len(entities) != len(set(ids)):
+            # some entities have been invalidated
+            return False, None, None
+        return True, [json.loads(entities[i]) for i in ids], cached_at
+
+    def store(self, key, value, tags=(), generation=None):
+        """Add a reply to the cache
+
+        Args:
+            key: hashable key of the request
+            value: reply to cache
+            tags: iterable of tags used by `invalidate`
+            generation: (optional) value of `self.generation` when the request was
+                sent. If an invalidation happened since, the reply is not stored
+        """
+        key = _dump_key(key)
+        is_entities = isinstance(value, list) and all(
+            isinstance(e, dict) and "id" in e for e in value
+        )
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            with self._connect() as con:
+                if is_entities:
+                    con.executemany(
+                        "INSERT INTO entities (id, date_updated, data) "
+                        "VALUES (?, ?, ?) ON CONFLICT(id) DO UPDATE SET "
+                        "date_updated = excluded.date_updated, data = excluded.data "
+                        "WHERE excluded.date_updated >= entities.date_updated",
+                        [
+                            (
+                                e["id"],
+                                e.get("dateUpdated", e.get("dateCreated", 0)),
+                                json.dumps(e),
+                            )
+                            for e in value
+                        ],
+                    )
+                    row = (key, json.dumps([e["id"] for e in value]), None)
+                else:
+                    row = (key, None, json.dumps(value))
+                con.execute(
+                    "INSERT OR REPLACE INTO queries (key, ids, value, cached_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    row + (time.time(),),
+                )
+                con.execute("DELETE FROM tags WHERE key = ?", (key,))
+                con.executemany(
+                    "INSERT OR IGNORE INTO tags (tag, key) VALUES (?, ?)",
+                    [(_dump_key(tag), key) for tag in tags],
+                )
+
+    def invalidate(self, tags):
+        """Remove all entries with at least one of `tags`
+
+        Entities with an ("id", id) tag are also removed, which invalidates all the
+        replies containing them.
+
+        Args:
+            tags: iterable of tags
+
+        Returns:
+            int: number of entries removed
+        """
+        tags = list(tags)
+        ids = [tag[1] for tag in tags if tag[0] == "id"]
+        with self._lock:
+            self.generation += 1
+            with self._connect() as con:
+                keys = set()
+                for tag in tags:
+                    rows = con.execute(
+                        "SELECT key FROM tags WHERE tag = ?", (_dump_key(tag),)
+                    )
+                    keys.update(row[0] for row in rows)
+                con.executemany(
+                    "DELETE FROM queries WHERE key = ?", [(k,) for k in keys]
+                )
+                con.executemany("DELETE FROM tags WHERE key = ?", [(k,) for k in keys])
+                con.executemany(
+                    "DELETE FROM entities WHERE id = ?", [(i,) for i in ids]
+                )
+            self.invalidations += len(keys)
+        return len(keys)
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self.generation += 1
+            with self._connect() as con:
+                for table in ("entities", "queries", "tags"):
+                    con.execute("DELETE FROM %s" % table)
+
+    def stats(self):
+        """Usage counters of the cache
+
+        Hits, misses and invalidations are counted for this process only.
+
+        Returns:
+            dict: number of entries and entities, hits, misses and invalidations
+        """
+        with self._connect() as con:
+            entries = con.execute("SELECT COUNT(*) FROM queries").fetchone()[0]
+            entities = con.execute("SELECT COUNT(*) FROM entities").fetchone()[0]
+        return dict(
+            entries=entries,
+            entities=entities,
+            hits=self.hits,
+            misses=self.misses,
+            invalidations=self.invalidations,
+        )
+
+
+@contextmanager
+def _closing_connection(path, timeout=30):
+    """Open a SQLite connection, commit on success and always close it"""
+    con = sqlite3.connect(path, timeout=timeout)
+    try:
+        with con:
+            yield con
+    finally:
+        con.close()
+
+
+def _dump_key(key):
+    """Serialise a cache key or tag to a string"""
+    return json.dumps(key, default=str)
@@ -0,0 +1,178 @@
+"""Selection of the library used to encode and decode JSON
+
+The standard library `json` is used by default. `orjson` or `ujson`, if installed,
+are much faster to decode large replies and snapshots:
+
+    import flexilims.json_backend
+    flexilims.json_backend.set_json_backend("orjson")  # for all sessions
+    flm_sess = Flexilims(username, password, json_backend="orjson")  # for one session
+
+If a backend fails on some data, the standard library is used for that call. `NaN`
+and infinities are not valid JSON: encoding them raises a `ValueError`, unless
+`allow_nan=True` is given, as for the offline snapshots. Older snapshots can contain
+them. They are then written as `NaN`, except by `orjson`, which writes `null`.
+"""
+
+import json
+import math
+import warnings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+_DEFAULT_BACKEND = "json"
+_BACKENDS = {}
+
+
+class JSONBackend(object):
+    """Encode and decode JSON with one library, falling back to `json`
+
+    Args:
+        name: name of the backend
+        loads: function decoding a str or bytes
+        dumps: function encoding an object to bytes, with an `allow_nan` argument
+    """
+
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self._loads = loads
+        self._dumps = dumps
+
+    def __repr__(self):
+        return "JSONBackend(%r)" % self.name
+
+    def loads(self, data):
+        """Decode a JSON document
+
+        Args:
+            data: str or bytes
+
+        Returns:
+            decoded object
+        """
+        try:
+            return self._loads(data)
+        except ValueError:
+            if self._loads is json.loads:
+                raise
+            return json.loads(data)
+
+    def dumps(self, obj, allow_nan=False):
+        """Encode an object as JSON
+
+        Args:
+            obj: object to encode
+            allow_nan: write NaN and infinities as `NaN` and `Infinity`, which are
+                not valid JSON. If False, raise a ValueError instead
+
+        Returns:
+            bytes: utf-8 encoded JSON
+        """
+        try:
+            return self._dumps(obj, allow_nan=allow_nan)
+        except (TypeError, ValueError, OverflowError):
+            if self._dumps is _json_dumps:
+                raise
+            return _json_dumps(obj, allow_nan=allow_nan)
+
+    def load(self, file):
+        """Decode a JSON file opened in binary mode"""
+        return self.loads(file.read())
+
+    def dump(self, obj, file, allow_nan=False):
+        """Encode an object to a JSON file opened in binary mode"""
+        file.write(self.dumps(obj, allow_nan=allow_nan))
+
+
+def _json_dumps(obj, allow_nan=False):
+    return json.dumps(obj, allow_nan=allow_nan).encode("utf8")
+
+
+def _orjson_dumps(obj, allow_nan=False):
+    # orjson silently writes NaN as null. Only small request bodies are checked, as
+    # walking a whole snapshot in python is slower than encoding it with json
+    if not allow_nan and _contains_nan(obj):
+        raise ValueError("Out of range float values are not JSON compliant")
+    return orjson.dumps(obj)
+
+
+def _contains_nan(obj):
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, float):
+            if not math.isfinite(obj):
+                return True
+        elif isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+    return False
+
+
+def _ujson_dumps(obj, allow_nan=False):
+    return ujson.dumps(obj, ensure_ascii=False, allow_nan=allow_nan).encode("utf8")
+
+
+_BACKENDS["json"] = JSONBackend("json", json.loads, _json_dumps)
+if orjson is not None:
+    _BACKENDS["orjson"] = JSONBackend("orjson", orjson.loads, _orjson_dumps)
+if ujson is not None:
+    _BACKENDS["ujson"] = JSONBackend("ujson", ujson.loads, _ujson_dumps)
+
+
+def available_backends():
+    """Names of the installed JSON backends
+
+    Returns:
+        list: names of the backends, from the fastest
+    """
+    return [name for name in ("orjson", "ujson", "json") if name in _BACKENDS]
+
+
+def get_json_backend(name=None):
+    """Get a JSON backend
+
+    Args:
+        name: "json", "orjson", "ujson", "fastest" for the fastest installed
+            backend, or a `JSONBackend`. If None, use the global default (see
+            `set_json_backend`)
+
+    Returns:
+        JSONBackend: the backend. Uses `json` if the requested library is not
+            installed
+    """
+    if isinstance(name, JSONBackend):
+        return name
+    if name is None:
+        name = _DEFAULT_BACKEND
+    if name == "fastest":
+        name = available_backends()[0]
+    if name in _BACKENDS:
+        return _BACKENDS[name]
+    if name not in ("orjson", "ujson"):
+        raise ValueError("Unknown JSON backend: %s" % name)
+    warnings.warn("%s is not installed. Using the standard json library" % name)
+    return _BACKENDS["json"]
+
+
+def set_json_backend(name):
+    """Set the default JSON backend of all sessions
+
+    Args:
+        name: "json", "orjson", "ujson" or "fastest"
+
+    Returns:
+        JSONBackend: the new default backend
+    """
+    global _DEFAULT_BACKEND
+    backend = get_json_backend(name)
+    _DEFAULT_BACKEND = backend.name
+    return backend
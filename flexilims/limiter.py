@@ -0,0 +1,150 @@
+"""Adaptive limit of the number of concurrent requests sent to flexilims."""
+
+import threading
+import time
+from collections import deque
+
+
+class AdaptiveLimiter(object):
+    """Concurrency limit adapted to the load of the server, and optional rate limit
+
+    The number of requests in flight is limited with an additive increase,
+    multiplicative decrease (AIMD) rule: each successful request raises the limit by
+    `1 / limit` (about +1 per round of requests) while the limit is in use, and each
+    overload (5xx or 429 status code, timeout or connection error) multiplies it by
+    `backoff_factor`. Overloads of requests sent before the last decrease are ignored,
+    so that a burst of failures only reduces the limit once.
+
+    If `rate` is set, requests are also spaced by a token bucket allowing `rate`
+    requests per second on average, with bursts of up to `burst` requests.
+
+    A limiter is thread-safe and can be shared between several `Flexilims` objects so
+    that they adapt together to the server load.
+
+    Args:
+        initial_limit: initial number of concurrent requests
+        min_limit: minimum number of concurrent requests
+        max_limit: maximum number of concurrent requests
+        backoff_factor: factor applied to the limit after an overload
+        rate: (optional) maximum average number of requests per second. Unlimited
+            if None (default)
+        burst: (optional) maximum number of requests sent at once when the rate
+            limit allows it. Default to `max(1, rate)`
+        window: duration, in seconds, over which the throughput is measured
+    """
+
+    def __init__(
+        self,
+        initial_limit=10,
+        min_limit=1,
+        max_limit=50,
+        backoff_factor=0.5,
+        rate=None,
+        burst=None,
+        window=10,
+    ):
+        if not min_limit <= initial_limit <= max_limit:
+            raise ValueError("initial_limit must be between min_limit and max_limit")
+        if not 0 < backoff_factor < 1:
+            raise ValueError("backoff_factor must be between 0 and 1")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_factor = backoff_factor
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate or 1)
+        self.window = window
+        self.limit = float(initial_limit)
+        self.in_flight = 0
+        self.successes = 0
+        self.overloads = 0
+        self.decreases = 0
+        self._last_decrease = time.monotonic()
+        self._completions = deque()
+        self._condition = threading.Condition()
+        self._rate_lock = threading.Lock()
+        self._tokens = self.burst
+        self._last_refill = time.monotonic()
+
+    def acquire(self):
+        """Wait until a request can be sent
+
+        Returns:
+            float: time at which the request was allowed, to pass to `release`
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+        if self.rate is not None:
+            self._take_token()
+        return time.monotonic()
+
+    def release(self, started, overloaded=False):
+        """Report the end of a request
+
+        Args:
+            started: output of the corresponding `acquire`
+            overloaded: whether the server appeared overloaded (5xx or 429 status
+                code, timeout or connection error)
+        """
+        now = time.monotonic()
+        with self._condition:
+            limit_used = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if overloaded:
+                self.overloads += 1
+                if started >= self._last_decrease:
+                    self.limit = max(self.min_limit, self.limit * self.backoff_factor)
+                    self._last_decrease = now
+                    self.decreases += 1
+            else:
+                self.successes += 1
+                if limit_used:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._completions.append(now)
+            self._trim_completions(now)
+            self._condition.notify_all()
+
+    def throughput(self):
+        """Number of requests completed per second over the last `window` seconds"""
+        with self._condition:
+            self._trim_completions(time.monotonic())
+            return len(self._completions) / self.window
+
+    def stats(self):
+        """Current limits and throughput
+
+        Returns:
+            dict: `limit` and `in_flight` requests, `successes`, `overloads`, number
+                of `decreases` of the limit, `throughput` in requests per second and
+                `rate` limit
+        """
+        throughput = self.throughput()
+        with self._condition:
+            return dict(
+                limit=int(self.limit),
+                in_flight=self.in_flight,
+                successes=self.successes,
+                overloads=self.overloads,
+                decreases=self.decreases,
+                throughput=throughput,
+                rate=self.rate,
+            )
+
+    def _trim_completions(self, now):
+        while self._completions and self._completions[0] < now - self.window:
+            self._completions.popleft()
+
+    def _take_token(self):
+        """Wait for a token of the rate limit bucket"""
+        with self._rate_lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._last_refill) * self.rate
+                )
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                time.sleep((1 - self._tokens) / self.rate)
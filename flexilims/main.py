@@ -1,16 +1,35 @@
 """Generic function to interface with flexilims"""
 
+import base64
+import json
+import random
 import re
+import threading
 import time
 import warnings
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from copy import deepcopy
 
 import requests
+import urllib3
 from requests.auth import HTTPBasicAuth
 
+from flexilims.cache import SQLiteCache, reply_tags, request_key
+from flexilims.json_backend import get_json_backend
+from flexilims.limiter import AdaptiveLimiter
+from flexilims.stats import RequestStats
 from flexilims.utils import (
     AuthenticationError,
     FlexilimsError,
+    ServerError,
     check_flexilims_validity,
+    iter_json_array,
 )
 
 BASE_URL = "https://flexylims.thecrick.org/flexilims/api/"
@@ -27,10 +46,79 @@ class Flexilims(object):
         project_id: hexadecimal id of the project to use
         base_url: base url of the flexilims server
         token: if you already have a token, you can pass it here
+        token_lifetime: (optional) validity of a new token in seconds. Only used if the
+            expiry date cannot be read from the token itself. If None (default),
+            tokens are only refreshed when a request is rejected
+        token_refresh_margin: refresh the token this many seconds before it expires
+        cache: (optional) a `flexilims.cache.ResponseCache` or
+            `flexilims.cache.SQLiteCache` used to store the replies of `get`,
+            `get_children` and `get_project_info`. It is invalidated by write
+            requests made through this object. No cache if None (default)
+        log_size: maximum number of messages kept in `self.log`
+        json_backend: (optional) library used to decode replies and encode request
+            bodies: "json", "orjson", "ujson" or "fastest". If None (default), use
+            the global default, see `flexilims.json_backend.set_json_backend`
+        coalesce_reads: if True (default), identical `get`, `get_children` and
+            `get_project_info` requests made at the same time by several threads
+            share a single HTTP request
+        limiter: (optional) a `flexilims.limiter.AdaptiveLimiter` controlling the
+            number of concurrent requests and their rate. It can be shared between
+            sessions. A new limiter with default settings is created if None
+        timeout: timeout of each HTTP request in seconds, as a single number or a
+            (connect, read) tuple. The read timeout is the maximum time between two
+            bytes of the reply. No timeout if None
+        deadline: (optional) maximum duration in seconds of a call, including
+            retries. Enforced approximately, by shortening the timeout of the last
+            attempts. No deadline if None (default)
+        max_retries: number of times a request is retried after a connection error,
+            a timeout or a 5xx error, with exponential backoff. `post` and `delete`
+            requests are only retried if they could not reach the server
+        backoff: initial backoff delay in seconds. The delay before the n-th retry is
+            drawn uniformly between 0 and `backoff * 2 ** n` (full jitter)
+        max_backoff: maximum backoff delay in seconds
+        hedge_quantile: (optional) latency quantile, between 0 and 1, after which a
+            second identical GET request is sent if the first has not replied. The
+            first reply is used. No hedged requests if None (default)
+        hedge_min_samples: number of requests to an endpoint needed to estimate the
+            latency quantile before hedging requests to it
+        pool_maxsize: (optional) maximum number of connections kept open to the
+            server. If None (default), enough for the maximum number of concurrent
+            requests allowed by the limiter, doubled if requests are hedged
+        pool_connections: number of hosts for which a connection pool is kept
+        pool_block: if True, requests wait for a free connection when
+            `pool_maxsize` connections are in use, instead of opening a connection
+            that is closed after the request. Default to False
+        keep_alive: if True (default), connections are reused between requests
+        adapter: (optional) a `requests.adapters.HTTPAdapter` mounted on the session,
+            replacing the pool settings above
     """
 
     def __init__(
-        self, username, password, project_id=None, base_url=BASE_URL, token=None
+        self,
+        username,
+        password,
+        project_id=None,
+        base_url=BASE_URL,
+        token=None,
+        token_lifetime=None,
+        token_refresh_margin=60,
+        cache=None,
+        log_size=1000,
+        json_backend=None,
+        coalesce_reads=True,
+        limiter=None,
+        timeout=(10, 300),
+        deadline=None,
+        max_retries=3,
+        backoff=0.5,
+        max_backoff=30,
+        hedge_quantile=None,
+        hedge_min_samples=20,
+        pool_maxsize=None,
+        pool_connections=requests.adapters.DEFAULT_POOLSIZE,
+        pool_block=False,
+        keep_alive=True,
+        adapter=None,
     ):
         assert isinstance(base_url, str), "base_url must be a string"
         assert base_url.endswith("api/"), "base_url must end with 'api/'"
@@ -40,7 +128,39 @@ class Flexilims(object):
         self.base_url = base_url
         self.session = None
         self.project_id = project_id
+        self.cache = cache
+        self.token_lifetime = token_lifetime
+        self.token_refresh_margin = token_refresh_margin
+        self._token_expiry = None
+        self._token_lock = threading.RLock()
+        self.request_stats = RequestStats()
+        self.limiter = limiter if limiter is not None else AdaptiveLimiter()
+        self.coalesce_reads = coalesce_reads
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self._hedge_executor = None
+        self._hedge_lock = threading.Lock()
+        if pool_maxsize is None:
+            pool_maxsize = self.limiter.max_limit * (1 if hedge_quantile is None else 2)
+        self.pool_maxsize = pool_maxsize
+        self.pool_connections = pool_connections
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self.adapter = adapter
+        self._single_flight = _SingleFlight()
+        # incremented by each write, so that reads sent after a write do not share
+        # the reply of a read sent before
+        self._write_generation = 0
+        self.log_size = log_size
         self.log = []
+        self._json_backend = (
+            None if json_backend is None else get_json_backend(json_backend)
+        )
         self.create_session(password, token=token)
 
     def create_session(self, password, token=None):
@@ -49,28 +169,143 @@ class Flexilims(object):
             print("Session already exists.")
             return
 
-        session = requests.Session()
+        session = self._make_session()
         if token is None:
-            token = get_token(self.username, password, self.base_url)
+            try:
+                token = get_token(
+                    self.username,
+                    password,
+                    self.base_url,
+                    timeout=self.timeout,
+                    session=session,
+                )
+            except BaseException:
+                session.close()
+                raise
 
-        session.headers.update(token)
         self.session = session
-        self.log.append("Session created for user %s" % self.username)
+        self._set_token(token)
+        self._log("Session created for user %s" % self.username)
+
+    def _make_session(self):
+        """Create a `requests.Session` with a connection pool sized for this object"""
+        session = requests.Session()
+        adapter = self.adapter
+        if adapter is None:
+            # retries are handled by `safe_execute`
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=self.pool_connections,
+                pool_maxsize=self.pool_maxsize,
+                pool_block=self.pool_block,
+                max_retries=0,
+            )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if not self.keep_alive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def _log(self, message):
+        """Add a message to `self.log`, dropping the oldest beyond `self.log_size`"""
+        self.log.append(message)
+        if len(self.log) > self.log_size:
+            del self.log[: len(self.log) - self.log_size]
+
+    def close(self):
+        """Close the connections to the server"""
+        if self.session is not None:
+            self.session.close()
+        with self._hedge_lock:
+            if self._hedge_executor is not None:
+                self._hedge_executor.shutdown(wait=False)
+                self._hedge_executor = None
 
     def update_token(self, timeout=600):
-        """Update the token in the session"""
+        """Update the token in the session
+
+        Failed attempts are retried with an exponential backoff, until `timeout`
+        seconds have elapsed. Concurrent calls from several threads share the same
+        refresh.
+        """
+        with self._token_lock:
+            self._update_token(timeout=timeout)
+
+    def _update_token(self, timeout=600):
+        """Get a new token. Must be called with `self._token_lock` acquired"""
         token = None
-        elapsed_time = 0
-        while token is None and elapsed_time < timeout:
-            elapsed_time += 5
+        start = time.monotonic()
+        delay = 0.5
+        while token is None:
+            request_start = time.monotonic()
             try:
-                token = get_token(self.username, self.password, self.base_url)
-            except IOError:
-                print("Failed to get a token. Retrying in 5 seconds.")
-                time.sleep(5)
-        if token is None:
-            raise IOError("Failed to get a token. Timeout reached.")
+                token = get_token(
+                    self.username,
+                    self.password,
+                    self.base_url,
+                    timeout=self.timeout,
+                    session=self.session,
+                )
+            except IOError as err:
+                self.request_stats.record(
+                    "authenticate", time.monotonic() - request_start, error=err
+                )
+                remaining = timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise IOError("Failed to get a token. Timeout reached.")
+                delay = min(delay, remaining)
+                print("Failed to get a token. Retrying in %.1f seconds." % delay)
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+        self.request_stats.record("authenticate", time.monotonic() - request_start)
+        self.request_stats.record_token_refresh()
+        self._set_token(token)
+        self._log("Token refreshed for user %s" % self.username)
+
+    def _set_token(self, token):
+        """Set the token headers of the session and find when it expires"""
         self.session.headers.update(token)
+        expiry = _token_expiry(token["Authorization"])
+        if expiry is None and self.token_lifetime is not None:
+            expiry = time.time() + self.token_lifetime
+        self._token_expiry = expiry
+
+    def _refresh_token(self, stale_token=None, timeout=600):
+        """Refresh the token once, even if called by many threads at the same time
+
+        Args:
+            stale_token: (optional) Authorization header that was rejected or is
+                about to expire. If the session already uses another token, another
+                thread refreshed it and nothing is done.
+            timeout: see `update_token`
+        """
+        with self._token_lock:
+            if (
+                stale_token is not None
+                and self.session.headers.get("Authorization") != stale_token
+            ):
+                return
+            self._update_token(timeout=timeout)
+
+    def _check_token(self):
+        """Refresh the token if it is about to expire
+
+        Returns:
+            str: the Authorization header used for the next request
+        """
+        token = self.session.headers.get("Authorization")
+        expiry = self._token_expiry
+        now = time.time()
+        if expiry is None or now < expiry - self.token_refresh_margin:
+            return token
+        if now >= expiry:
+            self._refresh_token(token)
+        else:
+            try:
+                self._refresh_token(token, timeout=expiry - now)
+            except IOError:
+                # the current token is still valid, try again at the next request
+                return token
+        return self.session.headers.get("Authorization")
 
     def get(
         self,
@@ -113,51 +348,267 @@ class Flexilims(object):
 
         if project_id is None:
             project_id = self.project_id
-        params = dict(type=datatype, project_id=project_id)
-        if date_created_operator is not None:
-            assert date_created_operator in ("gt", "lt")
-        elif date_created is not None:
-            date_created_operator = "gt"
-        if cross_project_entity:
-            params["cross_project_entity"] = "yes"
-        else:
-            params["cross_project_entity"] = "no"
-        # add all non-None arguments in the list
-        args = (
-            "query_key",
-            "query_value",
-            "id",
-            "name",
-            "origin_id",
-            "date_created",
-            "date_created_operator",
-            "created_by",
+        params = _get_params(
+            datatype=datatype,
+            project_id=project_id,
+            query_key=query_key,
+            query_value=query_value,
+            created_by=created_by,
+            id=id,
+            name=name,
+            origin_id=origin_id,
+            date_created=date_created,
+            date_created_operator=date_created_operator,
+            cross_project_entity=cross_project_entity,
         )
-        for arg_name in args:
-            if locals()[arg_name] is not None:
-                params[arg_name] = locals()[arg_name]
+        return self._cached_read("get", params=params, tags=[("type", datatype)])
 
-        return self.safe_execute(
-            "json", self.session.get, self.base_url + "get", params=params
+    def get_parallel(
+        self,
+        datatype=None,
+        project_id=None,
+        query_key=None,
+        query_value=None,
+        created_by=None,
+        id=None,
+        name=None,
+        origin_id=None,
+        date_created=None,
+        date_created_operator=None,
+        cross_project_entity=False,
+        page_size=1000,
+        max_workers=None,
+        target_duration=2.0,
+        min_page_size=100,
+        max_page_size=20000,
+    ):
+        """Get entries by downloading pages of the reply in parallel
+
+        This gives the same result as `get` but splits a large request into pages
+        (using the `offset` and `limit` parameters of the API) that are downloaded
+        concurrently and merged. Duplicated entities (if the database changed during
+        the download) are removed. If the server ignores `offset` and `limit`, which
+        is detected from a page longer than requested or a page with only entities
+        already received, a single `get` request is sent instead. The cache is not
+        used. See `get` for a description of the filtering arguments.
+
+        The first page is requested alone, so that small requests need a single
+        call. The size of the next pages is then adapted from the duration of the
+        previous full pages: doubled if they were received in less than half of
+        `target_duration` and halved if they took longer than `target_duration`.
+
+        Args:
+            page_size: number of entities of the first page
+            max_workers: maximum number of pages downloaded at the same time. The
+                actual number is adapted by `self.limiter`. Default to
+                `self.limiter.max_limit`
+            target_duration: target duration of each request, in seconds
+            min_page_size: minimum number of entities per page
+            max_page_size: maximum number of entities per page
+
+        Returns:
+            a list of dictionary with one element per valid flexilimns entry.
+        """
+        if max_workers is None:
+            max_workers = self.limiter.max_limit
+        if project_id is None:
+            project_id = self.project_id
+        params = _get_params(
+            datatype=datatype,
+            project_id=project_id,
+            query_key=query_key,
+            query_value=query_value,
+            created_by=created_by,
+            id=id,
+            name=name,
+            origin_id=origin_id,
+            date_created=date_created,
+            date_created_operator=date_created_operator,
+            cross_project_entity=cross_project_entity,
         )
 
+        def get_page(offset, limit):
+            page_params = dict(params, offset=offset, limit=limit)
+            start = time.monotonic()
+            page = self.safe_execute(
+                "json", self.session.get, self.base_url + "get", params=page_params
+            )
+            return page, time.monotonic() - start
+
+        pages = {}
+        received = set()
+        paging_ignored = False
+        next_offset = 0
+        last_page_found = False
+        in_flight_limit = 1
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {}
+            while pending or not last_page_found:
+                while not last_page_found and len(pending) < in_flight_limit:
+                    future = executor.submit(get_page, next_offset, page_size)
+                    pending[future] = (next_offset, page_size)
+                    next_offset += page_size
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    offset, limit = pending.pop(future)
+                    page, duration = future.result()
+                    ids = set(entity["id"] for entity in page)
+                    if len(page) > limit or (ids and ids <= received):
+                        # each page is the whole reply: stop paging
+                        paging_ignored = last_page_found = True
+                        for other in pending:
+                            other.cancel()
+                        pending.clear()
+                        break
+                    received |= ids
+                    pages[offset] = page
+                    if len(page) < limit:
+                        last_page_found = True
+                        continue
+                    # do not queue more pages than the limiter lets through, the
+                    # waiting time would count in their duration. Pages are sent one
+                    # by one until the second shows that the server pages the reply
+                    if len(pages) > 1:
+                        in_flight_limit = max(
+                            1, min(max_workers, int(self.limiter.limit))
+                        )
+                    if duration < target_duration / 2:
+                        page_size = min(page_size * 2, max_page_size)
+                    elif duration > target_duration:
+                        page_size = max(page_size // 2, min_page_size)
+
+        if paging_ignored:
+            self._log("offset and limit ignored by the server, get_parallel not used")
+            return self.safe_execute(
+                "json", self.session.get, self.base_url + "get", params=params
+            )
+        entities = {}
+        for offset in sorted(pages):
+            for entity in pages[offset]:
+                entities.setdefault(entity["id"], entity)
+        return list(entities.values())
+
+    def iter_get(
+        self,
+        datatype=None,
+        project_id=None,
+        query_key=None,
+        query_value=None,
+        created_by=None,
+        id=None,
+        name=None,
+        origin_id=None,
+        date_created=None,
+        date_created_operator=None,
+        cross_project_entity=False,
+        chunk_size=65536,
+    ):
+        """Iterate on the entries of a `get` request as they are downloaded
+
+        The reply is streamed and parsed incrementally, so that only one entity is
+        kept in memory at a time. The cache is not used. See `get` for a description
+        of the filtering arguments.
+
+        Args:
+            chunk_size: number of bytes read from the connection at a time
+
+        Yields:
+            dict: one flexilims entry at a time
+        """
+        if project_id is None:
+            project_id = self.project_id
+        params = _get_params(
+            datatype=datatype,
+            project_id=project_id,
+            query_key=query_key,
+            query_value=query_value,
+            created_by=created_by,
+            id=id,
+            name=name,
+            origin_id=origin_id,
+            date_created=date_created,
+            date_created_operator=date_created_operator,
+            cross_project_entity=cross_project_entity,
+        )
+        rep = self.safe_execute(
+            "response",
+            self.session.get,
+            self.base_url + "get",
+            params=params,
+            stream=True,
+        )
+        with rep:
+            yield from iter_json_array(rep.iter_content(chunk_size=chunk_size))
+
     def get_children(self, id):
         """Get the children of one entry based on its hexadecimal id
 
         Args:
             id: hexadecimal id of the parent object
         """
-        return self.safe_execute(
-            "json", self.session.get, self.base_url + "get-children", params=dict(id=id)
+        return self._cached_read(
+            "get-children", params=dict(id=id), tags=[("parent", id)]
         )
 
+    def get_tree(self, root_id, max_depth=None, types=None, max_workers=None):
+        """Get an entity and all its descendants
+
+        The hierarchy is fetched level by level, with parallel `get_children`
+        requests for all the entities of a level.
+
+        Args:
+            root_id: hexadecimal id of the root entity
+            max_depth: (optional) number of levels to fetch below the root. Fetch
+                the whole hierarchy if None (default)
+            types: (optional) entity type or list of types to include. Entities of
+                other types are ignored, as well as their descendants. Include all
+                types if None (default)
+            max_workers: maximum number of requests in flight at the same time. The
+                actual number is adapted by `self.limiter`. Default to
+                `self.limiter.max_limit`
+
+        Returns:
+            dict: nested dictionary with the same layout as
+                `flexilims.offline.download_database`, i.e. {root_name: root} where
+                each entity with children has a `children` field containing
+                {child_name: child}
+        """
+        if max_workers is None:
+            max_workers = self.limiter.max_limit
+        if isinstance(types, str):
+            types = [types]
+        root = self.get(id=root_id)
+        if not root:
+            raise FlexilimsError("Cannot find entity with id %s" % root_id)
+        root = root[0]
+
+        level = [root]
+        depth = 0
+        while level and (max_depth is None or depth < max_depth):
+            children = _run_concurrently(
+                self.get_children,
+                [entity["id"] for entity in level],
+                max_workers=max_workers,
+                stop_on_error=True,
+            )
+            next_level = []
+            for parent, parent_children in zip(level, children):
+                if types is not None:
+                    parent_children = [c for c in parent_children if c["type"] in types]
+                if parent_children:
+                    parent["children"] = {c["name"]: c for c in parent_children}
+                next_level.extend(parent_children)
+            level = next_level
+            depth += 1
+        return {root["name"]: root}
+
     def get_project_info(self):
         """Get the list of existing project and their properties
 
         Returns:
             proj_list (list of dict): a list with one dictionary per project
         """
-        return self.safe_execute("json", self.session.get, self.base_url + "projects")
+        return self._cached_read("projects", entities=False)
 
     def update_one(
         self,
@@ -191,28 +642,27 @@ class Flexilims(object):
         if project_id is None:
             project_id = self.project_id
 
-        params = dict(type=datatype, id=id)
-        json_data = {}
-        for field in ("name", "origin_id", "attributes"):
-            value = locals()[field]
-            if value is not None:
-                json_data[field] = value
-
-        check_flexilims_validity(json_data)
-
-        address = "update-one"
-        # add flags
-        if strict_validation:
-            params["strict_validation"] = "true"
-        if allow_nulls:
-            params["allow_nulls"] = "true"
-        return self.safe_execute(
-            "json",
-            self.session.put,
-            self.base_url + address,
-            params=params,
-            json=json_data,
+        params, json_data = _update_one_request(
+            id=id,
+            datatype=datatype,
+            origin_id=origin_id,
+            name=name,
+            attributes=attributes,
+            strict_validation=strict_validation,
+            allow_nulls=allow_nulls,
         )
+        try:
+            return self.safe_execute(
+                "json",
+                self.session.put,
+                self.base_url + "update-one",
+                params=params,
+                **self._json_body(json_data),
+            )
+        finally:
+            self._invalidate_cache(
+                ("id", id), ("type", datatype), ("type", None), ("parent", origin_id)
+            )
 
     def update_many(
         self,
@@ -241,29 +691,21 @@ class Flexilims(object):
 
         if project_id is None:
             project_id = self.project_id
-        for n, w in zip(["update_key", "query_key"], [update_key, query_key]):
-            if (w is not None) and (w.lower() != w):
-                warnings.warn("`%s` should probably be lower case. Trying anyways" % n)
-        params = dict(
-            type=datatype,
-            project_id=project_id,
+        address, params = _update_many_request(
+            datatype=datatype,
             update_key=update_key,
             update_value=update_value,
+            query_key=query_key,
+            query_value=query_value,
+            project_id=project_id,
+            strict_validation=strict_validation,
         )
-        if query_key is not None:
-            params["query_key"] = query_key
-        if query_value is not None:
-            params["query_value"] = query_value
-
-        check_flexilims_validity(params)
-
-        address = "update-many"
-        if strict_validation:
-            address += "?strict_validation=true"
-
-        return self.safe_execute(
-            "content", self.session.put, self.base_url + address, params=params
-        )
+        try:
+            return self.safe_execute(
+                "content", self.session.put, self.base_url + address, params=params
+            )
+        finally:
+            self._invalidate_cache(("type", datatype), ("type", None))
 
     def post(
         self,
@@ -294,34 +736,159 @@ class Flexilims(object):
 
         if project_id is None:
             project_id = self.project_id
-        assert isinstance(project_id, str)
-        assert isinstance(attributes, dict)
+        address, json_data = _post_request(
+            datatype=datatype,
+            name=name,
+            attributes=attributes,
+            project_id=project_id,
+            origin_id=origin_id,
+            other_relations=other_relations,
+            strict_validation=strict_validation,
+        )
+        try:
+            return self.safe_execute(
+                "json",
+                self.session.post,
+                self.base_url + address,
+                **self._json_body(json_data),
+            )
+        finally:
+            self._invalidate_cache(
+                ("type", datatype), ("type", None), ("parent", origin_id)
+            )
 
-        # Flexilims cannot handle None value for now
-        # requests refuses invalid json, so no NaNs either
-        check_flexilims_validity(attributes)
+    def post_many(self, entities, max_workers=None, stop_on_error=False):
+        """Create many new entries concurrently
 
-        json_data = dict(
-            type=datatype, name=name, project_id=project_id, attributes=attributes
-        )
-        if origin_id is not None:
-            json_data["origin_id"] = origin_id
-        if other_relations is not None:
-            json_data["other_relations"] = other_relations
+        All entities are validated before sending any request. Requests are then
+        sent in parallel from a pool of threads sharing the same session.
 
-        address = "save"
-        if strict_validation:
-            address += "?strict_validation=true"
+        Args:
+            entities: iterable of dictionaries with the keyword arguments of `post`
+                for each entity (`datatype`, `name`, `attributes` and optionally
+                `project_id`, `origin_id`, `other_relations`, `strict_validation`)
+            max_workers: maximum number of requests in flight at the same time. The
+                actual number is adapted by `self.limiter`. Default to
+                `self.limiter.max_limit`
+            stop_on_error: if True, raise the first error encountered and cancel the
+                requests not yet sent. Otherwise the error is returned in place of
+                the reply for the failed entity. Default to False.
 
-        return self.safe_execute(
-            "json", self.session.post, self.base_url + address, json=json_data
+        Returns:
+            list: one element per entity, in the same order, with the reply from
+                flexilims for successful posts and the exception raised for failures
+        """
+        if max_workers is None:
+            max_workers = self.limiter.max_limit
+        requests_to_send = []
+        for entity in entities:
+            entity = dict(entity)
+            if entity.get("project_id") is None:
+                entity["project_id"] = self.project_id
+            try:
+                requests_to_send.append(_post_request(**entity))
+            except Exception as err:
+                if stop_on_error:
+                    raise
+                requests_to_send.append(err)
+
+        def send(request):
+            if isinstance(request, Exception):
+                raise request
+            address, json_data = request
+            try:
+                return self.safe_execute(
+                    "json",
+                    self.session.post,
+                    self.base_url + address,
+                    **self._json_body(json_data),
+                )
+            finally:
+                self._invalidate_cache(
+                    ("type", json_data["type"]),
+                    ("type", None),
+                    ("parent", json_data.get("origin_id")),
+                )
+
+        return _run_concurrently(
+            send, requests_to_send, max_workers=max_workers, stop_on_error=stop_on_error
         )
 
+    def delete_tree(self, root_id, include_root=False, max_workers=None):
+        """Delete an entity and all its descendants
+
+        The tree is first discovered level by level with parallel `get-children`
+        requests, which do not use `self.cache` so that no recent child is missed.
+        Entities are then deleted leaves first, one level at a time, with all the
+        deletions of a level sent in parallel. An entity is not deleted if one of
+        its descendants could not be deleted.
+
+        Args:
+            root_id: hexadecimal id of the root of the tree
+            include_root: if True, delete the root entity too. Default to False
+            max_workers: maximum number of requests in flight at the same time. The
+                actual number is adapted by `self.limiter`. Default to
+                `self.limiter.max_limit`
+
+        Returns:
+            dict: reply from flexilims for each deleted entity id (e.g.
+                "deleted successfully [1, 0]") or the exception raised if the
+                entity could not be deleted
+        """
+        if max_workers is None:
+            max_workers = self.limiter.max_limit
+
+        def get_children(parent_id):
+            return self.safe_execute(
+                "json",
+                self.session.get,
+                self.base_url + "get-children",
+                params=dict(id=parent_id),
+            )
+
+        parents = {}
+        levels = [[root_id]]
+        while levels[-1]:
+            children = _run_concurrently(
+                get_children,
+                levels[-1],
+                max_workers=max_workers,
+                stop_on_error=True,
+            )
+            next_level = []
+            for parent_id, parent_children in zip(levels[-1], children):
+                for child in parent_children:
+                    parents[child["id"]] = parent_id
+                    next_level.append(child["id"])
+            levels.append(next_level)
+        if not include_root:
+            levels = levels[1:]
+
+        outcome = {}
+        failed = set()
+        for level in reversed(levels):
+            to_delete = []
+            for entity_id in level:
+                if entity_id in failed:
+                    outcome[entity_id] = FlexilimsError(
+                        "Not deleted. Some children could not be deleted"
+                    )
+                else:
+                    to_delete.append(entity_id)
+            replies = _run_concurrently(self.delete, to_delete, max_workers=max_workers)
+            for entity_id, reply in zip(to_delete, replies):
+                outcome[entity_id] = reply
+            for entity_id in level:
+                if isinstance(outcome[entity_id], Exception) and entity_id in parents:
+                    failed.add(parents[entity_id])
+        return outcome
+
     def safe_execute(self, mode, function, *args, **kwargs):
         """Execute a function and update the token if needed
 
         Args:
-            mode: 'json' or 'content' to return the json or the content of the response
+            mode: 'json' or 'content' to return the json or the content of the response,
+                'response' to return the response object itself
             function: function to execute
             *args: arguments to pass to the function
             **kwargs: keyword arguments to pass to the function
@@ -329,20 +896,141 @@ class Flexilims(object):
         Returns:
             json or content of the response
         """
+        token = self._check_token()
+        endpoint = _endpoint_name(args[0] if args else kwargs.get("url", ""))
+        start = time.monotonic()
+        deadline = None if self.deadline is None else start + self.deadline
+        retries = 0
+        refreshed = False
         try:
-            rep = function(*args, **kwargs)
-            self.handle_error(rep)
-        except AuthenticationError:
-            # try to update the token and retry
-            self.update_token()
-            rep = function(*args, **kwargs)
-            self.handle_error(rep)
+            while True:
+                try:
+                    rep = self._attempt(endpoint, deadline, function, *args, **kwargs)
+                    self.handle_error(rep)
+                    break
+                except AuthenticationError:
+                    if refreshed:
+                        raise
+                    # try to update the token and retry
+                    refreshed = True
+                    self._refresh_token(token)
+                except (
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    ServerError,
+                ) as err:
+                    n_errors = retries - refreshed
+                    if n_errors >= self.max_retries or not _can_retry(function, err):
+                        raise
+                    delay = random.uniform(
+                        0, min(self.max_backoff, self.backoff * 2**n_errors)
+                    )
+                    if deadline is not None and time.monotonic() + delay >= deadline:
+                        raise
+                    time.sleep(delay)
+                retries += 1
+        except Exception as err:
+            self.request_stats.record(
+                endpoint, time.monotonic() - start, retries=retries, error=err
+            )
+            raise
+        if mode == "response":
+            # the body of a streamed response has not been read yet
+            n_bytes = int(rep.headers.get("Content-Length", 0))
+        else:
+            n_bytes = len(rep.content)
+        self.request_stats.record(
+            endpoint, time.monotonic() - start, n_bytes=n_bytes, retries=retries
+        )
         if mode == "json":
-            return rep.json()
+            return self.json_backend.loads(rep.content)
         elif mode == "content":
             return rep.content.decode("utf8")
+        elif mode == "response":
+            return rep
         else:
-            raise ValueError("mode must be 'json' or 'content'")
+            raise ValueError("mode must be 'json', 'content' or 'response'")
+
+    def _attempt(self, endpoint, deadline, function, *args, **kwargs):
+        """Send one request with the timeout, deadline and hedging settings"""
+        timeout = kwargs.pop("timeout", self.timeout)
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(
+                    "Deadline of %s seconds exceeded for %s" % (self.deadline, endpoint)
+                )
+            timeout = _cap_timeout(timeout, remaining)
+        kwargs["timeout"] = timeout
+        if (
+            self.hedge_quantile is not None
+            and function.__name__ == "get"
+            and not kwargs.get("stream", False)
+            and self.request_stats.count(endpoint) >= self.hedge_min_samples
+        ):
+            delay = self.request_stats.quantile(endpoint, self.hedge_quantile)
+            return self._send_hedged(delay, function, *args, **kwargs)
+        return self._send(function, *args, **kwargs)
+
+    def _send_hedged(self, delay, function, *args, **kwargs):
+        """Send a request, and a copy if it takes longer than `delay` seconds
+
+        Returns:
+            the first reply without a server error, or the last reply
+        """
+        with self._hedge_lock:
+            if self._hedge_executor is None:
+                # the limiter lets `max_limit` requests run, each with a hedged copy
+                self._hedge_executor = ThreadPoolExecutor(
+                    max_workers=2 * self.limiter.max_limit,
+                    thread_name_prefix="flexilims-hedge",
+                )
+        executor = self._hedge_executor
+        first = executor.submit(self._send, function, *args, **kwargs)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        self.request_stats.record_hedged()
+        pending = [first, executor.submit(self._send, function, *args, **kwargs)]
+        while True:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                try:
+                    rep = future.result()
+                except Exception:
+                    if not pending:
+                        raise
+                    continue
+                if rep.status_code < 500 or not pending:
+                    return rep
+
+    def _send(self, function, *args, **kwargs):
+        """Send one request within the limits of `self.limiter`"""
+        started = self.limiter.acquire()
+        try:
+            rep = function(*args, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self.limiter.release(started, overloaded=True)
+            raise
+        except BaseException:
+            self.limiter.release(started)
+            raise
+        overloaded = rep.status_code >= 500 or rep.status_code == 429
+        self.limiter.release(started, overloaded=overloaded)
+        return rep
+
+    def stats(self):
+        """Statistics of the requests sent by this object
+
+        Returns:
+            dict: see `flexilims.stats.RequestStats.summary`, with the state of the
+                concurrency limiter in `limiter` (see
+                `flexilims.limiter.AdaptiveLimiter.stats`)
+        """
+        stats = self.request_stats.summary()
+        stats["limiter"] = self.limiter.stats()
+        return stats
 
     def delete(self, id):
         """Delete an entity
@@ -350,33 +1038,114 @@ class Flexilims(object):
         Args:
             id: hexadecimal id of the entity to delete
         """
-        return self.safe_execute(
-            "content", self.session.delete, self.base_url + "delete", params=dict(id=id)
+        try:
+            return self.safe_execute(
+                "content",
+                self.session.delete,
+                self.base_url + "delete",
+                params=dict(id=id),
+            )
+        finally:
+            self._invalidate_cache(("id", id), ("parent", id))
+
+    def _cached_read(self, endpoint, params=None, tags=(), entities=True):
+        """Send a GET request, sharing it with identical requests in flight
+
+        See `_read_through_cache` for arguments.
+        """
+        if not self.coalesce_reads:
+            return self._read_through_cache(endpoint, params, tags, entities)
+        key = (request_key(self.base_url + endpoint, params), self._write_generation)
+        reply, shared = self._single_flight.do(
+            key, self._read_through_cache, endpoint, params, tags, entities
         )
+        if shared:
+            self.request_stats.record_coalesced()
+        return reply
 
-    def handle_error(self, rep):
-        """handles responses that have a status code != 200"""
-        if rep.status_code == 200:
-            return
-        # error handling:
-        if rep.ok:
-            warnings.warn(
-                "Warning. Seems ok but I had an unknown status code %s"
-                % rep.status_code
+    def _read_through_cache(self, endpoint, params=None, tags=(), entities=True):
+        """Send a GET request, using `self.cache` if defined
+
+        Args:
+            endpoint: address of the request, relative to `self.base_url`
+            params: (optional) query parameters
+            tags: tags of the request used to invalidate the cache entry
+            entities: if True, the reply is a list of entities and their ids and
+                types are added to the tags
+
+        Returns:
+            json reply
+        """
+        if self.cache is None:
+            return self.safe_execute(
+                "json", self.session.get, self.base_url + endpoint, params=params
             )
-            warnings.warn("Will return the response object without interpreting it.")
-            warnings.warn("see response.json() to (hopefully) get the data.")
-            return rep
-        if rep.status_code == 400:
-            error_dict = parse_error(rep.content)
-            raise IOError("Error %d: %s" % (rep.status_code, error_dict["message"]))
-        if rep.status_code == 404:
-            raise IOError(
-                "Page not found is the base url: %s?" % (self.base_url + "get")
+        key = request_key(self.base_url + endpoint, params)
+        found, reply = self.cache.lookup(key)
+        if found:
+            return reply
+        generation = self.cache.generation
+        if (
+            endpoint == "get"
+            and "date_created" not in params
+            and isinstance(self.cache, SQLiteCache)
+        ):
+            found, reply = self.cache.lookup_stale(key)
+        if found and reply:
+            reply = self._fetch_created_since(params, reply)
+        else:
+            reply = self.safe_execute(
+                "json", self.session.get, self.base_url + endpoint, params=params
             )
-        if rep.status_code == 403:
-            raise AuthenticationError("Forbidden. Are you logged in?")
-        raise IOError("Unknown error with status code %d" % rep.status_code)
+        tags = set(tags)
+        if entities:
+            tags |= reply_tags(reply)
+        self.cache.store(key, reply, tags=tags, generation=generation)
+        return reply
+
+    def _fetch_created_since(self, params, reply):
+        """Update an outdated `get` reply with the entities created since
+
+        Args:
+            params: query parameters of the `get` request
+            reply: outdated reply
+
+        Returns:
+            list: `reply` with the entities created after its most recent entity
+        """
+        params = dict(params)
+        params["date_created"] = max(e["dateCreated"] for e in reply)
+        params["date_created_operator"] = "gt"
+        new_entities = self.safe_execute(
+            "json", self.session.get, self.base_url + "get", params=params
+        )
+        # the date_created filter includes exact matches
+        known = set(e["id"] for e in reply)
+        return reply + [e for e in new_entities if e["id"] not in known]
+
+    def _invalidate_cache(self, *tags):
+        """Remove cache entries affected by a write request"""
+        self._write_generation += 1
+        if self.cache is not None:
+            self.cache.invalidate(tags)
+
+    def handle_error(self, rep):
+        """handles responses that have a status code != 200"""
+        return check_status(rep.status_code, rep.content, self.base_url, rep=rep)
+
+    def _json_body(self, json_data):
+        """Keyword arguments to send `json_data` as the body of a request"""
+        return dict(
+            data=self.json_backend.dumps(json_data),
+            headers={"Content-Type": "application/json"},
+        )
+
+    @property
+    def json_backend(self):
+        """`flexilims.json_backend.JSONBackend` used by this session"""
+        if self._json_backend is None:
+            return get_json_backend()
+        return self._json_backend
 
     @property
     def project_id(self):
@@ -399,6 +1168,263 @@ class Flexilims(object):
         self._project_id = value
 
 
+def _run_concurrently(function, arguments, max_workers=10, stop_on_error=False):
+    """Call `function` on each element of `arguments` using a pool of threads
+
+    Args:
+        function: function called with one element of `arguments`
+        arguments: list of arguments, one per call
+        max_workers: maximum number of calls running at the same time
+        stop_on_error: if True, cancel pending calls and raise the first error.
+            Otherwise, errors are returned in place of the results
+
+    Returns:
+        list: results (or exceptions) in the same order as `arguments`
+    """
+    results = [None] * len(arguments)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(function, argument): index
+            for index, argument in enumerate(arguments)
+        }
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as err:
+                if stop_on_error:
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+                results[futures[future]] = err
+    return results
+
+
+class _SingleFlight(object):
+    """Share the result of a function between concurrent calls with the same key
+
+    The result is kept private: when a call is shared, each caller, the one that
+    called the function included, receives its own deep copy.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key: [future, number of callers waiting for it]
+        self._in_flight = {}
+
+    def do(self, key, function, *args):
+        """Call `function(*args)`, or wait for the result of a call in flight
+
+        Args:
+            key: hashable key identifying identical calls
+            function: function to call
+            *args: arguments of the function
+
+        Returns:
+            (object, bool): output of the function and whether this caller waited for
+                the call of another caller
+        """
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = [Future(), 0]
+                self._in_flight[key] = call
+            else:
+                call[1] += 1
+        future = call[0]
+        if not leader:
+            return deepcopy(future.result()), True
+        try:
+            result = function(*args)
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        # no caller can join once the call is removed from `_in_flight`
+        if call[1]:
+            result = deepcopy(result)
+        return result, False
+
+
+def check_status(status_code, content, base_url, rep=None):
+    """Raise the relevant error for a reply with a status code != 200
+
+    Shared by the synchronous and asynchronous clients.
+
+    Args:
+        status_code: HTTP status code of the reply
+        content: body of the reply, used to parse 400 errors
+        base_url: base url of the flexilims server, used in 404 error message
+        rep: (optional) the response object, returned if the status is unknown but ok
+
+    Returns:
+        None if status code is 200, `rep` for other 2xx status codes
+    """
+    if status_code == 200:
+        return
+    # error handling:
+    if status_code < 400:
+        warnings.warn(
+            "Warning. Seems ok but I had an unknown status code %s" % status_code
+        )
+        warnings.warn("Will return the response object without interpreting it.")
+        warnings.warn("see response.json() to (hopefully) get the data.")
+        return rep
+    if status_code == 400:
+        error_dict = parse_error(content)
+        raise IOError("Error %d: %s" % (status_code, error_dict["message"]))
+    if status_code == 404:
+        raise IOError("Page not found is the base url: %s?" % (base_url + "get"))
+    if status_code == 403:
+        raise AuthenticationError("Forbidden. Are you logged in?")
+    if status_code >= 500:
+        raise ServerError("Server error with status code %d" % status_code)
+    raise IOError("Unknown error with status code %d" % status_code)
+
+
+def _get_params(
+    datatype=None,
+    project_id=None,
+    query_key=None,
+    query_value=None,
+    created_by=None,
+    id=None,
+    name=None,
+    origin_id=None,
+    date_created=None,
+    date_created_operator=None,
+    cross_project_entity=False,
+):
+    """Format the parameters of a `get` request. See `Flexilims.get`"""
+    params = dict(type=datatype, project_id=project_id)
+    if date_created_operator is not None:
+        assert date_created_operator in ("gt", "lt")
+    elif date_created is not None:
+        date_created_operator = "gt"
+    if cross_project_entity:
+        params["cross_project_entity"] = "yes"
+    else:
+        params["cross_project_entity"] = "no"
+    # add all non-None arguments in the list
+    args = (
+        "query_key",
+        "query_value",
+        "id",
+        "name",
+        "origin_id",
+        "date_created",
+        "date_created_operator",
+        "created_by",
+    )
+    for arg_name in args:
+        if locals()[arg_name] is not None:
+            params[arg_name] = locals()[arg_name]
+    return params
+
+
+def _update_one_request(
+    id,
+    datatype,
+    origin_id=None,
+    name=None,
+    attributes=None,
+    strict_validation=True,
+    allow_nulls=True,
+):
+    """Format params and json body of an `update-one` request
+
+    See `Flexilims.update_one`
+    """
+    params = dict(type=datatype, id=id)
+    json_data = {}
+    for field in ("name", "origin_id", "attributes"):
+        value = locals()[field]
+        if value is not None:
+            json_data[field] = value
+
+    check_flexilims_validity(json_data)
+
+    # add flags
+    if strict_validation:
+        params["strict_validation"] = "true"
+    if allow_nulls:
+        params["allow_nulls"] = "true"
+    return params, json_data
+
+
+def _update_many_request(
+    datatype,
+    update_key,
+    update_value,
+    query_key=None,
+    query_value=None,
+    project_id=None,
+    strict_validation=False,
+):
+    """Format address and params of an `update-many` request
+
+    See `Flexilims.update_many`
+    """
+    for n, w in zip(["update_key", "query_key"], [update_key, query_key]):
+        if (w is not None) and (w.lower() != w):
+            warnings.warn("`%s` should probably be lower case. Trying anyways" % n)
+    params = dict(
+        type=datatype,
+        project_id=project_id,
+        update_key=update_key,
+        update_value=update_value,
+    )
+    if query_key is not None:
+        params["query_key"] = query_key
+    if query_value is not None:
+        params["query_value"] = query_value
+
+    check_flexilims_validity(params)
+
+    address = "update-many"
+    if strict_validation:
+        address += "?strict_validation=true"
+    return address, params
+
+
+def _post_request(
+    datatype,
+    name,
+    attributes,
+    project_id,
+    origin_id=None,
+    other_relations=None,
+    strict_validation=True,
+):
+    """Format address and json body of a `save` request
+
+    See `Flexilims.post`
+    """
+    assert isinstance(project_id, str)
+    assert isinstance(attributes, dict)
+
+    # Flexilims cannot handle None value for now
+    # requests refuses invalid json, so no NaNs either
+    check_flexilims_validity(attributes)
+
+    json_data = dict(
+        type=datatype, name=name, project_id=project_id, attributes=attributes
+    )
+    if origin_id is not None:
+        json_data["origin_id"] = origin_id
+    if other_relations is not None:
+        json_data["other_relations"] = other_relations
+
+    address = "save"
+    if strict_validation:
+        address += "?strict_validation=true"
+    return address, json_data
+
+
 def parse_error(error_message):
     """Parse the error message from flexilims bad request
 
@@ -413,11 +1439,81 @@ def parse_error(error_message):
     return {name: v for name, v in zip(("type", "message", "description"), m.groups())}
 
 
-def get_token(username, password, base_url=BASE_URL):
-    """Login to the database and create headers with the proper token"""
+def _can_retry(function, error):
+    """Whether a failed request can be sent again
+
+    GET and PUT requests are idempotent and can always be retried. Other requests
+    are only retried if they did not reach the server.
+    """
+    if function.__name__ in ("get", "put"):
+        return True
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        reason = getattr(error.args[0], "reason", None)
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+    return False
+
+
+def _cap_timeout(timeout, remaining):
+    """Shorten a requests timeout to end within `remaining` seconds"""
+    if timeout is None:
+        return remaining
+    if isinstance(timeout, tuple):
+        return tuple(remaining if t is None else min(t, remaining) for t in timeout)
+    return min(timeout, remaining)
+
+
+def _endpoint_name(url):
+    """Name of the endpoint of a request, e.g. "get" for ".../api/get?id=..."
+
+    Args:
+        url: url of the request
+
+    Returns:
+        str: last element of the path of the url
+    """
+    return url.split("?", 1)[0].rstrip("/").rsplit("/", 1)[-1]
+
+
+def _token_expiry(authorization):
+    """Read the expiry date of a JWT bearer token
+
+    Args:
+        authorization: value of the Authorization header, "Bearer <token>"
+
+    Returns:
+        float: expiry date in seconds since epoch or None if the token is not a JWT
+            with an `exp` claim
+    """
+    try:
+        payload = authorization.split(" ")[-1].split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def get_token(username, password, base_url=BASE_URL, timeout=None, session=None):
+    """Login to the database and create headers with the proper token
+
+    Args:
+        username: flexilims username
+        password: flexilims password
+        base_url: base url of the flexilims server
+        timeout: (optional) timeout of the request in seconds
+        session: (optional) `requests.Session` used to send the request, to reuse its
+            connections. A new connection is opened if None (default)
+
+    Returns:
+        dict: headers with the token
+    """
+    post = requests.post if session is None else session.post
     try:
-        rep = requests.post(
-            base_url + "authenticate", auth=HTTPBasicAuth(username, password)
+        rep = post(
+            base_url + "authenticate",
+            auth=HTTPBasicAuth(username, password),
+            timeout=timeout,
         )
     except requests.exceptions.ConnectionError:
         raise requests.exceptions.ConnectionError(
@@ -6,17 +6,27 @@ This will use a JSON file as a database instead of the online MongoDB.
 Functions to generate the JSON are also included.
 """
 
-import json
+import bisect
+import itertools
+import math
+from collections import Counter
 from copy import deepcopy
 from warnings import warn
 
-import pandas as pd
-
+from flexilims.json_backend import get_json_backend
 from flexilims.utils import FlexilimsError, check_flexilims_validity, format_results
 
+_MISSING = object()
+# fields of the entities with an index from value to ids
+INDEXED_FIELDS = ("name", "type", "origin_id")
+# fields of the entities in the columnar snapshot
+COLUMN_FIELDS = ("type", "name", "origin_id", "createdBy", "dateCreated")
+# minimum number of candidate entities to filter them with the columnar snapshot
+COLUMNS_MIN_ROWS = 1000
+
 
 class OfflineFlexilims(object):
-    def __init__(self, json_file, project_id=None, edit_file=False):
+    def __init__(self, json_file, project_id=None, edit_file=False, json_backend=None):
         """Create offline Flexilims session.
 
         Args:
@@ -25,6 +35,9 @@ class OfflineFlexilims(object):
                 mode, provided for compatibility with the online version.
             edit_file (optional): if True, the file will be editable. Otherwise, only
                 the loaded data will be affected. Default to False.
+            json_backend (optional): library used to read and write the json file:
+                "json", "orjson", "ujson" or "fastest". If None (default), use the
+                global default, see `flexilims.json_backend.set_json_backend`.
 
         Returns:
             OfflineFlexilims object
@@ -33,13 +46,24 @@ class OfflineFlexilims(object):
         self.base_url = "Offline"
         self._json_file = None
         self._json_data = None
+        # indexes of the entities are created by `_build_index` when loading the file
         self._editable = edit_file
+        self._json_backend = (
+            None if json_backend is None else get_json_backend(json_backend)
+        )
 
         self.session = DummySession()
         self.project_id = project_id
         self.log = []
         self.json_file = json_file
 
+    @property
+    def json_backend(self):
+        """`flexilims.json_backend.JSONBackend` used to read and write the file."""
+        if self._json_backend is None:
+            return get_json_backend()
+        return self._json_backend
+
     @property
     def json_file(self):
         """Path to JSON file."""
@@ -48,13 +72,179 @@ class OfflineFlexilims(object):
     @json_file.setter
     def json_file(self, value):
         self._json_file = value
-        with open(self._json_file) as f:
-            self._json_data = json.load(f)
+        with open(self._json_file, "rb") as f:
+            self._json_data = self.json_backend.load(f)
+        self._build_index()
         self.log.append(f"Loaded data from {self._json_file}")
 
+    def _build_index(self):
+        """Index the entities by id, parent and the values of `INDEXED_FIELDS`."""
+        self._entities = {}
+        self._parents = {}
+        # order in which entities were loaded or created, to sort replies
+        self._positions = {}
+        self._next_position = itertools.count()
+        self._index = {field: {} for field in INDEXED_FIELDS}
+        self._key_counts = Counter()
+        self._columns = None
+        self._attribute_index = {}
+        # sorted indexes of dateCreated and of numeric attributes, built on first use
+        self._date_index = None
+        self._attribute_range_index = {}
+        self._add_to_index(self._json_data, None)
+        # ids of created entities are allocated in sequence from this number, above
+        # the loaded ids of the same format so that deleted ids are not reused
+        self._next_id = max(
+            (n + 1 for n in map(_hex2int, self._entities) if n is not None), default=0
+        )
+
+    def _add_to_index(self, container, parent):
+        """Index the entities of a `children` dictionary and their descendants."""
+        # depth first, so that entities are in the same order as in the file
+        stack = [(iter(container.values()), parent)]
+        while stack:
+            entities, parent = stack[-1]
+            entity = next(entities, None)
+            if entity is None:
+                stack.pop()
+                continue
+            self._entities[entity["id"]] = entity
+            self._parents[entity["id"]] = parent
+            self._positions[entity["id"]] = next(self._next_position)
+            self._index_fields(entity)
+            if entity.get("children"):
+                stack.append((iter(entity["children"].values()), entity))
+
+    def _remove_from_index(self, entity):
+        """Remove an entity and its descendants from the indexes."""
+        stack = [entity]
+        while stack:
+            entity = stack.pop()
+            self._entities.pop(entity["id"], None)
+            self._parents.pop(entity["id"], None)
+            self._positions.pop(entity["id"], None)
+            self._unindex_fields(entity)
+            if self._columns is not None:
+                self._columns.remove(entity["id"])
+            stack.extend(entity.get("children", {}).values())
+        if self._columns is not None and self._columns.n_removed > len(self._entities):
+            # rebuild the snapshot without the removed rows when it is next used
+            self._columns = None
+
+    def _index_fields(self, entity):
+        for field in INDEXED_FIELDS:
+            value = entity.get(field)
+            # skip missing values, None and NaN
+            if value is not None and value == value:
+                self._index[field].setdefault(value, {})[entity["id"]] = None
+        self._key_counts.update(k for k in entity if k != "children")
+        if self._columns is not None:
+            self._columns.set(entity)
+        attributes = entity.get("attributes") or {}
+        for key, index in self._attribute_index.items():
+            value = attributes.get(key, _MISSING)
+            if _indexable(value):
+                index.setdefault(value, {})[entity["id"]] = None
+        if self._date_index is not None:
+            self._date_index.add(entity.get("dateCreated"), entity["id"])
+        for key, index in self._attribute_range_index.items():
+            index.add(attributes.get(key), entity["id"])
+
+    def _unindex_fields(self, entity):
+        for field in INDEXED_FIELDS:
+            value = entity.get(field)
+            ids = self._index[field].get(value) if value is not None else None
+            if ids is not None:
+                ids.pop(entity["id"], None)
+                if not ids:
+                    del self._index[field][value]
+        attributes = entity.get("attributes") or {}
+        for key, index in self._attribute_index.items():
+            value = attributes.get(key, _MISSING)
+            if _indexable(value) and value in index:
+                index[value].pop(entity["id"], None)
+                if not index[value]:
+                    del index[value]
+        if self._date_index is not None:
+            self._date_index.remove(entity.get("dateCreated"), entity["id"])
+        for key, index in self._attribute_range_index.items():
+            index.remove(attributes.get(key), entity["id"])
+        self._key_counts.subtract(k for k in entity if k != "children")
+        for key in [k for k, n in self._key_counts.items() if n <= 0]:
+            del self._key_counts[key]
+
+    def _update_fields(self, entity, **fields):
+        """Change top level fields of an entity, keeping the indexes up to date."""
+        self._unindex_fields(entity)
+        entity.update(fields)
+        self._index_fields(entity)
+
+    def _new_id(self):
+        """Allocate a hexadecimal id for a new entity.
+
+        Ids are numbered in sequence, after the largest loaded id of the same format,
+        and are not reused after a deletion.
+
+        Returns:
+            str: id not used by any entity
+        """
+        new_id = _int2hex(self._next_id)
+        self._next_id += 1
+        return new_id
+
+    def _get_attribute_index(self, key):
+        """Inverted index of one attribute, built on first use.
+
+        Args:
+            key: name of the attribute
+
+        Returns:
+            dict: {value: {id: None}} for the hashable values of the attribute
+        """
+        index = self._attribute_index.get(key)
+        if index is None:
+            index = {}
+            for entity in self._entities.values():
+                value = (entity.get("attributes") or {}).get(key, _MISSING)
+                if _indexable(value):
+                    index.setdefault(value, {})[entity["id"]] = None
+            self._attribute_index[key] = index
+        return index
+
+    def _get_date_index(self):
+        """Sorted index of `dateCreated`, built on first use."""
+        if self._date_index is None:
+            self._date_index = _RangeIndex(
+                (e.get("dateCreated"), i) for i, e in self._entities.items()
+            )
+        return self._date_index
+
+    def _get_attribute_range_index(self, key):
+        """Sorted index of the numeric values of one attribute, built on first use."""
+        index = self._attribute_range_index.get(key)
+        if index is None:
+            index = _RangeIndex(
+                ((e.get("attributes") or {}).get(key), i)
+                for i, e in self._entities.items()
+            )
+            self._attribute_range_index[key] = index
+        return index
+
+    def _get_columns(self):
+        """Columnar snapshot of the entities, built on first use.
+
+        Returns:
+            _ColumnSnapshot: the snapshot, or None if numpy is not installed
+        """
+        if self._columns is None:
+            np = _import_numpy()
+            if np is None:
+                return None
+            self._columns = _ColumnSnapshot(np, self._entities.values())
+        return self._columns
+
     def _format_dataframe(self):
-        entities = self._flat_dataframe()
-        return pd.DataFrame(format_results(entities))
+        return format_results(self._flat_data())
 
     def _flat_data(self, keep_children=False):
         """Flatten the json data to a list of dict."""
@@ -86,21 +276,9 @@ class OfflineFlexilims(object):
             id: hexadecimal id of the entity
 
         Returns:
-            a reference to the entity in the database
+            a reference to the entity in the database, None if not found
         """
-
-        def recur_find(data, id):
-            for properties in data.values():
-                if properties["id"] == id:
-                    return properties
-                children = properties.get("children", {})
-                if children:
-                    found = recur_find(children, id)
-                    if found:
-                        return found
-            return None
-
-        return recur_find(self._json_data, id)
+        return self._entities.get(id)
 
     def get(
         self,
@@ -114,6 +292,8 @@ class OfflineFlexilims(object):
         origin_id=None,
         date_created=None,
         date_created_operator=None,
+        query=None,
+        query_range=None,
     ):
         """Get all the entries of type datatype in the current project
 
@@ -130,40 +310,103 @@ class OfflineFlexilims(object):
             created_by: name of the user who created the object
             date_created: cutoff date. Only elements with date creation greater
                 (default) or lower than this date will be return (see
-                date_created_operator), in unix time since epoch.
+                date_created_operator), in unix time since epoch. A (start, end)
+                tuple selects the elements created between the two dates (offline
+                only)
             date_created_operator: 'gt' or 'lt' for greater or lower than (default to
-                'gt') both include exact match
+                'gt') both include exact match. 'between' if `date_created` is a
+                tuple
+            query: (optional) dictionary of {attribute: value} filters, all of which
+                must match, in addition to `query_key`. Offline only, the online API
+                can only filter on one attribute
+            query_range: (optional) dictionary of {attribute: (min, max)} filters on
+                numeric attributes, bounds included. A bound can be None. Offline
+                only
 
         Returns:
-            a list of dictionary with one element per valid flexilimns entry.
+            a list of dictionary with one element per valid flexilimns entry, in the
+            order in which they were loaded or created.
         """
 
-        data = pd.DataFrame(self._flat_data())
         filters = dict(
             type=datatype, createdBy=created_by, id=id, name=name, origin_id=origin_id
         )
-        for key, value in filters.items():
-            if value is not None:
-                data = data[data[key] == value]
-        if date_created is not None:
-            if date_created_operator is None:
-                date_created_operator = "gt"
-
-            if date_created_operator == "gt":
-                data = data[data["dateCreated"] > date_created]
-            elif date_created_operator == "lt":
-                data = data[data["dateCreated"] < date_created]
-            else:
-                raise FlexilimsError("date_created_operator should be 'gt' or 'lt'")
+        filters = [(k, v) for k, v in filters.items() if v is not None]
+        attribute_filters = dict(query or {})
         if query_key is not None:
-            valid = []
-            for _, el in data.iterrows():
-                if query_key in el["attributes"]:
-                    if el["attributes"][query_key] == query_value:
-                        valid.append(el)
-            return valid
-        # get returns a list of dict
-        return data.to_dict(orient="records")
+            attribute_filters[query_key] = query_value
+        query_range = query_range or {}
+        date_range = _date_range(date_created, date_created_operator)
+
+        # only look at the entities with the least common indexed value. Entities
+        # matching all the filters are in the intersection of the indexed sets
+        hits = []
+        if id is not None:
+            hits.append({id: None} if id in self._entities else {})
+        for field, value in (
+            ("type", datatype),
+            ("name", name),
+            ("origin_id", origin_id),
+        ):
+            if value is not None:
+                hits.append(self._index[field].get(value, {}))
+        for key, value in attribute_filters.items():
+            # do not build a new index if there are already few candidates
+            few = hits and len(min(hits, key=len)) <= COLUMNS_MIN_ROWS
+            if _indexable(value) and (key in self._attribute_index or not few):
+                hits.append(self._get_attribute_index(key).get(value, {}))
+        if date_range is not None:
+            hits.append(self._get_date_index().select(*date_range, strict=True))
+        for key, (low, high) in query_range.items():
+            index = self._get_attribute_range_index(key)
+            hits.append(index.select(low, high, strict=False))
+        candidates = min(hits, key=len) if hits else self._entities
+        # filter many candidates on other fields with vectorized masks
+        n_filters = len(filters)
+        n_all_filters = (
+            n_filters + len(attribute_filters) + len(query_range) + bool(date_range)
+        )
+        if (
+            len(candidates) > COLUMNS_MIN_ROWS
+            and n_filters
+            and n_all_filters > (1 if hits else 0)
+        ):
+            columns = self._get_columns()
+            if columns is not None:
+                selected = columns.select(filters, date_range)
+                if len(selected) < len(candidates):
+                    candidates = selected
+
+        valid = []
+        for entity in (self._entities[i] for i in candidates):
+            if any(entity.get(k, _MISSING) != v for k, v in filters):
+                continue
+            if date_range is not None and not _in_range(
+                entity.get("dateCreated"), *date_range, strict=True
+            ):
+                continue
+            attributes = entity.get("attributes") or {}
+            if any(
+                attributes.get(k, _MISSING) != v for k, v in attribute_filters.items()
+            ):
+                continue
+            if any(
+                not _in_range(attributes.get(k), low, high, strict=False)
+                for k, (low, high) in query_range.items()
+            ):
+                continue
+            valid.append(entity)
+        if candidates is not self._entities:
+            # indexes are not in load order once entities have been updated
+            valid.sort(key=lambda entity: self._positions[entity["id"]])
+        # the output has the same keys for all entities, like the online reply
+        records = _pad_records(valid, self._key_counts)
+        # only nested values, such as `attributes`, can be modified by the caller
+        for record in records:
+            for key, value in record.items():
+                if isinstance(value, (dict, list)):
+                    record[key] = deepcopy(value)
+        return records
 
     def get_children(self, id):
         """Get the children of one entry based on its hexadecimal id
@@ -174,10 +417,8 @@ class OfflineFlexilims(object):
         Returns:
             a list of dictionary with one element per valid flexilimns entry.
         """
-        flat_with_children = self._flat_data(keep_children=True)
-        parent = [data for data in flat_with_children if data["id"] == id]
-        assert len(parent) == 1, "Parent not found"
-        parent = parent[0]
+        parent = self._entities.get(id)
+        assert parent is not None, "Parent not found"
         if "children" not in parent:
             return []
         # remove children below
@@ -237,23 +478,27 @@ class OfflineFlexilims(object):
         if datatype is not None:
             assert entity_to_update["type"] == datatype, "Datatype mismatch"
 
-        if origin_id is not None:
-            entity_to_update["origin_id"] = origin_id
-            warn("Updating origin_id will break children/parent hierarchy")
-        if name is not None:
-            entity_to_update["name"] = name
-
         attr2change = {}
         if attributes is not None:
             self._recur_clean(
                 json_data["attributes"], attr2change, allow_nulls=allow_nulls
             )
+        if origin_id is not None:
+            warn("Updating origin_id will break children/parent hierarchy")
+
+        self._unindex_fields(entity_to_update)
+        if origin_id is not None:
+            entity_to_update["origin_id"] = origin_id
+        if name is not None:
+            entity_to_update["name"] = name
+        if attributes is not None:
             entity_to_update["attributes"].update(attr2change)
+        self._index_fields(entity_to_update)
 
         if self._editable:
             print(f"Updating entity {entity_to_update['name']} in {self._json_file}")
-            with open(self._json_file, "w") as f:
-                json.dump(self._json_data, f)
+            with open(self._json_file, "wb") as f:
+                self.json_backend.dump(self._json_data, f, allow_nan=True)
         return entity_to_update
 
     def _recur_clean(self, attr, output, allow_nulls=True, allow_strings=False):
@@ -278,6 +523,31 @@ class OfflineFlexilims(object):
     def update_many(self, entities):
         raise NotImplementedError("update_many is not implemented in offline mode")
 
+    def delete(self, id):
+        """Delete an entity and its children from the database.
+
+        Args:
+            id: hexadecimal id of the entity to delete
+
+        Returns:
+            the deleted entity
+        """
+
+        deleted = self._entities.get(id)
+        if deleted is None:
+            raise FlexilimsError(f"Entity {id} not found")
+        parent = self._parents[id]
+        container = self._json_data if parent is None else parent["children"]
+        # the key can differ from the name if the entity was renamed
+        key = next(k for k, v in container.items() if v is deleted)
+        container.pop(key)
+        self._remove_from_index(deleted)
+        if self._editable:
+            print(f"Deleting entity {deleted['name']} from {self._json_file}")
+            with open(self._json_file, "wb") as f:
+                self.json_backend.dump(self._json_data, f, allow_nan=True)
+        return deleted
+
     def post(
         self,
         datatype,
@@ -312,19 +582,7 @@ class OfflineFlexilims(object):
 
         json_data = dict(type=datatype, name=name, attributes=attr2change)
 
-        # create a random hexadecimal id
-        existing = [el["id"] for el in self._flat_data()]
-        n = 0
-
-        def int2hex(n):
-            hex_id = hex(n)
-            if len(hex_id) < 24:
-                hex_id = "0x" + "0" * (24 - len(hex_id)) + hex_id[2:]
-            return hex_id
-
-        while int2hex(n) in existing:
-            n += 1
-        json_data["id"] = int2hex(n)
+        json_data["id"] = self._new_id()
 
         if origin_id is not None:
             json_data["origin_id"] = origin_id
@@ -335,24 +593,270 @@ class OfflineFlexilims(object):
             parent = self._find_entity(origin_id)
             if "children" not in parent:
                 parent["children"] = {}
-            parent["children"][name] = json_data
+            container = parent["children"]
         else:
-            self._json_data[name] = json_data
+            parent = None
+            container = self._json_data
+        if name in container:
+            # the entity with the same name is replaced
+            self._remove_from_index(container[name])
+        container[name] = json_data
+        self._add_to_index({name: json_data}, parent)
         if self._editable:
             print(f"Adding entity {name} to {self._json_file}")
-            with open(self._json_file, "w") as f:
-                json.dump(self._json_data, f)
+            with open(self._json_file, "wb") as f:
+                self.json_backend.dump(self._json_data, f, allow_nan=True)
         return json_data
 
 
-def download_database(flexilims_session, types, verbose=True):
+def _int2hex(n):
+    """Format a number as an id of 24 characters."""
+    hex_id = hex(n)
+    if len(hex_id) < 24:
+        hex_id = "0x" + "0" * (24 - len(hex_id)) + hex_id[2:]
+    return hex_id
+
+
+def _hex2int(hex_id):
+    """Number of an id created by `_int2hex`, None for other ids."""
+    if not (len(hex_id) == 24 and hex_id.startswith("0x")):
+        return None
+    try:
+        return int(hex_id, 16)
+    except ValueError:
+        return None
+
+
+class _ColumnSnapshot(object):
+    """Main fields of the entities as numpy arrays, to filter them with masks.
+
+    Rows are in the order of `OfflineFlexilims._entities`. New entities are appended,
+    the arrays growing by doubling, updated entities are changed in place and removed
+    entities are masked out.
+
+    Args:
+        np: the numpy module
+        entities: iterable of entities
+    """
+
+    def __init__(self, np, entities):
+        self.np = np
+        entities = list(entities)
+        capacity = max(16, len(entities))
+        self.ids = np.empty(capacity, dtype=object)
+        self.columns = {
+            field: np.empty(capacity, dtype=object) for field in COLUMN_FIELDS
+        }
+        self.columns["dateCreated"] = np.full(capacity, np.nan)
+        self.valid = np.zeros(capacity, dtype=bool)
+        self.rows = {}
+        self.size = 0
+        self.n_removed = 0
+        for entity in entities:
+            self.set(entity)
+
+    def set(self, entity):
+        """Add an entity, or update its row if it is already present."""
+        row = self.rows.get(entity["id"])
+        if row is None:
+            if self.size == len(self.valid):
+                self._grow()
+            row = self.size
+            self.size += 1
+            self.rows[entity["id"]] = row
+            self.ids[row] = entity["id"]
+            self.valid[row] = True
+        for field in COLUMN_FIELDS:
+            value = entity.get(field)
+            if field == "dateCreated":
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    value = math.nan
+            self.columns[field][row] = value
+
+    def remove(self, id):
+        """Mask out the row of an entity."""
+        row = self.rows.pop(id, None)
+        if row is not None:
+            self.valid[row] = False
+            self.n_removed += 1
+
+    def select(self, filters, date_range=None):
+        """Ids of the entities matching the filters.
+
+        Args:
+            filters: list of (field, value) pairs. Fields that are not in
+                `COLUMN_FIELDS` are ignored
+            date_range: (optional) (start, end) of the creation date, bounds
+                excluded. Either can be None
+
+        Returns:
+            numpy.ndarray: ids, in row order
+        """
+        mask = self.valid[: self.size].copy()
+        for field, value in filters:
+            if field in self.columns:
+                mask &= self.columns[field][: self.size] == value
+        if date_range is not None:
+            dates = self.columns["dateCreated"][: self.size]
+            start, end = date_range
+            if start is not None:
+                mask &= dates > start
+            if end is not None:
+                mask &= dates < end
+        return self.ids[: self.size][mask]
+
+    def _grow(self):
+        np = self.np
+        capacity = 2 * len(self.valid)
+
+        def grown(array, fill):
+            new = np.full(capacity, fill, dtype=array.dtype)
+            new[: len(array)] = array
+            return new
+
+        self.ids = grown(self.ids, None)
+        self.valid = grown(self.valid, False)
+        for field, array in self.columns.items():
+            self.columns[field] = grown(
+                array, math.nan if array.dtype.kind == "f" else None
+            )
+
+
+class _RangeIndex(object):
+    """Sorted numeric values of a field, to find the entities in a range.
+
+    Values that are not numbers are not indexed. Entities are sorted by value, then by
+    id. Adding or removing an entity costs O(log n) comparisons and a list insertion,
+    selecting a range O(log n + k).
+
+    Args:
+        items: iterable of (value, id)
+    """
+
+    def __init__(self, items):
+        items = sorted((v, i) for v, i in items if _is_number(v))
+        self.values = [v for v, _ in items]
+        self.ids = [i for _, i in items]
+
+    def add(self, value, id):
+        if _is_number(value):
+            position = self._position(value, id)
+            self.values.insert(position, value)
+            self.ids.insert(position, id)
+
+    def remove(self, value, id):
+        if _is_number(value):
+            position = self._position(value, id)
+            if position < len(self.ids) and self.ids[position] == id:
+                del self.values[position]
+                del self.ids[position]
+
+    def _position(self, value, id):
+        # entities with the same value are sorted by id
+        start = bisect.bisect_left(self.values, value)
+        end = bisect.bisect_right(self.values, value, start)
+        return bisect.bisect_left(self.ids, id, start, end)
+
+    def select(self, low=None, high=None, strict=False):
+        """Ids of the entities with a value between `low` and `high`.
+
+        Args:
+            low: (optional) lower bound
+            high: (optional) upper bound
+            strict: if True, the bounds are excluded
+
+        Returns:
+            list: ids, sorted by value
+        """
+        start, end = 0, len(self.values)
+        if low is not None:
+            bisect_low = bisect.bisect_right if strict else bisect.bisect_left
+            start = bisect_low(self.values, low)
+        if high is not None:
+            bisect_high = bisect.bisect_left if strict else bisect.bisect_right
+            end = bisect_high(self.values, high)
+        return self.ids[start:end]
+
+
+def _date_range(date_created, date_created_operator):
+    """Convert the date arguments of `get` to (start, end), bounds excluded.
+
+    Returns:
+        tuple: (start, end), either can be None. None if there is no date filter
+    """
+    if date_created is None:
+        return None
+    if isinstance(date_created, (tuple, list)):
+        if date_created_operator not in (None, "between"):
+            raise FlexilimsError("A date_created range requires operator 'between'")
+        start, end = date_created
+        return start, end
+    if date_created_operator is None:
+        date_created_operator = "gt"
+    if date_created_operator == "gt":
+        return date_created, None
+    if date_created_operator == "lt":
+        return None, date_created
+    raise FlexilimsError("date_created_operator should be 'gt' or 'lt'")
+
+
+def _is_number(value):
+    """Whether a value is an int or a float, other than a boolean or NaN."""
+    return (
+        isinstance(value, (int, float))
+        and not isinstance(value, bool)
+        and value == value
+    )
+
+
+def _in_range(value, low, high, strict=False):
+    """Whether a value is a number between `low` and `high`, which can be None."""
+    if not _is_number(value):
+        return False
+    if strict:
+        return (low is None or value > low) and (high is None or value < high)
+    return (low is None or value >= low) and (high is None or value <= high)
+
+
+def _indexable(value):
+    """Whether an attribute value can be found with the inverted index."""
+    if value is _MISSING or value is None or value != value:
+        return False
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def _import_numpy():
+    """Import numpy on first use, None if it is not installed."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def download_database(
+    flexilims_session, types, verbose=True, snapshot=None, reconcile=False
+):
     """Download a FlexiLIMS database as JSON.
 
+    If a previous `snapshot` is provided, only the entities created after the most
+    recent `dateCreated` of the snapshot are downloaded and added to it.
+
     Args:
         flexilims_session (flexilims.Flexilims): Flexilims session, must have project_id
             set.
         types (str or list of str): Entity types to download.
         verbose (bool, optional): Print progress info. Defaults to True.
+        snapshot (dict, optional): JSON data from a previous download. It is updated
+            in place. Defaults to None.
+        reconcile (bool, optional): Only used with `snapshot`. If True, download all
+            entities of `types` and update the entities of the snapshot that have
+            been modified (`dateUpdated` changed), moved, renamed or deleted since.
+            Defaults to False.
 
     Returns:
         dict: JSON data
@@ -361,6 +865,11 @@ def download_database(flexilims_session, types, verbose=True):
     if isinstance(types, str):
         types = [types]
 
+    if snapshot is not None:
+        return _update_snapshot(
+            flexilims_session, types, snapshot, reconcile=reconcile, verbose=verbose
+        )
+
     all_data = []
     for datatype in types:
         if verbose:
@@ -372,38 +881,253 @@ def download_database(flexilims_session, types, verbose=True):
 
     if verbose:
         print("Create JSON data")
-    # make a dataframe to simplify queries
-    df = pd.DataFrame(all_data)
-    root_entities = df[df["origin_id"].isna()]
+    # NaN is not valid JSON, missing values are written as null
+    all_data = _pad_records([_without_nan(e) for e in all_data], missing=None)
+    children = {}
+    for entity in all_data:
+        if not _is_root(entity):
+            children.setdefault(entity["origin_id"], []).append(entity)
     json_data = {}
-    for _, root in root_entities.iterrows():
-        json_data[root["name"]] = root.to_dict()
-        _add_recursively(json_data[root["name"]], root, df)
+    for root in all_data:
+        if _is_root(root):
+            json_data[root["name"]] = root
+            _add_recursively(json_data[root["name"]], children)
     return json_data
 
 
-def _add_recursively(target, entity, df):
+def _update_snapshot(flexilims_session, types, snapshot, reconcile=False, verbose=True):
+    """Add new entities to a snapshot and optionally reconcile existing ones
+
+    See `download_database` for arguments.
+
+    Returns:
+        dict: the updated snapshot
+    """
+    index = _index_tree(snapshot)
+    watermark = max(
+        (entity["dateCreated"] for entity, _ in index.values()), default=None
+    )
+    all_data = []
+    for datatype in types:
+        if verbose:
+            print(f"Downloading {datatype}")
+        if reconcile or watermark is None:
+            data = flexilims_session.get(datatype=datatype)
+        else:
+            data = flexilims_session.get(
+                datatype=datatype, date_created=watermark, date_created_operator="gt"
+            )
+        if verbose:
+            print(f"    ... {len(data)} {datatype} entities")
+        all_data.extend(data)
+
+    all_data = [_without_nan(entity) for entity in all_data]
+    # the date_created filter includes exact matches
+    new_entities = [entity for entity in all_data if entity["id"] not in index]
+    if verbose:
+        print(f"Adding {len(new_entities)} new entities")
+    if reconcile:
+        moved = _reconcile(snapshot, index, types, all_data, verbose=verbose)
+        new_entities.extend(moved)
+        index = _index_tree(snapshot)
+
+    # parents are usually created before their children, but moved entities can
+    # have a more recent parent: `_insert_entities` retries them
+    new_entities.sort(key=lambda entity: entity["dateCreated"])
+    orphans = _insert_entities(snapshot, index, new_entities)
+    if reconcile:
+        moved_ids = set(entity["id"] for entity in moved)
+        lost = [entity["id"] for entity in orphans if entity["id"] in moved_ids]
+        if lost:
+            raise ValueError(
+                "Cannot find the new origin of moved entities: %s" % ", ".join(lost)
+            )
+    if orphans and verbose:
+        print(f"    ... {len(orphans)} entities without parent in the snapshot")
+    return snapshot
+
+
+def _index_tree(json_data):
+    """Map each entity id of a nested JSON database to the entity and its parent
+
+    Args:
+        json_data (dict): nested JSON data as created by `download_database`
+
+    Returns:
+        dict: {id: (entity, parent)} with parent None for root entities
+    """
+    index = {}
+
+    def recur_index(container, parent):
+        for entity in container.values():
+            index[entity["id"]] = (entity, parent)
+            if entity.get("children"):
+                recur_index(entity["children"], entity)
+
+    recur_index(json_data, None)
+    return index
+
+
+def _without_nan(entity):
+    """Copy of an entity with its NaN top level values, e.g. from padding, as None"""
+    return {
+        k: None if isinstance(v, float) and math.isnan(v) else v
+        for k, v in entity.items()
+    }
+
+
+def _is_root(entity):
+    """Whether an entity has no origin"""
+    origin_id = entity.get("origin_id")
+    return origin_id is None or (isinstance(origin_id, float) and math.isnan(origin_id))
+
+
+def _insert_entities(json_data, index, entities):
+    """Add entities to a nested JSON database below their parent
+
+    Args:
+        json_data (dict): nested JSON data, modified in place
+        index (dict): output of `_index_tree`, updated in place
+        entities (list): entities to add, preferably parents before children, as
+            entities whose origin is not added yet need another pass. They can
+            already have `children`
+
+    Returns:
+        list: entities that could not be added as their origin is not in the database
+    """
+    orphans = []
+    while entities:
+        for entity in entities:
+            if _is_root(entity):
+                parent = None
+                container = json_data
+            elif entity["origin_id"] in index:
+                parent = index[entity["origin_id"]][0]
+                container = parent.setdefault("children", {})
+            else:
+                orphans.append(entity)
+                continue
+            container[entity["name"]] = entity
+            index[entity["id"]] = (entity, parent)
+            descendants = _index_tree(entity.get("children", {}))
+            for child_id, (child, child_parent) in descendants.items():
+                index[child_id] = (
+                    child,
+                    entity if child_parent is None else child_parent,
+                )
+        if len(orphans) == len(entities):
+            # no progress: the origins are not in the database
+            break
+        entities, orphans = orphans, []
+    return orphans
+
+
+def _reconcile(json_data, index, types, entities, verbose=True):
+    """Update the entities of a snapshot to match the online version
+
+    Entities with a different `dateUpdated` are updated in place. Deleted entities
+    are removed with their children. Entities that have been renamed or have a new
+    origin are removed from the tree and returned, with their children, to be
+    inserted back.
+
+    Args:
+        json_data (dict): nested JSON data, modified in place
+        index (dict): output of `_index_tree` before any modification
+        types (list): entity types to reconcile
+        entities (list): all the entities of `types` in the online database
+        verbose (bool): print a summary of the changes
+
+    Returns:
+        list: entities that must be inserted back in the tree
+    """
+    online = {entity["id"]: entity for entity in entities}
+    moved = []
+    n_updated = n_deleted = 0
+    for entity_id, (entity, parent) in index.items():
+        if entity["type"] not in types:
+            continue
+        new_version = online.get(entity_id)
+        if new_version is not None and (
+            new_version.get("dateUpdated") == entity.get("dateUpdated")
+        ):
+            continue
+        is_moved = (
+            new_version is None
+            or new_version["name"] != entity["name"]
+            or (
+                new_version.get("origin_id") != entity.get("origin_id")
+                and not (_is_root(new_version) and _is_root(entity))
+            )
+        )
+        if is_moved:
+            container = json_data if parent is None else parent["children"]
+            container.pop(entity["name"])
+            if parent is not None and not parent["children"]:
+                parent.pop("children")
+        if new_version is None:
+            n_deleted += 1
+            continue
+        n_updated += 1
+        children = entity.get("children")
+        entity.clear()
+        entity.update(new_version)
+        if children:
+            entity["children"] = children
+        if is_moved:
+            moved.append(entity)
+    if verbose:
+        print(f"Reconciled: {n_updated} entities updated, {n_deleted} deleted")
+    return moved
+
+
+def _add_recursively(target, children):
     """Recursively add entities to a dictionary.
 
     Args:
         target (dict): Target dictionary
-        entity (pd.Series): FlexiLIMS entity
-        df (pd.DataFrame): DataFrame of entities
+        children (dict): Lists of entities, by `origin_id`
 
     Returns:
         dict: Entity with children added
     """
     assert "children" not in target, "Entity already has a `children` field"
-    children = df[df["origin_id"] == entity["id"]]
-    if children.empty:
+    if target["id"] not in children:
         return target
     target["children"] = {}
-    for _, child in children.iterrows():
-        target["children"][child["name"]] = child.to_dict()
-        _add_recursively(target["children"][child["name"]], child, df)
+    for child in children[target["id"]]:
+        target["children"][child["name"]] = child
+        _add_recursively(target["children"][child["name"]], children)
     return target
 
 
+def _pad_records(entities, columns=None, missing=math.nan):
+    """Give the same keys, in the same order, to all entities
+
+    Missing values are set to NaN by default, like in the records of a DataFrame.
+
+    Args:
+        entities (list): list of dict
+        columns (iterable, optional): keys to use, in order. Defaults to the keys of
+            all the entities, in order of appearance
+        missing (optional): value of the missing keys. Defaults to NaN
+
+    Returns:
+        list: new dictionaries, sharing their values with `entities`
+    """
+    if columns is None:
+        columns = {}
+        for entity in entities:
+            columns.update(dict.fromkeys(entity))
+    records = []
+    for entity in entities:
+        record = {k: entity.get(k, missing) for k in columns}
+        for key in entity:
+            if key not in record and key != "children":
+                record[key] = entity[key]
+        records.append(record)
+    return records
+
+
 def get_token(username, password=None, base_url="OFFLINE"):
     """Get a token from Flexilims API.
 
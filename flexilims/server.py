@@ -0,0 +1,441 @@
+"""Local stand-in for the flexilims server
+
+`FlexilimsServer` serves the flexilims API on top of an `OfflineFlexilims` JSON
+database, so that the online clients can be tested and benchmarked without sending
+requests to the real server. Latency, random server errors and token expiry can be
+simulated.
+
+The server can also be started from the command line:
+
+    python -m flexilims.server tests/test_data.json --port 8080 --latency 0.05
+"""
+
+import argparse
+import base64
+import json
+import math
+import random
+import secrets
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from flexilims.offline import OfflineFlexilims
+from flexilims.utils import FlexilimsError
+
+API_PATH = "/flexilims/api/"
+
+
+class FlexilimsServer(object):
+    """Local HTTP server imitating the flexilims API
+
+    The endpoints `authenticate`, `get`, `get-children`, `save`, `update-one`,
+    `update-many`, `delete` and `projects` are implemented. The server runs in a
+    background thread after `start` and can be used as a context manager:
+
+        with FlexilimsServer("data.json", latency=0.01) as server:
+            flm_sess = Flexilims("user", "password", project_id, base_url=server.url)
+
+    Args:
+        json_file: path to a JSON database, as created by
+            `flexilims.offline.download_database`
+        username: (optional) username accepted by `authenticate`. Any user is accepted
+            if None (default)
+        password: (optional) password accepted by `authenticate`. Any password is
+            accepted if None (default)
+        project_id: hexadecimal id of the project reported by `projects`
+        host: address to bind the server to
+        port: port to listen on. A free port is chosen if 0 (default)
+        latency: delay, in seconds, added to every request
+        latency_jitter: maximum random delay, in seconds, added to `latency`
+        error_rate: fraction of requests (other than `authenticate`) that fail with
+            a 500 error
+        token_lifetime: (optional) validity of tokens in seconds, after which
+            requests are rejected with a 403 error. The expiry date is included in
+            the token, like a JWT. Tokens never expire if None (default)
+        edit_file: if True, changes are saved to `json_file`. Default to False
+        seed: (optional) seed of the random number generator used for latency jitter
+            and errors
+    """
+
+    def __init__(
+        self,
+        json_file,
+        username=None,
+        password=None,
+        project_id=None,
+        host="127.0.0.1",
+        port=0,
+        latency=0,
+        latency_jitter=0,
+        error_rate=0,
+        token_lifetime=None,
+        edit_file=False,
+        seed=None,
+    ):
+        self.database = OfflineFlexilims(
+            json_file, project_id=project_id, edit_file=edit_file
+        )
+        self.username = username
+        self.password = password
+        self.project_id = project_id
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.token_lifetime = token_lifetime
+        self.request_counts = Counter()
+        self.connection_count = 0
+        self._tokens = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = None
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    @property
+    def url(self):
+        """Base url of the API, to use as `base_url` of the clients"""
+        return "http://%s:%d%s" % (self.host, self.port, API_PATH)
+
+    def start(self):
+        """Start serving requests in a background thread"""
+        if self._httpd is not None:
+            raise FlexilimsError("Server already started")
+        self._httpd = ThreadingHTTPServer((self.host, self.port), _RequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.flexilims_server = self
+        self.port = self._httpd.server_port
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the server"""
+        if self._httpd is None:
+            return
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+        self._httpd = None
+        self._thread = None
+
+    def expire_tokens(self):
+        """Revoke all tokens. The next requests of each client get a 403 error"""
+        with self._lock:
+            self._tokens.clear()
+
+    def handle(self, method, endpoint, params, body, headers):
+        """Process one request
+
+        Args:
+            method: HTTP method of the request
+            endpoint: name of the endpoint, e.g. "get"
+            params: dictionary of query parameters
+            body: decoded JSON body of the request, or None
+            headers: headers of the request
+
+        Returns:
+            (int, object): status code and reply. Strings are sent as they are, other
+                objects as JSON
+        """
+        with self._lock:
+            self.request_counts[endpoint] += 1
+        delay = self.latency
+        if self.latency_jitter:
+            delay += self._random.uniform(0, self.latency_jitter)
+        if delay:
+            time.sleep(delay)
+
+        if endpoint == "authenticate":
+            if method != "POST":
+                return 405, "Method not allowed"
+            return self._authenticate(headers.get("Authorization"))
+        if endpoint not in _ENDPOINTS:
+            return 404, "Not found"
+        if _ENDPOINTS[endpoint][0] != method:
+            return 405, "Method not allowed"
+        if not self._valid_token(headers.get("Authorization")):
+            return 403, "Forbidden"
+        if self.error_rate and self._random.random() < self.error_rate:
+            return 500, "Internal server error (simulated)"
+
+        function = getattr(self, _ENDPOINTS[endpoint][1])
+        try:
+            with self._lock:
+                return 200, function(params, body)
+        except (FlexilimsError, AssertionError, KeyError, ValueError) as err:
+            return 400, _error_page(err)
+        except Exception as err:
+            return 500, "Internal server error: %s" % err
+
+    def _authenticate(self, authorization):
+        """Check basic authentication and create a new token"""
+        try:
+            scheme, credentials = authorization.split(" ", 1)
+            assert scheme == "Basic"
+            username, password = (
+                base64.b64decode(credentials).decode("utf8").split(":", 1)
+            )
+        except Exception:
+            return 401, "Unauthorized"
+        if (self.username is not None and username != self.username) or (
+            self.password is not None and password != self.password
+        ):
+            return 401, "Unauthorized"
+        if self.token_lifetime is None:
+            expiry = None
+            token = secrets.token_hex(16)
+        else:
+            expiry = time.time() + self.token_lifetime
+            token = ".".join(
+                [
+                    _b64_json(dict(alg="none", typ="JWT")),
+                    _b64_json(dict(sub=username, exp=math.ceil(expiry))),
+                    secrets.token_hex(8),
+                ]
+            )
+        with self._lock:
+            self._tokens[token] = expiry
+        return 200, token
+
+    def _valid_token(self, authorization):
+        if not authorization or not authorization.startswith("Bearer "):
+            return False
+        token = authorization[len("Bearer ") :]
+        with self._lock:
+            if token not in self._tokens:
+                return False
+            expiry = self._tokens[token]
+            if expiry is not None and time.time() > expiry:
+                del self._tokens[token]
+                return False
+        return True
+
+    def _get(self, params, body):
+        if not self.database._json_data:
+            return []
+        date_created = params.get("date_created")
+        entities = self.database.get(
+            datatype=params.get("type"),
+            created_by=params.get("created_by"),
+            id=params.get("id"),
+            name=params.get("name"),
+            origin_id=params.get("origin_id"),
+            date_created=None if date_created is None else float(date_created),
+            date_created_operator=params.get("date_created_operator"),
+        )
+        entities = [_clean_entity(e) for e in entities]
+        if "query_key" in params:
+            entities = [
+                e
+                for e in entities
+                if params["query_key"] in e["attributes"]
+                and _matches(
+                    e["attributes"][params["query_key"]], params["query_value"]
+                )
+            ]
+        if "offset" in params or "limit" in params:
+            offset = int(params.get("offset", 0))
+            limit = params.get("limit")
+            end = None if limit is None else offset + int(limit)
+            entities = entities[offset:end]
+        return entities
+
+    def _get_children(self, params, body):
+        return [_clean_entity(e) for e in self.database.get_children(params["id"])]
+
+    def _get_project_info(self, params, body):
+        return [dict(uuid=self.project_id, name="offline")]
+
+    def _post(self, params, body):
+        if self.database.get(name=body["name"]):
+            raise FlexilimsError("An entity named %s already exists" % body["name"])
+        origin_id = body.get("origin_id")
+        if origin_id is not None and self.database._find_entity(origin_id) is None:
+            raise FlexilimsError("Origin %s not found" % origin_id)
+        entity = self.database.post(
+            datatype=body["type"],
+            name=body["name"],
+            attributes=body["attributes"],
+            origin_id=origin_id,
+            other_relations=body.get("other_relations"),
+        )
+        now = int(time.time() * 1000)
+        self.database._update_fields(
+            entity,
+            dateCreated=now,
+            dateUpdated=now,
+            createdBy=self.username or "Offline",
+            project=body.get("project_id", self.project_id),
+        )
+        return _clean_entity(entity)
+
+    def _update_one(self, params, body):
+        self._check_exists(params["id"])
+        entity = self.database.update_one(
+            id=params["id"],
+            datatype=params.get("type"),
+            origin_id=body.get("origin_id"),
+            name=body.get("name"),
+            attributes=body.get("attributes"),
+            allow_nulls=params.get("allow_nulls") == "true",
+        )
+        self.database._update_fields(entity, dateUpdated=int(time.time() * 1000))
+        return _clean_entity(entity)
+
+    def _update_many(self, params, body):
+        query = {
+            k: params[k] for k in ("type", "query_key", "query_value") if k in params
+        }
+        entities = self._get(query, body)
+        for entity in entities:
+            self.database.update_one(
+                id=entity["id"],
+                attributes={params["update_key"]: params["update_value"]},
+                allow_nulls=True,
+            )
+        return "updated successfully %d items of type %s with %s=%s" % (
+            len(entities),
+            params["type"],
+            params["update_key"],
+            params["update_value"],
+        )
+
+    def _delete(self, params, body):
+        self._check_exists(params["id"])
+        self.database.delete(params["id"])
+        return "deleted successfully null"
+
+    def _check_exists(self, id):
+        if self.database._find_entity(id) is None:
+            raise FlexilimsError("Entity %s not found" % id)
+
+
+# endpoint: (HTTP method, FlexilimsServer method)
+_ENDPOINTS = {
+    "get": ("GET", "_get"),
+    "get-children": ("GET", "_get_children"),
+    "projects": ("GET", "_get_project_info"),
+    "save": ("POST", "_post"),
+    "update-one": ("PUT", "_update_one"),
+    "update-many": ("PUT", "_update_many"),
+    "delete": ("DELETE", "_delete"),
+}
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """Translate HTTP requests into `FlexilimsServer.handle` calls"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        server = self.server.flexilims_server
+        with server._lock:
+            server.connection_count += 1
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else None
+        if not url.path.startswith(API_PATH):
+            status, reply = 404, "Not found"
+        else:
+            try:
+                body = json.loads(body) if body else None
+            except ValueError:
+                status, reply = 400, _error_page("Invalid JSON body")
+            else:
+                status, reply = self.server.flexilims_server.handle(
+                    self.command,
+                    url.path[len(API_PATH) :],
+                    dict(parse_qsl(url.query)),
+                    body,
+                    self.headers,
+                )
+        if isinstance(reply, str):
+            content = reply.encode("utf8")
+            content_type = "text/html; charset=utf-8"
+        else:
+            content = json.dumps(reply).encode("utf8")
+            content_type = "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+def _error_page(message):
+    """Format an error like the html pages of flexilims 400 errors"""
+    return (
+        "<html><body><h1>HTTP Status 400 - Bad Request</h1>"
+        "<p><b>Type</b> Status Report</p><p><b>Message</b> %s</p>"
+        "<p><b>Description</b> The server cannot or will not process the request due "
+        "to something that is perceived to be a client error.</p></body></html>"
+        % str(message).replace("\n", " ")
+    )
+
+
+def _b64_json(data):
+    """Encode a dictionary as a base64url JSON string without padding"""
+    encoded = base64.urlsafe_b64encode(json.dumps(data).encode("utf8"))
+    return encoded.decode("ascii").rstrip("=")
+
+
+def _clean_entity(entity):
+    """Copy of an entity without children and missing (NaN) fields"""
+    return {
+        k: v
+        for k, v in entity.items()
+        if k != "children" and not (isinstance(v, float) and math.isnan(v))
+    }
+
+
+def _matches(value, query_value):
+    """Compare an attribute to a query value, which is received as a string"""
+    return value == query_value or str(value) == query_value
+
+
+def main(argv=None):
+    """Run a server from the command line until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("json_file", help="JSON database to serve")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--username", default=None)
+    parser.add_argument("--password", default=None)
+    parser.add_argument("--project-id", default=None)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--latency-jitter", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--token-lifetime", type=float, default=None)
+    parser.add_argument("--edit-file", action="store_true")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+    server = FlexilimsServer(**vars(args)).start()
+    print("Serving %s on %s" % (args.json_file, server.url))
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
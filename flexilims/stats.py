@@ -0,0 +1,167 @@
+"""Statistics of the requests sent to flexilims."""
+
+import bisect
+import logging
+import math
+import threading
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the latency histogram bins, in seconds
+LATENCY_BINS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+
+class RequestStats(object):
+    """Thread-safe, bounded record of request counts, latencies and sizes
+
+    For each endpoint (`get`, `get-children`, `save`, ...), the number of requests,
+    errors and retries, the number of bytes received and a histogram of latencies
+    are kept. Memory usage does not grow with the number of requests.
+
+    Callbacks can be added to receive every request record, for instance to forward
+    them to a monitoring system.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self.token_refreshes = 0
+        self.coalesced = 0
+        self.hedged = 0
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        """Add a function called after each request
+
+        Args:
+            callback: function called with a dictionary containing `endpoint`,
+                `duration` (in seconds), `bytes`, `retries` and `error` (None or the
+                exception raised)
+        """
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        """Remove a callback added with `add_callback`"""
+        self.callbacks.remove(callback)
+
+    def record(self, endpoint, duration, n_bytes=0, retries=0, error=None):
+        """Record one request
+
+        Args:
+            endpoint: name of the endpoint, e.g. "get"
+            duration: duration of the request in seconds
+            n_bytes: size of the reply in bytes
+            retries: number of times the request was retried
+            error: (optional) exception raised by the request
+        """
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = dict(
+                    count=0,
+                    errors=0,
+                    retries=0,
+                    bytes=0,
+                    total_time=0.0,
+                    max_time=0.0,
+                    histogram=[0] * len(LATENCY_BINS),
+                )
+                self._endpoints[endpoint] = stats
+            stats["count"] += 1
+            stats["errors"] += error is not None
+            stats["retries"] += retries
+            stats["bytes"] += n_bytes
+            stats["total_time"] += duration
+            stats["max_time"] = max(stats["max_time"], duration)
+            stats["histogram"][bisect.bisect_left(LATENCY_BINS, duration)] += 1
+        if self.callbacks:
+            record = dict(
+                endpoint=endpoint,
+                duration=duration,
+                bytes=n_bytes,
+                retries=retries,
+                error=error,
+            )
+            for callback in list(self.callbacks):
+                # a failing callback must not fail the request it monitors
+                try:
+                    callback(record)
+                except Exception:
+                    logger.exception("Request stats callback %r failed", callback)
+
+    def record_token_refresh(self):
+        """Count one token refresh"""
+        with self._lock:
+            self.token_refreshes += 1
+
+    def record_coalesced(self):
+        """Count one request answered by an identical request already in flight"""
+        with self._lock:
+            self.coalesced += 1
+
+    def record_hedged(self):
+        """Count one request sent twice because the first was slow"""
+        with self._lock:
+            self.hedged += 1
+
+    def count(self, endpoint):
+        """Number of requests recorded for `endpoint`"""
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            return 0 if stats is None else stats["count"]
+
+    def quantile(self, endpoint, q):
+        """Estimate a latency quantile from the histogram
+
+        Args:
+            endpoint: name of the endpoint
+            q: quantile, between 0 and 1
+
+        Returns:
+            float: upper bound of the histogram bin containing the quantile, in
+                seconds, or None if no request was recorded
+        """
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None or not stats["count"]:
+                return None
+            target = q * stats["count"]
+            cumulative = 0
+            for upper_bound, n in zip(LATENCY_BINS, stats["histogram"]):
+                cumulative += n
+                if cumulative >= target:
+                    return min(upper_bound, stats["max_time"])
+            return stats["max_time"]
+
+    def summary(self):
+        """Summary of the recorded requests
+
+        Returns:
+            dict: with one entry per endpoint giving `count`, `errors`, `retries`,
+                `bytes`, `mean_time`, `max_time`, `p50`, `p95` and the `histogram`
+                as a {upper bound: count} dictionary, `token_refreshes`,
+                `coalesced` requests and `hedged` requests
+        """
+        output = dict(
+            token_refreshes=self.token_refreshes,
+            coalesced=self.coalesced,
+            hedged=self.hedged,
+            endpoints={},
+        )
+        for endpoint in list(self._endpoints):
+            with self._lock:
+                stats = dict(self._endpoints[endpoint])
+                stats["histogram"] = dict(zip(LATENCY_BINS, stats["histogram"]))
+            stats["mean_time"] = stats.pop("total_time") / stats["count"]
+            stats["p50"] = self.quantile(endpoint, 0.5)
+            stats["p95"] = self.quantile(endpoint, 0.95)
+            output["endpoints"][endpoint] = stats
+        return output
+
+    def reset(self):
+        """Forget all recorded requests"""
+        with self._lock:
+            self._endpoints = {}
+            self.token_refreshes = 0
+            self.coalesced = 0
+            self.hedged = 0
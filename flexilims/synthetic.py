@@ -0,0 +1,275 @@
+"""Synthetic flexilims databases for tests and benchmarks
+
+Databases have the nested format of `flexilims.offline.download_database`, with a
+mouse > session > recording > dataset hierarchy. They can be written to disk one
+entity at a time, so that databases of millions of entities can be created without
+holding them in memory:
+
+    python -m flexilims.synthetic database.json --n-entities 1000000
+"""
+
+import argparse
+import json
+import random
+
+HIERARCHY = ("mouse", "session", "recording", "dataset")
+PROJECT_ID = "606df1ac08df4d77c72c9aa4"
+START_DATE = 1600000000000  # in ms since epoch, like flexilims dates
+
+
+class SyntheticDatabase(object):
+    """Generator of a random hierarchical database
+
+    Args:
+        n_entities: total number of entities. If None, `n_roots` root entities with
+            all their descendants are created
+        n_roots: number of root entities (mice), used if `n_entities` is None
+        fan_out: number of children of each entity, for each level below the root.
+            Either an int or a (min, max) tuple to draw it at random. A single value
+            is used for all levels
+        n_attributes: number of random attributes of each entity, in addition to
+            `path`. Either an int or a (min, max) tuple
+        nested_fraction: fraction of random attributes that are dictionaries
+        string_fraction: fraction of random (non nested) attributes that are
+            strings. The others are numbers
+        cardinality: number of distinct values of string attributes
+        hierarchy: entity types, from root to leaves
+        project_id: hexadecimal id of the project of the entities
+        seed: seed of the random number generator
+    """
+
+    def __init__(
+        self,
+        n_entities=None,
+        n_roots=1,
+        fan_out=4,
+        n_attributes=5,
+        nested_fraction=0.1,
+        string_fraction=0.5,
+        cardinality=10,
+        hierarchy=HIERARCHY,
+        project_id=PROJECT_ID,
+        seed=0,
+    ):
+        if isinstance(fan_out, (int, tuple)):
+            fan_out = [fan_out] * (len(hierarchy) - 1)
+        if len(fan_out) != len(hierarchy) - 1:
+            raise ValueError("fan_out must have one element per non-root level")
+        self.n_entities = n_entities
+        self.n_roots = n_roots
+        self.fan_out = list(fan_out)
+        self.n_attributes = n_attributes
+        self.nested_fraction = nested_fraction
+        self.string_fraction = string_fraction
+        self.cardinality = cardinality
+        self.hierarchy = tuple(hierarchy)
+        self.project_id = project_id
+        self.seed = seed
+
+    def iter_tree(self):
+        """Iterate on the entities, depth first
+
+        Yields:
+            (int, dict): depth of the entity in the hierarchy and the entity, without
+                children
+        """
+        rng = random.Random(self.seed)
+        state = dict(n_created=0, date=START_DATE, counts=[0] * len(self.hierarchy))
+
+        def remaining():
+            return self.n_entities is None or state["n_created"] < self.n_entities
+
+        def descend(parent, depth):
+            if depth == len(self.hierarchy):
+                return
+            for _ in range(_draw(rng, self.fan_out[depth - 1])):
+                if not remaining():
+                    return
+                child = self._make_entity(rng, state, depth, parent)
+                yield depth, child
+                yield from descend(child, depth + 1)
+
+        n_roots = 0
+        while remaining() and (self.n_entities is not None or n_roots < self.n_roots):
+            root = self._make_entity(rng, state, 0, None)
+            n_roots += 1
+            yield 0, root
+            yield from descend(root, 1)
+
+    def iter_entities(self):
+        """Iterate on the entities, depth first, as flat dictionaries"""
+        for _, entity in self.iter_tree():
+            yield entity
+
+    def to_json_data(self):
+        """Create the whole database in memory
+
+        Returns:
+            dict: nested database, as returned by `download_database`
+        """
+        json_data = {}
+        stack = [json_data]
+        for depth, entity in self.iter_tree():
+            del stack[depth + 1 :]
+            stack[depth][entity["name"]] = entity
+            stack.append(entity.setdefault("children", {}))
+        _remove_empty_children(json_data)
+        return json_data
+
+    def write(self, path, indent=None):
+        """Write the database to a JSON file, one entity at a time
+
+        Args:
+            path: path of the output file
+            indent: (optional) indent the JSON file, for debugging
+
+        Returns:
+            int: number of entities written
+        """
+        n_entities = 0
+        with open(path, "w") as f:
+            f.write("{")
+            # entities written without their closing brace. For each, whether its
+            # "children" dictionary has been opened
+            open_entities = []
+            for depth, entity in self.iter_tree():
+                while len(open_entities) > depth:
+                    _close_entity(f, open_entities.pop())
+                if depth == 0:
+                    if n_entities:
+                        f.write(", ")
+                elif open_entities[-1]:
+                    f.write(", ")
+                else:
+                    f.write(', "children": {')
+                    open_entities[-1] = True
+                f.write(json.dumps(entity["name"]) + ": ")
+                f.write(json.dumps(entity, indent=indent)[:-1].rstrip())
+                open_entities.append(False)
+                n_entities += 1
+            while open_entities:
+                _close_entity(f, open_entities.pop())
+            f.write("}")
+        return n_entities
+
+    def _make_entity(self, rng, state, depth, parent):
+        """Create one entity with random attributes"""
+        datatype = self.hierarchy[depth]
+        state["counts"][depth] += 1
+        state["n_created"] += 1
+        state["date"] += rng.randint(1, 3600000)
+        count = state["counts"][depth]
+        if parent is None:
+            name = "%s_%06d" % (datatype, count)
+        else:
+            name = "%s_%s%06d" % (parent["name"], datatype[0].upper(), count)
+        attributes = dict(path="/".join(name.split("_")))
+        for i in range(_draw(rng, self.n_attributes)):
+            if rng.random() < self.nested_fraction:
+                value = {
+                    "field_%d" % j: self._random_value(rng)
+                    for j in range(rng.randint(1, 3))
+                }
+            else:
+                value = self._random_value(rng)
+            attributes["%s_attr_%d" % (datatype, i)] = value
+        entity = dict(
+            id="%024x" % state["n_created"],
+            type=datatype,
+            name=name,
+            incrementalId="%s%010d" % (datatype.upper(), count),
+            attributes=attributes,
+            createdBy="Synthetic User",
+            dateCreated=state["date"],
+            dateUpdated=state["date"] + rng.randint(0, 1000),
+            project=self.project_id,
+            # roots have a null origin, as in downloaded databases
+            origin_id=None if parent is None else parent["id"],
+        )
+        return entity
+
+    def _random_value(self, rng):
+        if rng.random() < self.string_fraction:
+            return "value_%d" % rng.randrange(self.cardinality)
+        if rng.random() < 0.5:
+            return rng.randrange(1000)
+        return round(rng.uniform(0, 1000), 3)
+
+
+def make_database(n_entities, seed=0, **kwargs):
+    """Create a synthetic database in memory
+
+    Args:
+        n_entities: number of entities
+        seed: seed of the random number generator
+        **kwargs: other arguments of `SyntheticDatabase`
+
+    Returns:
+        dict: nested database, as returned by `download_database`
+    """
+    return SyntheticDatabase(n_entities=n_entities, seed=seed, **kwargs).to_json_data()
+
+
+def write_database(path, n_entities, seed=0, **kwargs):
+    """Write a synthetic database to a JSON file without holding it in memory
+
+    Args:
+        path: path of the output file
+        n_entities: number of entities
+        seed: seed of the random number generator
+        **kwargs: other arguments of `SyntheticDatabase`
+
+    Returns:
+        int: number of entities written
+    """
+    return SyntheticDatabase(n_entities=n_entities, seed=seed, **kwargs).write(path)
+
+
+def _draw(rng, value):
+    """Return value, or a random integer between value[0] and value[1]"""
+    if isinstance(value, tuple):
+        return rng.randint(*value)
+    return value
+
+
+def _close_entity(f, children_opened):
+    """Write the end of an entity opened by `SyntheticDatabase.write`"""
+    f.write("}}" if children_opened else "}")
+
+
+def _remove_empty_children(data):
+    for entity in data.values():
+        if entity["children"]:
+            _remove_empty_children(entity["children"])
+        else:
+            del entity["children"]
+
+
+def main(argv=None):
+    """Write a synthetic database from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("path", help="output JSON file")
+    parser.add_argument("--n-entities", type=int, required=True)
+    parser.add_argument("--fan-out", type=int, nargs="+", default=[4])
+    parser.add_argument("--n-attributes", type=int, default=5)
+    parser.add_argument("--nested-fraction", type=float, default=0.1)
+    parser.add_argument("--string-fraction", type=float, default=0.5)
+    parser.add_argument("--cardinality", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    fan_out = args.fan_out[0] if len(args.fan_out) == 1 else args.fan_out
+    n_entities = write_database(
+        args.path,
+        args.n_entities,
+        seed=args.seed,
+        fan_out=fan_out,
+        n_attributes=args.n_attributes,
+        nested_fraction=args.nested_fraction,
+        string_fraction=args.string_fraction,
+        cardinality=args.cardinality,
+    )
+    print("Wrote %d entities to %s" % (n_entities, args.path))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,11 @@
 """Utility functions useful for both online and offline FlexiLIMS."""
 
+import codecs
+import json
 import math
 import re
 import warnings
 
-import pandas as pd
-
 SPECIAL_CHARACTERS = re.compile(r'[\',\.@"+=\-!#$%^&*<>?/\|}{~:]')
 
 
@@ -21,6 +21,12 @@ class AuthenticationError(Exception):
     pass
 
 
+class ServerError(IOError):
+    """Error 5xx, the server failed to process a valid request"""
+
+    pass
+
+
 def check_flexilims_validity(attributes, warn_case=False):
     """Check that the data can be uploaded to flexilims
 
@@ -117,8 +123,8 @@ def _cleanlist(list2clean):
     assert all([e is not None for e in list2clean])
 
 
-def format_results(results):
-    """Make request output a nice DataFrame
+def flatten_attributes(results):
+    """Move the attributes of entities to the top level of each entity
 
     This will crash if any attribute is also present in the flexilims reply,
     i.e. if an attribute is named:
@@ -126,10 +132,10 @@ def format_results(results):
     'origin_id', 'objects', 'customEntities', or 'project'
 
     Args:
-        results (:obj:`list` of :obj:`dict`): Flexilims reply
+        results (:obj:`list` of :obj:`dict`): Flexilims reply. Modified in place
 
     Returns:
-        :py:class:`pandas.DataFrame`: Reply formatted as a DataFrame
+        :obj:`list` of :obj:`dict`: the entities, without `attributes`
 
     """
     for result in results:
@@ -140,4 +146,109 @@ def format_results(results):
                 )
             result[attr_name] = attr_value
         result.pop("attributes")
-    return pd.DataFrame(results)
+    return results
+
+
+def format_results(results):
+    """Make request output a nice DataFrame
+
+    See `flatten_attributes` to get the same output as a list of dictionaries, without
+    pandas.
+
+    Args:
+        results (:obj:`list` of :obj:`dict`): Flexilims reply
+
+    Returns:
+        :py:class:`pandas.DataFrame`: Reply formatted as a DataFrame
+
+    """
+    pd = _import_pandas()
+    return pd.DataFrame(flatten_attributes(results))
+
+
+def _import_pandas():
+    """Import pandas on first use
+
+    pandas is optional and slow to import, so it is only loaded when a DataFrame is
+    created.
+
+    Returns:
+        module: pandas
+    """
+    try:
+        import pandas
+    except ImportError:
+        raise ImportError(
+            "Creating DataFrames requires pandas. Install it with "
+            "`pip install flexilims[pandas]`"
+        )
+    return pandas
+
+
+def iter_json_array(chunks):
+    """Parse a JSON array incrementally and yield its elements one by one
+
+    Only the current element and the unparsed part of the last chunk are kept in
+    memory.
+
+    Args:
+        chunks: iterable of `bytes` (utf-8 encoded) or `str` containing a JSON array,
+            for instance `requests.Response.iter_content()`
+
+    Yields:
+        elements of the array
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer = ""
+    position = 0
+    state = "start"
+
+    def read_chunk():
+        nonlocal buffer, position
+        for chunk in chunks:
+            if isinstance(chunk, bytes):
+                chunk = utf8.decode(chunk)
+            if chunk:
+                buffer = buffer[position:] + chunk
+                position = 0
+                return True
+        return False
+
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\n\r":
+            position += 1
+        if position == len(buffer):
+            if not read_chunk():
+                raise ValueError("Incomplete JSON array")
+            continue
+        char = buffer[position]
+        if state == "start":
+            if char != "[":
+                raise ValueError("Expected a JSON array, got %r" % char)
+            position += 1
+            state = "first"
+        elif state == "separator":
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError("Expected ',' or ']' in JSON array, got %r" % char)
+            position += 1
+            state = "element"
+        else:
+            if state == "first" and char == "]":
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the element might continue in the next chunk
+                if not read_chunk():
+                    raise
+                continue
+            if end == len(buffer) and read_chunk():
+                # a number could continue in the next chunk, parse it again
+                continue
+            yield element
+            position = end
+            state = "separator"
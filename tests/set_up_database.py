@@ -19,21 +19,11 @@ MOUSE_ID = "6094f7212597df357fa24a8c"
 flm_sess = flm.Flexilims(USERNAME, password)
 
 
-# Delete all entities below test mouse
-def delete_recursive(flm_sess, current_id):
-    children = flm_sess.get_children(current_id)
-    if not children:
-        return
-    print(f"Deleting {len(children)} children of {current_id}")
-    for c in children:
-        delete_recursive(flm_sess, c["id"])
-        rep = flm_sess.delete(c["id"])
-        if rep != "deleted successfully [1, 0]":
-            print(f"Error deleting {c['id']}: {rep}")
-
-
 print("Deleting all entities below test mouse")
-delete_recursive(flm_sess, MOUSE_ID)
+outcome = flm_sess.delete_tree(MOUSE_ID, include_root=False)
+for entity_id, rep in outcome.items():
+    if rep != "deleted successfully [1, 0]":
+        print(f"Error deleting {entity_id}: {rep}")
 
 # Add back what we need
 print("Adding test entities")
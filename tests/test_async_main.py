@@ -0,0 +1,121 @@
+"""Unit tests for the asynchronous flexilims client"""
+
+import asyncio
+import datetime
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+try:
+    from flexiznam.config.config_tools import get_password
+except ImportError:
+    print("Flexiznam is not installed. Will crash at steps requiring passwords")
+    get_password = None
+
+pytest.importorskip("aiohttp")
+
+from flexilims.async_main import AsyncFlexilims  # noqa: E402
+from flexilims.server import FlexilimsServer  # noqa: E402
+
+TEST_URL = "http://clvd0-ws-u-t-41.thecrick.test:8080/flexilims/api/"
+USERNAME = "blota"
+if get_password is None:
+    password = "NotDefined"
+else:
+    password = get_password(username=USERNAME, app="flexilims")
+PROJECT_ID = "606df1ac08df4d77c72c9aa4"  # <- test_api project
+MOUSE_ID = "6094f7212597df357fa24a8c"
+IN_GITHUB_ACTIONS = os.getenv("GITHUB_ACTIONS") == "true"
+
+not_on_github = pytest.mark.skipif(
+    IN_GITHUB_ACTIONS, reason="Test works only in Crick network."
+)
+JSON_FILE = Path(__file__).parent / "test_data.json"
+
+
+@pytest.fixture(params=["local", pytest.param("crick", marks=not_on_github)])
+def login(request):
+    """Arguments to connect to a local `FlexilimsServer` or to the test server"""
+    if request.param == "crick":
+        yield dict(username=USERNAME, password=password, base_url=TEST_URL)
+        return
+    with FlexilimsServer(
+        JSON_FILE, username="user", password="pass", project_id=PROJECT_ID
+    ) as server:
+        yield dict(username="user", password="pass", base_url=server.url)
+
+
+def test_get_req(login):
+    async def run():
+        async with AsyncFlexilims(project_id=PROJECT_ID, **login) as sess:
+            r = await sess.get(datatype="recording")
+            assert len(r) >= 1
+            r = await sess.get(datatype="mouse", id=MOUSE_ID)
+            assert len(r) == 1
+            ch = await sess.get_children(id=MOUSE_ID)
+            assert "test_session" in [c["name"] for c in ch]
+            # concurrent requests share the same session
+            reps = await asyncio.gather(
+                *[sess.get(datatype="mouse", id=MOUSE_ID) for _ in range(5)]
+            )
+            assert all(r == reps[0] for r in reps)
+
+    asyncio.run(run())
+
+
+def test_token_refresh(login):
+    async def run():
+        async with AsyncFlexilims(**login) as sess:
+            sess.session.headers["Authorization"] = "Bearer invalid_token"
+            pj = await sess.get_project_info()
+            assert len(pj) >= 1
+            assert sess.session.headers["Authorization"] != "Bearer invalid_token"
+
+    asyncio.run(run())
+
+
+def test_post_and_delete(login):
+    async def run():
+        async with AsyncFlexilims(project_id=PROJECT_ID, **login) as sess:
+            now = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            rep = await sess.post(
+                datatype="recording",
+                name="async_test_ran_on_%s" % now,
+                origin_id=MOUSE_ID,
+                attributes=dict(path="temp"),
+                strict_validation=False,
+            )
+            rep = await sess.update_one(
+                id=rep["id"],
+                datatype="recording",
+                attributes=dict(path="new_temp"),
+                strict_validation=False,
+            )
+            assert rep["attributes"]["path"] == "new_temp"
+            dlm = await sess.delete(rep["id"])
+            assert dlm.startswith("deleted successfully")
+            with pytest.raises(OSError):
+                await sess.delete(rep["id"])
+
+    asyncio.run(run())
+
+
+def test_token_backoff():
+    async def run(url):
+        async with AsyncFlexilims(
+            "user", "pass", project_id=PROJECT_ID, base_url=url
+        ) as sess:
+            assert sess.session.headers["Authorization"].startswith("Bearer ")
+            sess.password = "wrong"
+            start = time.monotonic()
+            with pytest.raises(IOError, match="Timeout reached"):
+                await sess.update_token(timeout=1)
+            # retried after 0.5 s, then stopped at the timeout
+            assert 1 <= time.monotonic() - start < 2
+
+    with FlexilimsServer(
+        JSON_FILE, username="user", password="pass", project_id=PROJECT_ID
+    ) as server:
+        asyncio.run(run(server.url))
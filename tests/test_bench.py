@@ -0,0 +1,39 @@
+"""Smoke tests of the benchmark suite"""
+
+from flexilims import bench
+
+
+def test_run_benchmarks():
+    results = bench.run_benchmarks(sizes=(100, 200), repeat=1, verbose=False)
+    # benchmarks independent of the database size are run once
+    n_results = sum(2 if b[3] else 1 for b in bench.BENCHMARKS.values())
+    assert len(results["results"]) == n_results
+    # benchmarks needing a missing optional module are skipped
+    assert all(
+        r["skipped"] != bench._available(r["benchmark"]) for r in results["results"]
+    )
+    ratios = bench.compare(results, results)
+    assert len(ratios) == sum(not r["skipped"] for r in results["results"])
+    assert all(r[-1] == 1 for r in ratios)
+    # benchmarks are skipped when they would take too long
+    results = bench.run_benchmarks(
+        sizes=(100, 200),
+        names=["offline_get_type"],
+        max_time=0,
+        online=False,
+        verbose=False,
+    )
+    assert [r["skipped"] for r in results["results"]] == [False, True]
+
+
+def test_missing_requirement(monkeypatch):
+    function, setup, online, per_size, _ = bench.BENCHMARKS["format_results"]
+    monkeypatch.setitem(
+        bench.BENCHMARKS,
+        "format_results",
+        (function, setup, online, per_size, ("not_installed_module",)),
+    )
+    results = bench.run_benchmarks(
+        sizes=(100,), names=["format_results"], online=False, verbose=False
+    )
+    assert [r["skipped"] for r in results["results"]] == [True]
@@ -0,0 +1,117 @@
+"""Unit tests for the cache of flexilims replies"""
+
+import time
+
+from flexilims.cache import ResponseCache, SQLiteCache, reply_tags, request_key
+
+
+def test_request_key():
+    k1 = request_key("get", dict(type="session", project_id="p", id=None))
+    k2 = request_key("get", dict(project_id="p", type="session"))
+    assert k1 == k2
+    assert request_key("get", dict(query_value=1)) == request_key(
+        "get", dict(query_value="1")
+    )
+    assert k1 != request_key("get-children", dict(project_id="p", type="session"))
+
+
+def test_lookup_and_store():
+    cache = ResponseCache()
+    found, value = cache.lookup("key")
+    assert not found
+    reply = [dict(id="a", type="session", attributes=dict(path="p"))]
+    cache.store("key", reply, tags=reply_tags(reply))
+    found, value = cache.lookup("key")
+    assert found
+    assert value == reply
+    # the cache returns copies
+    value[0]["attributes"]["path"] = "modified"
+    assert cache.lookup("key")[1] == reply
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 1
+
+
+def test_eviction():
+    cache = ResponseCache(max_entries=2)
+    for i in range(3):
+        cache.store(i, [i])
+    assert len(cache) == 2
+    assert not cache.lookup(0)[0]
+    # lookup makes 1 the most recently used
+    assert cache.lookup(1)[0]
+    cache.store(3, [3])
+    assert cache.lookup(1)[0]
+    assert not cache.lookup(2)[0]
+    assert cache.stats()["evictions"] == 2
+
+    cache = ResponseCache(max_entries=None, max_bytes=20)
+    cache.store("a", ["0123456789"])
+    cache.store("b", ["0123456789"])
+    assert len(cache) == 1
+    assert cache.lookup("b")[0]
+    # too big to be stored at all
+    cache.store("c", ["0" * 100])
+    assert not cache.lookup("c")[0]
+
+    cache = ResponseCache(ttl=0.01)
+    cache.store("a", [])
+    time.sleep(0.02)
+    assert not cache.lookup("a")[0]
+
+
+def test_invalidate():
+    cache = ResponseCache()
+    sessions = [dict(id="s1", type="session"), dict(id="s2", type="session")]
+    cache.store("get_sessions", sessions, tags={("type", "session")})
+    cache.store("children", sessions, tags={("parent", "m1")} | reply_tags(sessions))
+    cache.store("mice", [dict(id="m1", type="mouse")], tags={("type", "mouse")})
+    assert cache.invalidate([("id", "s2")]) == 1
+    assert not cache.lookup("children")[0]
+    assert cache.lookup("get_sessions")[0]
+    assert cache.invalidate([("type", "session"), ("parent", "m2")]) == 1
+    assert cache.lookup("mice")[0]
+    # replies of requests sent before an invalidation are not stored
+    generation = cache.generation
+    cache.invalidate([("type", "mouse")])
+    cache.store("mice", [], generation=generation)
+    assert not cache.lookup("mice")[0]
+
+
+def test_sqlite_cache(tmp_path):
+    cache = SQLiteCache(tmp_path / "cache.db")
+    sessions = [
+        dict(id="s1", type="session", dateCreated=1, dateUpdated=1),
+        dict(id="s2", type="session", dateCreated=2, dateUpdated=2),
+    ]
+    assert not cache.lookup("key")[0]
+    cache.store("get_sessions", sessions, tags={("type", "session")})
+    cache.store("children", sessions[1:], tags={("parent", "m1")})
+    cache.store("projects", [dict(uuid="p")])
+    # a second object, e.g. in another process, sees the same data
+    other = SQLiteCache(tmp_path / "cache.db")
+    assert other.lookup("get_sessions") == (True, sessions)
+    assert other.lookup("projects") == (True, [dict(uuid="p")])
+    assert other.stats()["entities"] == 2
+
+    # entities are shared between replies, the most recent version is kept
+    updated = dict(id="s2", type="session", dateCreated=2, dateUpdated=5)
+    cache.store("get_s2", [updated])
+    assert cache.lookup("children")[1] == [updated]
+    cache.store("old_s2", [sessions[1]])
+    assert cache.lookup("get_s2")[1] == [updated]
+
+    # invalidating an entity invalidates all the replies containing it
+    cache.invalidate([("id", "s2")])
+    assert not cache.lookup("get_sessions")[0]
+    assert not cache.lookup("children")[0]
+    assert cache.lookup("projects")[0]
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_sqlite_cache_max_age(tmp_path):
+    cache = SQLiteCache(tmp_path / "cache.db", max_age=0.01)
+    cache.store("key", [dict(id="s1", dateCreated=1)])
+    time.sleep(0.02)
+    assert not cache.lookup("key")[0]
+    assert cache.lookup_stale("key") == (True, [dict(id="s1", dateCreated=1)])
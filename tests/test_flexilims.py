@@ -2,6 +2,9 @@
 
 import datetime
 import os
+import threading
+import time
+from pathlib import Path
 
 import numpy as np
 import pytest
@@ -14,6 +17,7 @@ except ImportError:
 
 import flexilims as flm
 from flexilims.main import FlexilimsError
+from flexilims.server import FlexilimsServer
 
 TEST_URL = "http://clvd0-ws-u-t-41.thecrick.test:8080/flexilims/api/"
 # BASE_URL = "https://flexylims.thecrick.org/flexilims/api/"
@@ -35,6 +39,21 @@ print("------------------")
 not_on_github = pytest.mark.skipif(
     IN_GITHUB_ACTIONS, reason="Test works only in Crick network."
 )
+JSON_FILE = Path(__file__).parent / "test_data.json"
+
+
+@pytest.fixture(params=["local", pytest.param("crick", marks=not_on_github)])
+def sess(request):
+    """Session connected to a local `FlexilimsServer` or to the test server"""
+    if request.param == "crick":
+        yield flm.Flexilims(
+            USERNAME, password, project_id=PROJECT_ID, base_url=TEST_URL
+        )
+        return
+    with FlexilimsServer(
+        JSON_FILE, username="user", password="pass", project_id=PROJECT_ID
+    ) as server:
+        yield flm.Flexilims("user", "pass", project_id=PROJECT_ID, base_url=server.url)
 
 
 @not_on_github
@@ -51,6 +70,19 @@ def test_update_token():
     assert sess.session.headers["Authorization"] != ori_tok
 
 
+def test_token_expiry():
+    import base64
+    import json
+
+    from flexilims.main import _token_expiry
+
+    payload = base64.urlsafe_b64encode(json.dumps(dict(exp=1700000000)).encode())
+    token = "header.%s.signature" % payload.decode().rstrip("=")
+    assert _token_expiry("Bearer %s" % token) == 1700000000
+    assert _token_expiry("Bearer not_a_jwt") is None
+    assert _token_expiry("Bearer header.bm90IGpzb24.signature") is None
+
+
 @not_on_github
 def test_session_creation():
     sess = flm.Flexilims(USERNAME, password, base_url=TEST_URL)
@@ -124,6 +156,36 @@ def test_delete():
         sess.delete(rep["id"])
 
 
+def test_delete_tree(sess):
+    now = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    root = sess.post(
+        datatype="session",
+        name="test_delete_tree_%s" % now,
+        origin_id=MOUSE_ID,
+        attributes=dict(path="temp"),
+        strict_validation=False,
+    )
+    recordings = sess.post_many(
+        [
+            dict(
+                datatype="recording",
+                name="test_delete_tree_%s_rec%d" % (now, i),
+                origin_id=root["id"],
+                attributes=dict(path="temp"),
+                strict_validation=False,
+            )
+            for i in range(3)
+        ]
+    )
+    outcome = sess.delete_tree(root["id"])
+    assert set(outcome) == set(r["id"] for r in recordings)
+    assert all(rep.startswith("deleted successfully") for rep in outcome.values())
+    assert not sess.get_children(root["id"])
+    outcome = sess.delete_tree(root["id"], include_root=True)
+    assert list(outcome) == [root["id"]]
+    assert not sess.get(datatype="session", id=root["id"])
+
+
 @not_on_github
 def test_get_req():
     sess = flm.Flexilims(USERNAME, password, base_url=TEST_URL)
@@ -179,6 +241,21 @@ def test_get_req():
     )
 
 
+def test_get_parallel(sess):
+    expected = sess.get(datatype="dataset")
+    reply = sess.get_parallel(datatype="dataset", page_size=2, min_page_size=2)
+    assert sorted(r["id"] for r in reply) == sorted(r["id"] for r in expected)
+    reply = sess.get_parallel(datatype="dataset", name="test_dataset")
+    assert (len(reply) == 1) and (reply[0]["name"] == "test_dataset")
+
+
+def test_iter_get(sess):
+    streamed = list(sess.iter_get(datatype="recording", chunk_size=128))
+    assert streamed == sess.get(datatype="recording")
+    streamed = list(sess.iter_get(datatype="dataset", name="test_dataset"))
+    assert (len(streamed) == 1) and (streamed[0]["name"] == "test_dataset")
+
+
 @not_on_github
 def test_get_error():
     sess = flm.Flexilims(USERNAME, password, base_url=TEST_URL)
@@ -209,6 +286,17 @@ def test_get_children():
     assert "test_session" in [c["name"] for c in ch]
 
 
+def test_get_tree(sess):
+    tree = sess.get_tree(MOUSE_ID)
+    assert list(tree) == ["test_mouse"]
+    ts = tree["test_mouse"]["children"]["test_session"]
+    assert "test_dataset" in ts["children"]["test_recording"]["children"]
+    tree = sess.get_tree(MOUSE_ID, max_depth=1)
+    assert "children" not in tree["test_mouse"]["children"]["test_session"]
+    tree = sess.get_tree(MOUSE_ID, types="session")
+    assert "children" not in tree["test_mouse"]["children"]["test_session"]
+
+
 @not_on_github
 def test_get_children_error():
     sess = flm.Flexilims(
@@ -537,6 +625,37 @@ def test_post_null():
     sess.delete(rep["id"])
 
 
+def test_post_many(sess):
+    now = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    entities = [
+        dict(
+            datatype="session",
+            name="test_post_many_%s_%d" % (now, i),
+            attributes=dict(path="test/session"),
+            origin_id=MOUSE_ID,
+            strict_validation=False,
+        )
+        for i in range(5)
+    ]
+    # invalid attribute name is reported but does not stop the others
+    entities.insert(
+        2,
+        dict(datatype="session", name="bad_%s" % now, attributes={"plu+s": "o"}),
+    )
+    reps = sess.post_many(entities, max_workers=3)
+    assert len(reps) == 6
+    assert isinstance(reps[2], FlexilimsError)
+    valid = [r for r in reps if not isinstance(r, Exception)]
+    assert [r["name"] for r in valid] == [
+        e["name"] for e in entities if e["name"].startswith("test_post_many")
+    ]
+    with pytest.raises(FlexilimsError):
+        sess.post_many(entities, stop_on_error=True)
+    # try to keep the db a bit clean
+    for rep in valid:
+        sess.delete(rep["id"])
+
+
 @not_on_github
 def test_post_error():
     sess = flm.Flexilims(USERNAME, password, base_url=TEST_URL)
@@ -806,6 +925,68 @@ def test_multiproject():
     assert ent_one["id"] != ent_two["id"]
 
 
+def test_single_flight():
+    from flexilims.main import _SingleFlight
+
+    single_flight = _SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow(value):
+        calls.append(value)
+        started.set()
+        release.wait()
+        if value == "error":
+            raise ValueError(value)
+        return [value]
+
+    for value in ("ok", "error"):
+        outputs = []
+        n_followers = 3
+        joined = threading.Barrier(n_followers + 1)
+
+        def call(follower=False):
+            if follower:
+                joined.wait()
+            try:
+                output = single_flight.do(value, slow, value)
+            except ValueError as err:
+                outputs.append(err)
+            else:
+                # each caller owns its copy of the result
+                output[0].append("changed")
+                outputs.append(output)
+
+        started.clear()
+        release.clear()
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait()
+        followers = [
+            threading.Thread(target=call, kwargs=dict(follower=True))
+            for _ in range(n_followers)
+        ]
+        for thread in followers:
+            thread.start()
+        joined.wait()
+        # wait for the followers to be registered before releasing the leader
+        while single_flight._in_flight[value][1] < n_followers:
+            time.sleep(0.001)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        assert len(outputs) == 4
+        if value == "ok":
+            assert sorted(o[1] for o in outputs) == [False, True, True, True]
+            assert all(o[0] == ["ok", "changed"] for o in outputs)
+        else:
+            assert all(isinstance(o, ValueError) for o in outputs)
+    assert calls == ["ok", "error"]
+    # the key is released after the call
+    assert single_flight.do("ok", slow, "ok") == (["ok"], False)
+
+
 if __name__ == "__main__":
     test_multiproject()
     test_token()
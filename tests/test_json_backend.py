@@ -0,0 +1,77 @@
+"""Tests of the selection of the JSON library"""
+
+import json
+import math
+from pathlib import Path
+
+import pytest
+
+from flexilims import json_backend
+from flexilims.offline import OfflineFlexilims
+
+JSON_FILE = Path(__file__).parent / "test_data.json"
+
+
+@pytest.fixture
+def default_backend():
+    """Restore the default backend after the test"""
+    default = json_backend.get_json_backend().name
+    yield
+    json_backend.set_json_backend(default)
+
+
+@pytest.mark.parametrize("name", json_backend.available_backends())
+def test_roundtrip(name):
+    backend = json_backend.get_json_backend(name)
+    data = dict(a=[1, 2.5, "é", None, True], b=dict(c="d"))
+    encoded = backend.dumps(data)
+    assert isinstance(encoded, bytes)
+    assert backend.loads(encoded) == data
+    assert backend.loads(encoded.decode("utf8")) == data
+    # NaN is not valid JSON: refused by default, tolerated for the offline files
+    for value in (float("nan"), float("inf")):
+        with pytest.raises(ValueError):
+            backend.dumps(dict(a=[value]))
+    decoded = backend.loads(backend.dumps(dict(nan=float("nan")), allow_nan=True))
+    if name == "orjson":
+        assert decoded["nan"] is None
+    else:
+        assert math.isnan(decoded["nan"])
+    with pytest.raises(ValueError):
+        backend.loads(b"{invalid")
+
+
+def test_get_json_backend(default_backend):
+    assert json_backend.get_json_backend().name == "json"
+    fastest = json_backend.get_json_backend("fastest")
+    assert fastest.name == json_backend.available_backends()[0]
+    assert json_backend.get_json_backend(fastest) is fastest
+    with pytest.raises(ValueError):
+        json_backend.get_json_backend("pickle")
+    for name in ("orjson", "ujson"):
+        if name not in json_backend.available_backends():
+            with pytest.warns(UserWarning):
+                assert json_backend.get_json_backend(name).name == "json"
+    json_backend.set_json_backend("fastest")
+    assert json_backend.get_json_backend() is fastest
+
+
+def test_offline_backend(default_backend, tmp_path):
+    reference = OfflineFlexilims(JSON_FILE)
+    assert reference.json_backend.name == "json"
+    fastest = json_backend.available_backends()[0]
+    sess = OfflineFlexilims(JSON_FILE, json_backend=fastest)
+    assert sess.json_backend.name == fastest
+    assert str(sess._json_data) == str(reference._json_data)
+    # instances without a backend follow the global default
+    json_backend.set_json_backend(fastest)
+    assert reference.json_backend.name == fastest
+    # edited files can be read back. The NaN of old files can be written as null
+    path = tmp_path / "data.json"
+    path.write_bytes(JSON_FILE.read_bytes())
+    sess = OfflineFlexilims(path, edit_file=True)
+    sess.delete(sess.get_children(id=sess.get(datatype="mouse")[0]["id"])[0]["id"])
+    reloaded = OfflineFlexilims(path, json_backend="json")._json_data
+    assert json.dumps(reloaded).replace("NaN", "null") == json.dumps(
+        sess._json_data
+    ).replace("NaN", "null")
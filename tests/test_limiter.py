@@ -0,0 +1,69 @@
+"""Tests of the adaptive concurrency limiter"""
+
+import threading
+import time
+
+import pytest
+
+from flexilims.limiter import AdaptiveLimiter
+
+
+def test_aimd():
+    limiter = AdaptiveLimiter(initial_limit=4, min_limit=1, max_limit=6)
+    # the limit only grows when it is in use
+    started = limiter.acquire()
+    limiter.release(started)
+    assert limiter.limit == 4
+    for _ in range(20):
+        starts = [limiter.acquire() for _ in range(int(limiter.limit))]
+        for started in starts:
+            limiter.release(started)
+    assert limiter.limit == 6
+    # a burst of failures only decreases the limit once
+    starts = [limiter.acquire() for _ in range(6)]
+    for started in starts:
+        limiter.release(started, overloaded=True)
+    assert limiter.limit == 3
+    stats = limiter.stats()
+    assert stats["decreases"] == 1
+    assert stats["overloads"] == 6
+    assert stats["in_flight"] == 0
+    assert stats["throughput"] > 0
+    for _ in range(5):
+        limiter.release(limiter.acquire(), overloaded=True)
+    assert limiter.limit == 1
+    with pytest.raises(ValueError):
+        AdaptiveLimiter(initial_limit=10, max_limit=5)
+
+
+def test_concurrency_limit():
+    limiter = AdaptiveLimiter(initial_limit=3, max_limit=3)
+    lock = threading.Lock()
+    state = dict(running=0, max_running=0)
+
+    def work():
+        started = limiter.acquire()
+        with lock:
+            state["running"] += 1
+            state["max_running"] = max(state["max_running"], state["running"])
+        time.sleep(0.01)
+        with lock:
+            state["running"] -= 1
+        limiter.release(started)
+
+    threads = [threading.Thread(target=work) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert state["max_running"] == 3
+    assert limiter.successes == 20
+
+
+def test_rate_limit():
+    limiter = AdaptiveLimiter(rate=50, burst=5)
+    start = time.monotonic()
+    for _ in range(15):
+        limiter.release(limiter.acquire())
+    # 5 requests in the initial burst, then 10 at 50 per second
+    assert time.monotonic() - start >= 0.18
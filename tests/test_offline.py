@@ -63,6 +63,85 @@ def test_download_database(tmp_path):
     assert num_diff == 0
 
 
+def test_download_database_incremental():
+    from copy import deepcopy
+
+    from flexilims.offline import download_database
+
+    types = ("mouse", "session", "recording", "dataset")
+    # use an offline session as the source database
+    sess = flm.OfflineFlexilims(JSON_FILE)
+    full = download_database(sess, types=types, verbose=False)
+    assert full["test_mouse"]["id"] == MOUSE_ID
+    # the source has NaN values, the snapshot is valid JSON with null instead
+    assert full["test_mouse"]["origin_id"] is None
+    json.dumps(full, allow_nan=False)
+
+    # remove the most recent entity, it should be downloaded again
+    snapshot = deepcopy(full)
+    ts = snapshot["test_mouse"]["children"]["test_session"]
+    ts["children"]["test_recording"].pop("children")
+    out = download_database(sess, types=types, verbose=False, snapshot=snapshot)
+    assert out is snapshot
+    assert "test_dataset" in ts["children"]["test_recording"]["children"]
+
+    # modifications are only detected when reconciling
+    snapshot = deepcopy(full)
+    ts = snapshot["test_mouse"]["children"]["test_session"]
+    ts["attributes"]["path"] = "modified"
+    ts["dateUpdated"] = 0
+    ts["children"]["deleted"] = dict(
+        id="0" * 24, type="recording", name="deleted", origin_id=ts["id"], dateCreated=0
+    )
+    # move the recording to be a child of the mouse
+    recording = ts["children"].pop("test_recording")
+    recording["origin_id"] = MOUSE_ID
+    recording["dateUpdated"] = 0
+    snapshot["test_mouse"]["children"]["test_recording"] = recording
+    download_database(sess, types=types, verbose=False, snapshot=snapshot)
+    assert ts["attributes"]["path"] == "modified"
+    download_database(
+        sess, types=types, verbose=False, snapshot=snapshot, reconcile=True
+    )
+    assert json.dumps(snapshot, sort_keys=True, allow_nan=False) == json.dumps(
+        full, sort_keys=True
+    )
+
+
+def test_download_database_moved_to_newer_parent():
+    from flexilims.offline import download_database
+
+    types = ("mouse", "session", "recording", "dataset")
+    sess = flm.OfflineFlexilims(JSON_FILE)
+    snapshot = download_database(sess, types=types, verbose=False)
+    # move a recording, with its datasets, below a session created after it
+    recording = sess.get(datatype="recording", name="test_recording")[0]
+    session = sess.post(
+        datatype="session", name="newer_session", origin_id=MOUSE_ID, attributes={}
+    )
+    sess._update_fields(
+        sess._entities[session["id"]], dateCreated=recording["dateCreated"] + 1
+    )
+    sess._update_fields(
+        sess._entities[recording["id"]], origin_id=session["id"], dateUpdated=1
+    )
+    download_database(
+        sess, types=types, verbose=False, snapshot=snapshot, reconcile=True
+    )
+    full = download_database(sess, types=types, verbose=False)
+    assert json.dumps(snapshot, sort_keys=True) == json.dumps(full, sort_keys=True)
+    newer = snapshot["test_mouse"]["children"]["newer_session"]
+    assert "test_dataset" in newer["children"]["test_recording"]["children"]
+    # entities that cannot be placed back are not dropped silently
+    sess._update_fields(
+        sess._entities[recording["id"]], origin_id="f" * 24, dateUpdated=2
+    )
+    with pytest.raises(ValueError):
+        download_database(
+            sess, types=types, verbose=False, snapshot=snapshot, reconcile=True
+        )
+
+
 def test_token():
     tok = flm.get_token(USERNAME, password)
     assert len(tok)
@@ -341,6 +420,203 @@ def test_post_null():
     assert rep["attributes"]["none"] == None  # noqa: E711
 
 
+def test_delete():
+    sess = flm.OfflineFlexilims(JSON_FILE)
+    session_id = sess.get_children(id=MOUSE_ID)[0]["id"]
+    n_entities = len(sess._flat_data())
+    deleted = sess.delete(session_id)
+    assert deleted["id"] == session_id
+    # children are deleted too
+    assert len(sess._flat_data()) < n_entities - 1
+    assert sess.get_children(id=MOUSE_ID) == []
+    with pytest.raises(flm.FlexilimsError):
+        sess.delete(session_id)
+
+
+def test_indexes():
+    sess = flm.OfflineFlexilims(JSON_FILE)
+    n_sessions = len(sess.get(datatype="session"))
+    session = sess.post(
+        datatype="session",
+        name="indexed_session",
+        attributes=dict(path="indexed"),
+        origin_id=MOUSE_ID,
+    )
+    sess.post(
+        datatype="recording",
+        name="indexed_recording",
+        attributes=dict(path="indexed/recording"),
+        origin_id=session["id"],
+    )
+    assert sess.get(id=session["id"])[0]["name"] == "indexed_session"
+    assert len(sess.get(datatype="session")) == n_sessions + 1
+    assert [e["name"] for e in sess.get(origin_id=session["id"])] == [
+        "indexed_recording"
+    ]
+    assert [e["name"] for e in sess.get_children(session["id"])] == [
+        "indexed_recording"
+    ]
+    sess.update_one(id=session["id"], name="renamed_session")
+    assert sess.get(name="indexed_session") == []
+    assert (
+        sess.get(name="renamed_session", datatype="session")[0]["id"] == (session["id"])
+    )
+    # entities without attributes, or padded with NaN by older downloads, can be
+    # renamed
+    entity = sess._entities[session["id"]]
+    entity.pop("attributes")
+    sess.update_one(id=session["id"], name="session_without_attributes")
+    entity["attributes"] = float("nan")
+    sess.update_one(id=session["id"], name="session_with_nan_attributes")
+    assert sess.get(id=session["id"])[0]["name"] == "session_with_nan_attributes"
+    sess.delete(session["id"])
+    assert sess.get(id=session["id"]) == []
+    assert sess.get(name="indexed_recording") == []
+    assert len(sess.get(datatype="session")) == n_sessions
+    assert sess._find_entity(session["id"]) is None
+
+
+def test_columnar_snapshot(monkeypatch):
+    pytest.importorskip("numpy")
+
+    def queries(sess):
+        # compared as JSON, as NaN != NaN
+        return json.dumps(
+            [
+                sess.get(datatype="recording", created_by="Antonin Blot"),
+                sess.get(date_created=0),
+                sess.get(
+                    datatype="session", date_created=10**13, date_created_operator="lt"
+                ),
+                sess.get(name="columns_session", datatype="session"),
+            ]
+        )
+
+    def changes(sess):
+        session = sess.post(
+            datatype="session",
+            name="columns_session",
+            attributes=dict(path="columns"),
+            origin_id=MOUSE_ID,
+        )
+        sess._update_fields(session, dateCreated=1, createdBy="Antonin Blot")
+        recording = sess.post(
+            datatype="recording",
+            name="columns_recording",
+            attributes=dict(path="columns/recording"),
+            origin_id=session["id"],
+        )
+        sess._update_fields(recording, dateCreated=2, createdBy="Antonin Blot")
+        sess.update_one(id=recording["id"], name="columns_renamed")
+        return session
+
+    # use the snapshot for every query
+    monkeypatch.setattr(flm, "COLUMNS_MIN_ROWS", 0)
+    sess = flm.OfflineFlexilims(JSON_FILE)
+    reference = flm.OfflineFlexilims(JSON_FILE)
+    reference._get_columns = lambda: None
+    assert queries(sess) == queries(reference)
+    assert sess._columns is not None
+    # the snapshot is updated incrementally
+    columns = sess._columns
+    session = changes(sess)
+    changes(reference)
+    assert sess._columns is columns
+    assert queries(sess) == queries(reference)
+    sess.delete(session["id"])
+    reference.delete(session["id"])
+    assert queries(sess) == queries(reference)
+    # the attributes returned can be modified without changing the database
+    recording = sess.get(datatype="recording")[0]
+    recording["attributes"]["path"] = "modified"
+    assert sess.get(datatype="recording")[0]["attributes"]["path"] != "modified"
+
+
+def test_attribute_index():
+    sess = flm.OfflineFlexilims(JSON_FILE)
+    rep = sess.get(query_key="path", query_value="test/session/recording")
+    assert {e["type"] for e in rep} == {"recording", "dataset"}
+    assert "path" in sess._attribute_index
+    rep = sess.get(query=dict(path="test/session/recording", ds_attr=rep[1]["name"]))
+    assert rep == []
+    rep = sess.get(
+        query_key="path",
+        query_value="test/session/recording",
+        query=dict(dataset_type="test_dataset"),
+    )
+    assert [e["name"] for e in rep] == ["test_dataset"]
+    # the index is updated by writes
+    session = sess.post(
+        datatype="session",
+        name="attribute_session",
+        attributes=dict(path="test/session/recording"),
+    )
+    rep = sess.get(query_key="path", query_value="test/session/recording")
+    assert rep[-1]["name"] == "attribute_session"
+    sess.update_one(id=session["id"], attributes=dict(path="new/path"))
+    assert sess.get(query_key="path", query_value="new/path")[0]["id"] == session["id"]
+    assert len(sess.get(query_key="path", query_value="test/session/recording")) == 2
+    sess.delete(session["id"])
+    assert sess.get(query_key="path", query_value="new/path") == []
+    # unhashable values are compared to each entity
+    assert sess.get(query_key="path", query_value=["a"]) == []
+
+
+def test_range_index():
+    sess = flm.OfflineFlexilims(JSON_FILE)
+    dates = sorted(e["dateCreated"] for e in sess.get())
+    rep = sess.get(date_created=(dates[0], dates[-1]))
+    assert sorted(e["dateCreated"] for e in rep) == dates[1:-1]
+    rep = sess.get(date_created=(dates[1], None), date_created_operator="between")
+    assert len(rep) == len(dates) - 2
+    with pytest.raises(flm.FlexilimsError):
+        sess.get(date_created=(dates[0], dates[-1]), date_created_operator="gt")
+
+    ids = [
+        sess.post(
+            datatype="session",
+            name="range_session_%s" % trial,
+            attributes=dict(path="range", trial=trial),
+        )["id"]
+        for trial in (1, 2, 2.5, 3, 4, 5)
+    ]
+    sess.post(
+        datatype="session", name="range_text", attributes=dict(path="r", trial="3")
+    )
+    rep = sess.get(query_range=dict(trial=(2, 4)))
+    assert [e["attributes"]["trial"] for e in rep] == [2, 2.5, 3, 4]
+    assert len(sess.get(query_range=dict(trial=(None, 2)))) == 2
+    # the index is updated by writes
+    sess.update_one(id=ids[1], attributes=dict(trial=10))
+    sess.delete(ids[2])
+    rep = sess.get(datatype="session", query_range=dict(trial=(2, None)))
+    assert [e["attributes"]["trial"] for e in rep] == [10, 3, 4, 5]
+    rep = sess.get(query_range=dict(trial=(3, 4)), query=dict(path="range"))
+    assert [e["id"] for e in rep] == ids[3:5]
+
+
+def test_post_ids(tmp_path):
+    with open(JSON_FILE) as f:
+        json_data = json.load(f)
+    for n in (1, 5):
+        name = "loaded_%d" % n
+        json_data[name] = dict(id="0x%022x" % n, type="mouse", name=name)
+    with open(tmp_path / "data.json", "w") as f:
+        json.dump(json_data, f)
+    sess = flm.OfflineFlexilims(tmp_path / "data.json")
+
+    def post(name):
+        return sess.post(datatype="session", name=name, attributes=dict(path="p"))
+
+    # ids follow the largest loaded id of the same format
+    ids = [post("id_session_%d" % i)["id"] for i in range(2)]
+    assert ids == ["0x%022x" % i for i in (6, 7)]
+    # ids of deleted entities, loaded or created, are not reused
+    sess.delete("0x%022x" % 5)
+    sess.delete(ids[-1])
+    assert post("id_session_2")["id"] == "0x%022x" % 8
+
+
 if __name__ == "__main__":
     test_post_null()
     test_update_one()
@@ -0,0 +1,462 @@
+"""Tests of the online client against the local stand-in server"""
+
+import threading
+import time
+from pathlib import Path
+
+import pytest
+import requests
+
+from flexilims.cache import ResponseCache, SQLiteCache
+from flexilims.limiter import AdaptiveLimiter
+from flexilims.main import Flexilims
+from flexilims.server import FlexilimsServer
+from flexilims.utils import ServerError
+
+PROJECT_ID = "606df1ac08df4d77c72c9aa4"
+MOUSE_ID = "6094f7212597df357fa24a8c"
+JSON_FILE = Path(__file__).parent / "test_data.json"
+
+
+@pytest.fixture
+def server():
+    with FlexilimsServer(
+        JSON_FILE, username="user", password="pass", project_id=PROJECT_ID
+    ) as server:
+        yield server
+
+
+@pytest.fixture
+def flm_sess(server):
+    return Flexilims("user", "pass", project_id=PROJECT_ID, base_url=server.url)
+
+
+def test_authenticate(server):
+    with pytest.raises(IOError):
+        Flexilims("user", "wrong", base_url=server.url)
+
+
+def test_get(flm_sess):
+    sessions = flm_sess.get(datatype="session")
+    assert [s["name"] for s in sessions] == ["test_session"]
+    assert "children" not in sessions[0]
+    mice = flm_sess.get(datatype="mouse", id=MOUSE_ID)
+    assert len(mice) == 1
+    assert "origin_id" not in mice[0]
+    assert flm_sess.get(datatype="session", query_key="test_uniq", query_value="unique")
+    assert not flm_sess.get(datatype="session", query_key="test_uniq", query_value="x")
+    children = flm_sess.get_children(MOUSE_ID)
+    assert [c["name"] for c in children] == ["test_session"]
+    assert flm_sess.get_project_info()[0]["uuid"] == PROJECT_ID
+    with pytest.raises(IOError):
+        flm_sess.get_children("000000000000000000000000")
+
+
+def test_get_date_created(flm_sess):
+    sessions = flm_sess.get(datatype="session")
+    date = max(s["dateCreated"] for s in sessions)
+    # timestamps read from downloaded databases can be floats
+    for value in (date, float(date), date - 0.5):
+        reply = flm_sess.get(
+            datatype="session", date_created=value, date_created_operator="lt"
+        )
+        assert len(reply) == len(sessions) - 1
+
+
+def _post_sessions(flm_sess, n_sessions):
+    flm_sess.post_many(
+        [
+            dict(datatype="session", name="page_%d" % i, attributes={})
+            for i in range(n_sessions)
+        ],
+        stop_on_error=True,
+    )
+    return flm_sess.get(datatype="session")
+
+
+def test_get_parallel(server, flm_sess):
+    sessions = _post_sessions(flm_sess, 9)
+    reply = flm_sess.get_parallel(datatype="session", page_size=2, min_page_size=2)
+    assert reply == sessions
+    assert flm_sess.get_parallel(datatype="session", name="page_3") == [
+        s for s in sessions if s["name"] == "page_3"
+    ]
+
+
+@pytest.mark.parametrize("extra", [-1, 0])
+def test_get_parallel_without_paging(server, flm_sess, monkeypatch, extra):
+    sessions = _post_sessions(flm_sess, 9)
+    get = server._get
+
+    def get_ignoring_paging(params, body):
+        params = {k: v for k, v in params.items() if k not in ("offset", "limit")}
+        return get(params, body)
+
+    # pages are longer than requested, or all the same as the first full page
+    monkeypatch.setattr(server, "_get", get_ignoring_paging)
+    page_size = len(sessions) + extra
+    n_gets = server.request_counts["get"]
+    reply = flm_sess.get_parallel(
+        datatype="session", page_size=page_size, min_page_size=page_size
+    )
+    assert reply == sessions
+    assert server.request_counts["get"] - n_gets <= 3
+    assert flm_sess.log[-1].startswith("offset and limit ignored")
+
+
+def test_write(flm_sess):
+    rep = flm_sess.post(
+        datatype="session",
+        name="new_session",
+        attributes=dict(path="new"),
+        origin_id=MOUSE_ID,
+    )
+    assert rep["origin_id"] == MOUSE_ID
+    assert "dateCreated" in rep
+    with pytest.raises(IOError):
+        flm_sess.post(datatype="session", name="new_session", attributes={})
+    rep = flm_sess.update_one(rep["id"], datatype="session", attributes=dict(n=2))
+    assert rep["attributes"] == dict(path="new", n=2)
+    rep = flm_sess.update_many(
+        datatype="session",
+        update_key="n",
+        update_value="3",
+        query_key="path",
+        query_value="new",
+    )
+    assert rep == "updated successfully 1 items of type session with n=3"
+    new = flm_sess.get(datatype="session", name="new_session")[0]
+    assert new["attributes"]["n"] == "3"
+    assert flm_sess.delete(new["id"]) == "deleted successfully null"
+    assert not flm_sess.get(datatype="session", name="new_session")
+    with pytest.raises(IOError):
+        flm_sess.delete(new["id"])
+
+
+@pytest.mark.parametrize("cache_type", ["memory", "sqlite"])
+def test_cache(server, tmp_path, cache_type):
+    if cache_type == "memory":
+        cache = ResponseCache()
+    else:
+        cache = SQLiteCache(tmp_path / "cache.db")
+    flm_sess = Flexilims(
+        "user", "pass", project_id=PROJECT_ID, base_url=server.url, cache=cache
+    )
+
+    def count_gets(*args, **kwargs):
+        before = server.request_counts["get"]
+        rep = flm_sess.get(*args, **kwargs)
+        return rep, server.request_counts["get"] - before
+
+    sessions, n_gets = count_gets(datatype="session")
+    assert n_gets == 1
+    assert count_gets(datatype="session") == (sessions, 0)
+    # write requests invalidate the cached replies
+    rep = flm_sess.post(
+        datatype="session",
+        name="cached_session",
+        attributes=dict(path="cached"),
+        origin_id=MOUSE_ID,
+    )
+    new_sessions, n_gets = count_gets(datatype="session")
+    assert n_gets == 1
+    assert [s["id"] for s in new_sessions] == [s["id"] for s in sessions] + [rep["id"]]
+    assert count_gets(datatype="session") == (new_sessions, 0)
+    flm_sess.update_one(rep["id"], datatype="session", attributes=dict(n=2))
+    new_sessions, n_gets = count_gets(datatype="session")
+    assert n_gets == 1
+    assert new_sessions[-1]["attributes"] == dict(path="cached", n=2)
+    flm_sess.delete(rep["id"])
+    assert count_gets(datatype="session") == (sessions, 1)
+    assert count_gets(datatype="session") == (sessions, 0)
+
+
+def test_delete_tree_with_cache(server):
+    flm_sess = Flexilims(
+        "user",
+        "pass",
+        project_id=PROJECT_ID,
+        base_url=server.url,
+        cache=ResponseCache(),
+    )
+    session = flm_sess.post(
+        datatype="session", name="tree_session", attributes={}, origin_id=MOUSE_ID
+    )
+    recordings = [
+        flm_sess.post(
+            datatype="recording",
+            name="tree_recording",
+            attributes={},
+            origin_id=session["id"],
+        )
+    ]
+    assert flm_sess.get_children(session["id"]) == recordings
+    assert flm_sess.get(datatype="recording", name="tree_recording") == recordings
+    # a child created by another client is not in the cached reply
+    other = Flexilims("user", "pass", project_id=PROJECT_ID, base_url=server.url)
+    recordings.append(
+        other.post(
+            datatype="recording",
+            name="other_recording",
+            attributes={},
+            origin_id=session["id"],
+        )
+    )
+    outcome = flm_sess.delete_tree(session["id"], include_root=True)
+    assert set(outcome) == {session["id"]} | {r["id"] for r in recordings}
+    assert not any(isinstance(reply, Exception) for reply in outcome.values())
+    # the cached replies of the deleted entities are invalidated
+    assert flm_sess.get(datatype="recording", name="tree_recording") == []
+
+
+def test_cache_stale(server, tmp_path, monkeypatch):
+    cache = SQLiteCache(tmp_path / "cache.db", max_age=0)
+    flm_sess = Flexilims(
+        "user", "pass", project_id=PROJECT_ID, base_url=server.url, cache=cache
+    )
+    sessions = flm_sess.get(datatype="session")
+    # another client adds an entity
+    other = Flexilims("user", "pass", project_id=PROJECT_ID, base_url=server.url)
+    rep = other.post(
+        datatype="session",
+        name="stale_session",
+        attributes=dict(path="stale"),
+        origin_id=MOUSE_ID,
+    )
+    sent = []
+    handle = server.handle
+
+    def record(method, endpoint, params, body, headers):
+        status, reply = handle(method, endpoint, params, body, headers)
+        sent.append((endpoint, params, reply))
+        return status, reply
+
+    monkeypatch.setattr(server, "handle", record)
+    # the expired reply is refreshed with the entities created since
+    new_sessions = flm_sess.get(datatype="session")
+    assert [s["id"] for s in new_sessions] == [s["id"] for s in sessions] + [rep["id"]]
+    ((endpoint, params, reply),) = sent
+    assert endpoint == "get"
+    assert params["date_created_operator"] == "gt"
+    assert [e["id"] for e in reply] == [rep["id"]]
+
+
+def test_token_expiry(server, flm_sess):
+    server.expire_tokens()
+    assert flm_sess.get(datatype="session")
+    assert flm_sess.stats()["token_refreshes"] == 1
+    assert server.request_counts["authenticate"] == 2
+
+
+def test_log_size(server):
+    flm_sess = Flexilims(
+        "user", "pass", project_id=PROJECT_ID, base_url=server.url, log_size=2
+    )
+    for _ in range(3):
+        flm_sess.update_token()
+    # the oldest messages are dropped, the log is still a list
+    assert flm_sess.log == ["Token refreshed for user user"] * 2
+    assert flm_sess.log[-1:] == ["Token refreshed for user user"]
+
+
+def test_token_lifetime():
+    with FlexilimsServer(JSON_FILE, token_lifetime=1) as server:
+        flm_sess = Flexilims(
+            "user", "pass", base_url=server.url, token_refresh_margin=0
+        )
+        # the expiry date is read from the token
+        assert flm_sess._token_expiry is not None
+        flm_sess.get(datatype="session")
+        assert flm_sess.stats()["token_refreshes"] == 0
+        time.sleep(1.1)
+        flm_sess.get(datatype="session")
+        assert flm_sess.stats()["token_refreshes"] == 1
+
+
+def test_errors_and_latency():
+    with FlexilimsServer(JSON_FILE, error_rate=1) as server:
+        flm_sess = Flexilims("user", "pass", base_url=server.url)
+        with pytest.raises(IOError):
+            flm_sess.get(datatype="session")
+        server.error_rate = 0
+        server.latency = 0.1
+        start = time.monotonic()
+        flm_sess.get(datatype="session")
+        assert time.monotonic() - start >= 0.1
+        # requests without a valid token are refused
+        status, _ = server.handle("GET", "get", {}, None, {})
+        assert status == 403
+
+
+def _get_from_threads(flm_sess, n_threads, **kwargs):
+    barrier = threading.Barrier(n_threads)
+    replies = [None] * n_threads
+
+    def work(i):
+        barrier.wait()
+        replies[i] = flm_sess.get(**kwargs)
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return replies
+
+
+def test_coalesce_reads(server, flm_sess):
+    server.latency = 0.2
+    replies = _get_from_threads(flm_sess, 8, datatype="session")
+    assert server.request_counts["get"] == 1
+    assert flm_sess.stats()["coalesced"] == 7
+    assert all(r == replies[0] for r in replies)
+    # callers get independent copies
+    replies[0][0]["name"] = "modified"
+    assert replies[1][0]["name"] == "test_session"
+    # different requests are not coalesced
+    _get_from_threads(flm_sess, 2, datatype="mouse")
+    assert server.request_counts["get"] == 2
+    flm_sess.coalesce_reads = False
+    _get_from_threads(flm_sess, 4, datatype="session")
+    assert server.request_counts["get"] == 6
+
+
+def test_shared_limiter(server):
+    limiter = AdaptiveLimiter(initial_limit=4, max_limit=8)
+    sessions = [
+        Flexilims(
+            "user",
+            "pass",
+            project_id=PROJECT_ID,
+            base_url=server.url,
+            limiter=limiter,
+            max_retries=0,
+        )
+        for _ in range(2)
+    ]
+    server.error_rate = 1
+    with pytest.raises(IOError):
+        sessions[0].get(datatype="session")
+    assert limiter.limit == 2
+    assert sessions[1].stats()["limiter"]["overloads"] == 1
+    server.error_rate = 0
+    replies = sessions[1].post_many(
+        [
+            dict(datatype="session", name="session_%d" % i, attributes={})
+            for i in range(20)
+        ],
+        stop_on_error=True,
+    )
+    assert len(replies) == 20
+    assert limiter.successes == 20
+    # requests counted from concurrent threads are not lost
+    assert server.request_counts["save"] == 20
+
+
+def test_retries(server):
+    flm_sess = Flexilims(
+        "user", "pass", project_id=PROJECT_ID, base_url=server.url, backoff=0.01
+    )
+    server.error_rate = 1
+    with pytest.raises(ServerError):
+        flm_sess.get(datatype="session")
+    assert server.request_counts["get"] == 1 + flm_sess.max_retries
+    assert flm_sess.stats()["endpoints"]["get"]["retries"] == flm_sess.max_retries
+    # posts are not retried once they reached the server
+    with pytest.raises(ServerError):
+        flm_sess.post(datatype="session", name="new", attributes={})
+    assert server.request_counts["save"] == 1
+    server.error_rate = 0
+    assert flm_sess.get(datatype="session")
+
+
+def test_timeout_and_deadline(server):
+    flm_sess = Flexilims(
+        "user", "pass", base_url=server.url, timeout=0.1, max_retries=1, backoff=0
+    )
+    server.latency = 0.5
+    start = time.monotonic()
+    with pytest.raises(requests.exceptions.Timeout):
+        flm_sess.get(datatype="session")
+    assert time.monotonic() - start < 0.5
+    assert flm_sess.stats()["endpoints"]["get"]["retries"] == 1
+    flm_sess.timeout = None
+    flm_sess.deadline = 0.2
+    start = time.monotonic()
+    with pytest.raises(IOError):
+        flm_sess.get(datatype="session")
+    assert time.monotonic() - start < 0.5
+    flm_sess.deadline = None
+    assert flm_sess.get(datatype="session")
+
+
+def test_hedged_requests(flm_sess):
+    class Reply(object):
+        status_code = 200
+
+    calls = []
+
+    def get(delay):
+        calls.append(delay)
+        time.sleep(delay if len(calls) == 1 else 0)
+        return Reply()
+
+    start = time.monotonic()
+    assert isinstance(flm_sess._send_hedged(0.05, get, 1), Reply)
+    assert time.monotonic() - start < 0.5
+    assert len(calls) == 2
+    assert flm_sess.stats()["hedged"] == 1
+    # fast requests are not hedged
+    calls.clear()
+    flm_sess._send_hedged(0.5, get, 0)
+    assert len(calls) == 1
+    # hedging needs enough samples to estimate the latency
+    flm_sess.hedge_quantile = 0.9
+    flm_sess.hedge_min_samples = 10
+    for _ in range(5):
+        flm_sess.get(datatype="session")
+    assert flm_sess.stats()["hedged"] == 1
+    # one worker for each request allowed by the limiter and its hedged copy
+    executor = flm_sess._hedge_executor
+    assert executor._max_workers == 2 * flm_sess.limiter.max_limit
+    flm_sess.close()
+    assert flm_sess._hedge_executor is None
+    with pytest.raises(RuntimeError):
+        executor.submit(get, 0)
+
+
+def test_connection_pool(server):
+    flm_sess = Flexilims(
+        "user", "pass", project_id=PROJECT_ID, base_url=server.url, pool_maxsize=4
+    )
+    adapter = flm_sess.session.get_adapter(server.url)
+    assert adapter._pool_maxsize == 4
+    # authentication and requests share the pooled connection
+    for _ in range(5):
+        flm_sess.get(datatype="session")
+    flm_sess.update_token()
+    assert server.connection_count == 1
+    threads = [
+        threading.Thread(target=flm_sess.get, kwargs=dict(datatype="mouse"))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert server.connection_count <= 5
+    flm_sess.close()
+
+    n_connections = server.connection_count
+    no_keep_alive = Flexilims(
+        "user", "pass", project_id=PROJECT_ID, base_url=server.url, keep_alive=False
+    )
+    for _ in range(2):
+        no_keep_alive.get(datatype="session")
+    # one connection per request
+    assert server.connection_count == n_connections + 3
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=2)
+    custom = Flexilims(
+        "user", "pass", project_id=PROJECT_ID, base_url=server.url, adapter=adapter
+    )
+    assert custom.session.get_adapter(server.url) is adapter
@@ -0,0 +1,85 @@
+"""Unit tests for the statistics of flexilims requests"""
+
+import logging
+import threading
+
+from flexilims.main import _endpoint_name
+from flexilims.stats import RequestStats
+
+
+def test_endpoint_name():
+    base_url = "https://flexylims.thecrick.org/flexilims/api/"
+    assert _endpoint_name(base_url + "get") == "get"
+    assert _endpoint_name(base_url + "update-many?strict_validation=false") == (
+        "update-many"
+    )
+    assert _endpoint_name(base_url + "get-children") == "get-children"
+
+
+def test_record_and_summary():
+    stats = RequestStats()
+    assert stats.quantile("get", 0.5) is None
+    for duration in [0.001, 0.002, 0.003, 0.2]:
+        stats.record("get", duration, n_bytes=10)
+    stats.record("save", 1.5, retries=1, error=IOError("failed"))
+    stats.record_token_refresh()
+    summary = stats.summary()
+    assert summary["token_refreshes"] == 1
+    get = summary["endpoints"]["get"]
+    assert get["count"] == 4
+    assert get["bytes"] == 40
+    assert get["errors"] == 0
+    assert abs(get["mean_time"] - 0.0515) < 1e-9
+    assert get["max_time"] == 0.2
+    assert get["histogram"][0.01] == 3
+    assert get["histogram"][0.25] == 1
+    assert get["p50"] == 0.01
+    assert get["p95"] == 0.2
+    save = summary["endpoints"]["save"]
+    assert save["errors"] == 1
+    assert save["retries"] == 1
+    stats.reset()
+    assert stats.summary() == dict(
+        token_refreshes=0, coalesced=0, hedged=0, endpoints={}
+    )
+
+
+def test_callbacks(caplog):
+    stats = RequestStats()
+    records = []
+    stats.add_callback(records.append)
+    stats.record("get", 0.1, n_bytes=5)
+    assert records == [
+        dict(endpoint="get", duration=0.1, bytes=5, retries=0, error=None)
+    ]
+    stats.remove_callback(records.append)
+    stats.record("get", 0.1)
+    assert len(records) == 1
+
+    # a failing callback is logged and does not stop the others
+    def fail(record):
+        raise RuntimeError("monitoring is down")
+
+    stats.add_callback(fail)
+    stats.add_callback(records.append)
+    with caplog.at_level(logging.ERROR, logger="flexilims.stats"):
+        stats.record("get", 0.1)
+    assert len(records) == 2
+    assert "monitoring is down" in caplog.text
+
+
+def test_thread_safety():
+    stats = RequestStats()
+
+    def work():
+        for _ in range(1000):
+            stats.record("get", 0.01)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    summary = stats.summary()["endpoints"]["get"]
+    assert summary["count"] == 8000
+    assert sum(summary["histogram"].values()) == 8000
@@ -0,0 +1,62 @@
+"""Tests of the synthetic database generator"""
+
+import json
+
+from flexilims.offline import OfflineFlexilims
+from flexilims.synthetic import (
+    HIERARCHY,
+    SyntheticDatabase,
+    make_database,
+    write_database,
+)
+
+
+def _flatten(json_data, depth=0, output=None):
+    if output is None:
+        output = []
+    for entity in json_data.values():
+        output.append((depth, entity))
+        _flatten(entity.get("children", {}), depth + 1, output)
+    return output
+
+
+def test_make_database():
+    json_data = make_database(100)
+    entities = _flatten(json_data)
+    assert len(entities) == 100
+    assert len({e["id"] for _, e in entities}) == 100
+    assert len({e["name"] for _, e in entities}) == 100
+    assert {e["type"] for _, e in entities} == set(HIERARCHY)
+    for depth, entity in entities:
+        assert entity["type"] == HIERARCHY[depth]
+        assert (depth == 0) == (entity["origin_id"] is None)
+        assert entity["dateUpdated"] >= entity["dateCreated"]
+    # same seed, same database
+    assert make_database(100) == json_data
+    assert make_database(100, seed=1) != json_data
+
+
+def test_fan_out_and_attributes():
+    database = SyntheticDatabase(
+        n_roots=2, fan_out=[3, (1, 2), 0], n_attributes=4, nested_fraction=1
+    )
+    entities = _flatten(database.to_json_data())
+    depths = [d for d, _ in entities]
+    assert depths.count(0) == 2
+    assert depths.count(1) == 6
+    assert 6 <= depths.count(2) <= 12
+    assert depths.count(3) == 0
+    for _, entity in entities:
+        attributes = entity["attributes"]
+        assert len(attributes) == 5
+        assert all(isinstance(v, dict) for k, v in attributes.items() if k != "path")
+
+
+def test_write_database(tmp_path):
+    path = tmp_path / "database.json"
+    for kwargs in [dict(), dict(fan_out=(0, 3)), dict(fan_out=0)]:
+        assert write_database(path, 150, seed=3, **kwargs) == 150
+        with open(path) as f:
+            assert json.load(f) == make_database(150, seed=3, **kwargs)
+    sess = OfflineFlexilims(path)
+    assert len(sess.get(datatype="mouse")) == 150
@@ -0,0 +1,67 @@
+"""Unit tests for the functions shared by online and offline flexilims"""
+
+import json
+import subprocess
+import sys
+
+import pytest
+
+from flexilims.utils import (
+    FlexilimsError,
+    flatten_attributes,
+    format_results,
+    iter_json_array,
+)
+
+
+def test_iter_json_array():
+    data = [
+        dict(id="a", attributes=dict(path="p", nested=dict(l=[1, 2.5, None]))),
+        dict(id="b", attributes=dict(text="unicode é ü, [brackets] {braces}")),
+        12345,
+        "string",
+        True,
+        [],
+    ]
+    encoded = json.dumps(data).encode("utf8")
+    # any chunk size should give the same elements, even when splitting characters
+    for chunk_size in (1, 2, 3, 7, 64, len(encoded)):
+        chunks = [
+            encoded[i : i + chunk_size] for i in range(0, len(encoded), chunk_size)
+        ]
+        assert list(iter_json_array(chunks)) == data
+    assert list(iter_json_array(["[", "]"])) == []
+    assert list(iter_json_array([" [ 1 , 2 ] "])) == [1, 2]
+    assert list(iter_json_array(["[1", "2, 3", "4]"])) == [12, 34]
+
+
+def test_iter_json_array_errors():
+    with pytest.raises(ValueError):
+        list(iter_json_array(['{"a": 1}']))
+    with pytest.raises(ValueError):
+        list(iter_json_array(["[1, 2"]))
+    with pytest.raises(ValueError):
+        list(iter_json_array(['[{"a": 1']))
+    with pytest.raises(ValueError):
+        list(iter_json_array(["[1; 2]"]))
+
+
+def test_import_without_pandas():
+    code = "import sys, flexilims; assert 'pandas' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_format_results():
+    def results():
+        return [
+            dict(id="a", name="a", attributes=dict(path="p", n=1)),
+            dict(id="b", name="b", attributes=dict(path="q")),
+        ]
+
+    flat = flatten_attributes(results())
+    assert flat[0] == dict(id="a", name="a", path="p", n=1)
+    df = format_results(results())
+    assert list(df.columns) == ["id", "name", "path", "n"]
+    assert df.path.tolist() == ["p", "q"]
+    with pytest.raises(FlexilimsError):
+        flatten_attributes([dict(id="a", attributes=dict(id="b"))])